@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+"""Throughput benchmarks against a local fake Imgur API.
+
+Runs imgur.upload.iter_upload_images and imgur.save.iter_save_images
+against tests.fakeimgur across batch sizes, job counts, engines and
+file sizes, and writes the results as JSON, one object per case::
+
+    python -m benchmarks.bench -o before.json
+    (make changes)
+    python -m benchmarks.bench -o after.json --compare before.json
+
+Each case runs in a fresh Python process, so that its peak RSS is its
+own. The fake server runs in yet another process, so that it does not
+compete with the client for the GIL. Its settings (latency, error rate,
+and the credits it reports in X-RateLimit-* headers and enforces with
+429 responses) are recorded with each case, and --compare only matches
+cases run with the same settings.
+
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# interval between samples of the number of processes and threads
+SAMPLE_INTERVAL = 0.01
+
+# options of the fake server, recorded with each case
+SERVER_SETTINGS = ('latency', 'error_rate', 'user_credits',
+                   'client_credits')
+
+def _int_list(string):
+    """Parse a comma-separated list of integers, with k/m suffixes."""
+    numbers = []
+    for word in string.split(','):
+        word = word.strip().lower()
+        multiplier = 1
+        if word.endswith('k'):
+            multiplier, word = 1024, word[:-1]
+        elif word.endswith('m'):
+            multiplier, word = 1024 * 1024, word[:-1]
+        numbers.append(int(word) * multiplier)
+    return numbers
+
+def _str_list(string):
+    """Parse a comma-separated list of strings."""
+    return [word.strip() for word in string.split(',')]
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers; None if empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1,
+                      int(round(fraction * len(values) + 0.5)) - 1))
+    return values[rank]
+
+class TimedItems(object):
+    """Sized iterable recording when each item is taken.
+
+    The engine takes items lazily, right before submitting them, so
+    this is when the item's job is submitted.
+
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.taken = {}  # index => time.perf_counter()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        for index, item in enumerate(self.items):
+            self.taken[index] = time.perf_counter()
+            yield item
+
+class Sampler(object):
+    """Sample the number of processes and threads in the background."""
+
+    def __init__(self):
+        self.peak_processes = 1
+        self.peak_threads = threading.active_count()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop.wait(SAMPLE_INTERVAL):
+            self.peak_processes = max(
+                self.peak_processes, 1 + len(multiprocessing.active_children()))
+            self.peak_threads = max(self.peak_threads,
+                                    threading.active_count())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.thread.join()
+
+def make_files(directory, count, size):
+    """Write count files of size bytes each, with distinct contents."""
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, '%06d.png' % index)
+        header = b'\x89PNG\r\n\x1a\n' + index.to_bytes(8, 'big')
+        with open(path, 'wb') as fileobj:
+            fileobj.write(header)
+            fileobj.write(os.urandom(max(0, size - len(header))))
+        paths.append(path)
+    return paths
+
+def run_case(case):
+    """Run one benchmark case in this process; return its results.
+
+    IMGUR_API_URL should point to a running fake server.
+
+    """
+    # imported here so that the parent process measures nothing
+    import pyimgur
+    import imgur.save
+    import imgur.upload
+
+    client = pyimgur.Imgur('benchmark')
+    api_url = os.environ['IMGUR_API_URL']
+    with tempfile.TemporaryDirectory(prefix='imgur-bench-') as directory:
+        if case['action'] == 'upload':
+            items = TimedItems(make_files(directory, case['batch_size'],
+                                          case['file_size']))
+            results = imgur.upload.iter_upload_images(
+                client, items, jobs=case['jobs'], engine=case['engine'])
+        else:
+            items = TimedItems(['%s/source/%d/%06d.png' %
+                                (api_url, case['file_size'], index)
+                                for index in range(case['batch_size'])])
+            results = imgur.save.iter_save_images(
+                client, items, jobs=case['jobs'], engine=case['engine'])
+        latencies = []
+        failures = 0
+        with Sampler() as sampler:
+            start = time.perf_counter()
+            for index, link in results:
+                latencies.append(time.perf_counter() - items.taken[index])
+                if link is None:
+                    failures += 1
+            elapsed = time.perf_counter() - start
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = dict(case)
+    result.update(
+        seconds=elapsed,
+        images_per_second=len(latencies) / elapsed if elapsed else None,
+        failures=failures,
+        latency_p50=percentile(latencies, 0.50),
+        latency_p99=percentile(latencies, 0.99),
+        # ru_maxrss is in KiB on Linux; for children, it is that of the
+        # largest child
+        peak_rss_kib=self_usage.ru_maxrss,
+        peak_child_rss_kib=children_usage.ru_maxrss,
+        peak_processes=sampler.peak_processes,
+        peak_threads=sampler.peak_threads,
+    )
+    return result
+
+def start_server(latency, error_rate, user_credits=None,
+                 client_credits=None):
+    """Start a fake server process; return (process, url).
+
+    Credits of None are unlimited.
+
+    """
+    command = [sys.executable, '-m', 'tests.fakeimgur', '--port', '0',
+               '--latency', str(latency), '--error-rate', str(error_rate)]
+    if user_credits is not None:
+        command += ['--user-credits', str(user_credits)]
+    if client_credits is not None:
+        command += ['--client-credits', str(client_credits)]
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    url = process.stdout.readline().strip()
+    if not url:
+        process.wait()
+        raise RuntimeError("fake server failed to start")
+    return process, url
+
+def spawn_case(case, api_url):
+    """Run one benchmark case in a fresh process; return its results."""
+    env = dict(os.environ, IMGUR_API_URL=api_url)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [ROOT, env.get('PYTHONPATH')]))
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'benchmarks.bench', '--case', json.dumps(case)],
+        cwd=ROOT, env=env, stderr=subprocess.DEVNULL,
+        universal_newlines=True)
+    return json.loads(output)
+
+def get_revision():
+    """Current git revision of the tree, or None."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(baseline, results):
+    """Print the change in throughput of each case from a baseline."""
+    keys = ('action', 'engine', 'batch_size', 'jobs', 'file_size') + \
+        SERVER_SETTINGS
+    before = {tuple(case.get(key) for key in keys): case
+              for case in baseline['cases']}
+    for case in results['cases']:
+        old = before.get(tuple(case.get(key) for key in keys))
+        if not old or not old['images_per_second']:
+            continue
+        change = case['images_per_second'] / old['images_per_second'] - 1
+        print('%-7s %-8s n=%-5d j=%-3d size=%-8d %8.1f img/s (%+.1f%%)' %
+              (case['action'], case['engine'], case['batch_size'],
+               case['jobs'], case['file_size'], case['images_per_second'],
+               change * 100), file=sys.stderr)
+
+def main():
+    """CLI interface."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark uploads and saves against a fake Imgur API.")
+    parser.add_argument('--actions', type=_str_list, default=['upload', 'save'],
+                        help="comma-separated; default is upload,save")
+    parser.add_argument('--engines', type=_str_list,
+                        default=['process', 'async'],
+                        help="comma-separated; default is process,async")
+    parser.add_argument('--batch-sizes', type=_int_list, default=[10, 100],
+                        help="comma-separated; default is 10,100")
+    parser.add_argument('--jobs', type=_int_list, default=[4, 16],
+                        help="comma-separated; default is 4,16")
+    parser.add_argument('--file-sizes', type=_int_list,
+                        default=[10 * 1024, 1024 * 1024],
+                        help="comma-separated, in bytes, with optional "
+                        "k or m suffix; default is 10k,1m")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="seconds the fake server waits before each "
+                        "response; default is 0.05")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="fraction of uploads failing; default is 0")
+    parser.add_argument('--user-credits', type=int,
+                        help="user credits of the fake server, reported in "
+                        "X-RateLimit-User* headers; unlimited by default")
+    parser.add_argument('--client-credits', type=int,
+                        help="application credits of the fake server, "
+                        "reported in X-RateLimit-Client* headers; unlimited "
+                        "by default")
+    parser.add_argument('-o', '--output',
+                        help="write results to this file instead of stdout")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="print throughput changes from an earlier "
+                        "results file")
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return 0
+
+    settings = {key: getattr(args, key) for key in SERVER_SETTINGS}
+    server, api_url = start_server(**settings)
+    cases = []
+    try:
+        for action, engine, batch_size, jobs, file_size in itertools.product(
+                args.actions, args.engines, args.batch_sizes, args.jobs,
+                args.file_sizes):
+            case = dict(settings, action=action, engine=engine,
+                        batch_size=batch_size, jobs=jobs,
+                        file_size=file_size)
+            result = spawn_case(case, api_url)
+            print('%(action)-7s %(engine)-8s n=%(batch_size)-5d '
+                  'j=%(jobs)-3d size=%(file_size)-8d '
+                  '%(images_per_second)8.1f img/s' % result, file=sys.stderr)
+            cases.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = dict(
+        revision=get_revision(),
+        python=sys.version.split()[0],
+        cpu_count=multiprocessing.cpu_count(),
+        cases=cases,
+        **settings
+    )
+    if args.compare:
+        with open(args.compare) as baseline_obj:
+            compare(json.load(baseline_obj), results)
+    if args.output:
+        with open(args.output, 'w') as output_obj:
+            json.dump(results, output_obj, indent=2)
+            output_obj.write('\n')
+    else:
+        print(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
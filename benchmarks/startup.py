@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""Startup benchmark of the command line tools, with a time budget.
+
+Measures, each in fresh Python processes, the time to import imgur.cli
+(what imgur-upload and imgur-save load before parsing arguments), and
+the wall time of an imgur-upload of a single image against a local
+fake Imgur API, and lists the heavy modules loaded by the import::
+
+    python -m benchmarks.startup --import-budget 150 --upload-budget 600
+
+Exits with status 1 if the median of a measurement exceeds its budget
+(in milliseconds), so that it can guard against regressions in CI.
+
+"""
+
+import argparse
+import json
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+from benchmarks.bench import ROOT, get_revision, start_server
+
+# modules imgur-upload should not load before it needs them
+HEAVY_MODULES = ['asyncio', 'concurrent.futures', 'imgur.request',
+                 'multiprocessing', 'numpy', 'PIL', 'pyimgur', 'requests']
+
+IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import imgur.cli
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, sorted(name for name in %r
+                                  if name in sys.modules)]))
+''' % HEAVY_MODULES
+
+UPLOAD_SCRIPT = '''
+import sys
+sys.argv[0] = 'imgur-upload'
+import imgur.cli
+sys.exit(imgur.cli.upload_main())
+'''
+
+def get_env(directory, api_url=None):
+    """Environment of the measured processes: imgur and a client_id
+    configured under directory, and no daemon."""
+    env = dict(os.environ,
+               XDG_CONFIG_HOME=os.path.join(directory, 'config'),
+               XDG_DATA_HOME=os.path.join(directory, 'data'),
+               XDG_RUNTIME_DIR=os.path.join(directory, 'run'))
+    env.pop('IMGUR_UPLOADD', None)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [ROOT, env.get('PYTHONPATH')]))
+    if api_url:
+        env['IMGUR_API_URL'] = api_url
+    conf_dir = os.path.join(directory, 'config', 'imgur')
+    os.makedirs(conf_dir, exist_ok=True)
+    os.makedirs(os.path.join(directory, 'run'), exist_ok=True)
+    with open(os.path.join(conf_dir, 'imgur.conf'), 'w') as conf_obj:
+        conf_obj.write('[oauth]\nclient_id = benchmark\n')
+    return env
+
+def make_png(path, size):
+    """Write a file of size bytes passing imgur.validate: a PNG header
+    of a 1x1 image, followed by noise."""
+    ihdr = b'IHDR' + struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0)
+    header = (b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + ihdr +
+              struct.pack('>I', zlib.crc32(ihdr)))
+    with open(path, 'wb') as fileobj:
+        fileobj.write(header)
+        fileobj.write(os.urandom(max(0, size - len(header))))
+
+def time_python(env):
+    """Wall time of a bare Python startup, in seconds."""
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', 'pass'], env=env)
+    return time.perf_counter() - start
+
+def time_import(env):
+    """Time to import imgur.cli, and the heavy modules it loaded."""
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT],
+                                     cwd=ROOT, env=env,
+                                     universal_newlines=True)
+    return json.loads(output)
+
+def time_upload(env, path):
+    """Wall time of imgur-upload of a single image, in seconds."""
+    start = time.perf_counter()
+    subprocess.check_call(
+        [sys.executable, '-c', UPLOAD_SCRIPT, '--anonymous', '--no-progress',
+         path], cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def main():
+    """CLI interface."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the startup of imgur-upload.")
+    parser.add_argument('-n', '--repeat', type=int, default=10,
+                        help="runs of each measurement; default is 10")
+    parser.add_argument('--import-budget', type=float, metavar='MS',
+                        help="fail if importing imgur.cli takes longer "
+                        "(median, in milliseconds)")
+    parser.add_argument('--upload-budget', type=float, metavar='MS',
+                        help="fail if a single-image imgur-upload takes "
+                        "longer (median wall time, in milliseconds)")
+    parser.add_argument('-o', '--output',
+                        help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    server, api_url = start_server(0.0, 0.0)
+    try:
+        with tempfile.TemporaryDirectory(prefix='imgur-bench-') as directory:
+            env = get_env(directory, api_url)
+            path = os.path.join(directory, 'image.png')
+            make_png(path, 10 * 1024)
+            python_times = []
+            import_times = []
+            upload_times = []
+            loaded = set()
+            for _ in range(args.repeat):
+                python_times.append(time_python(env))
+                elapsed, modules = time_import(env)
+                import_times.append(elapsed)
+                loaded.update(modules)
+                upload_times.append(time_upload(env, path))
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = dict(
+        revision=get_revision(),
+        python=sys.version.split()[0],
+        repeat=args.repeat,
+        python_ms=statistics.median(python_times) * 1000,
+        import_ms=statistics.median(import_times) * 1000,
+        upload_ms=statistics.median(upload_times) * 1000,
+        heavy_modules_loaded=sorted(loaded),
+    )
+    print('python startup %7.1f ms' % results['python_ms'], file=sys.stderr)
+    print('import         %7.1f ms' % results['import_ms'], file=sys.stderr)
+    print('upload of one  %7.1f ms' % results['upload_ms'], file=sys.stderr)
+    if loaded:
+        print('heavy modules loaded by import: %s' % ', '.join(sorted(loaded)),
+              file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as output_obj:
+            json.dump(results, output_obj, indent=2)
+            output_obj.write('\n')
+    else:
+        print(json.dumps(results, indent=2))
+
+    status = 0
+    for name, budget in (('import', args.import_budget),
+                         ('upload', args.upload_budget)):
+        measured = results['%s_ms' % name]
+        if budget is not None and measured > budget:
+            print('%s: %.1f ms over budget of %.1f ms' %
+                  (name, measured, budget), file=sys.stderr)
+            status = 1
+    return status
+
+if __name__ == "__main__":
+    exit(main())
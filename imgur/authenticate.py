@@ -5,14 +5,44 @@
 # pylint: disable=wildcard-import,unused-wildcard-import
 
 import configparser
+import contextlib
+import fcntl
+import hashlib
+import json
 import os
+import random
 import sys
+import tempfile
+import threading
+import time
 
 import pyimgur
+import requests
 
 from zmwangx.colorout import *
 
 import imgur.authorize
+import imgur.metrics
+import imgur.profiles
+import imgur.request
+
+# profile of the [oauth] section; others are in [oauth:NAME] sections
+DEFAULT_PROFILE = 'default'
+PROFILE_SECTION_PREFIX = 'oauth:'
+
+# refresh a cached access token this many seconds before it expires
+REFRESH_MARGIN = 300
+
+# attempts at refreshing the access token on network or server errors,
+# with exponential backoff from REFRESH_BACKOFF seconds
+REFRESH_ATTEMPTS = 4
+REFRESH_BACKOFF = 1.0
+
+# expiry of the access token loaded into this process, by refresh token;
+# threads of a process share their client, and only one of them
+# reloads the token at a time
+_expires_at = {}
+_expires_at_lock = threading.Lock()
 
 def get_conf_file():
     """Get the path to imgur's config file.
@@ -30,9 +60,222 @@ def get_conf_file():
         os.makedirs(os.path.dirname(conf_file), mode=0o700)
     return conf_file
 
-def get_credentials():
+def get_token_file():
+    """Get the path to the access token cache.
+
+    The cache is a JSON file named token.json in the same directory as
+    the config file.
+
+    """
+    return os.path.join(os.path.dirname(get_conf_file()), 'token.json')
+
+@contextlib.contextmanager
+def token_lock():
+    """Hold an exclusive lock on the access token cache."""
+    with open(get_token_file() + '.lock', 'a') as lock_obj:
+        fcntl.flock(lock_obj, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_obj, fcntl.LOCK_UN)
+
+def _refresh_token_digest(client):
+    """Identify the refresh token without storing it."""
+    return hashlib.sha256(client.refresh_token.encode('utf-8')).hexdigest()
+
+def _read_tokens():
+    """All cached access tokens, by refresh token digest.
+
+    Should be called with token_lock held.
+
+    """
+    try:
+        with open(get_token_file(), encoding='utf-8') as token_obj:
+            cache = json.load(token_obj)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    if 'refresh_token_digest' in cache:
+        # single token cached by earlier versions
+        return {cache['refresh_token_digest']: cache}
+    tokens = cache.get('tokens')
+    return tokens if isinstance(tokens, dict) else {}
+
+def read_token_cache(client):
+    """Read the cached access token for a client.
+
+    Should be called with token_lock held.
+
+    Returns
+    -------
+    (access_token, expires_at) : tuple
+        expires_at is a Unix timestamp. (None, 0) if there is no usable
+        cache for this client's refresh token.
+
+    """
+    try:
+        entry = _read_tokens()[_refresh_token_digest(client)]
+        return entry['access_token'], entry['expires_at']
+    except (KeyError, TypeError):
+        return None, 0
+
+def write_token_cache(client, access_token, expires_at):
+    """Atomically write the access token cache (mode 600).
+
+    The cache holds a token per refresh token, i.e., per profile;
+    expired tokens of other profiles are dropped.
+
+    Should be called with token_lock held.
+
+    """
+    now = time.time()
+    tokens = {digest: entry for digest, entry in _read_tokens().items()
+              if isinstance(entry, dict) and
+              entry.get('expires_at', 0) > now}
+    tokens[_refresh_token_digest(client)] = {
+        'access_token': access_token,
+        'expires_at': expires_at,
+    }
+    token_file = get_token_file()
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(token_file),
+                                    prefix='.token-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as token_obj:
+            json.dump({'tokens': tokens}, token_obj)
+        os.replace(tmp_file, token_file)
+    except OSError:
+        os.remove(tmp_file)
+        raise
+
+def load_access_token(client, stale_token=None):
+    """Set a valid access token on an authorized client.
+
+    The cached token is reused unless it expires within REFRESH_MARGIN
+    seconds, or is stale_token, in which case the token is refreshed
+    and the cache updated. The cache is locked throughout, so that
+    concurrent invocations refresh at most once.
+
+    Parameters
+    ----------
+    client : pyimgur.Imgur
+        A client with client_secret and refresh_token.
+    stale_token : str
+        An access token known to be rejected (e.g., with 401
+        Unauthorized). Default is None.
+
+    Returns
+    -------
+    access_token : str
+
+    Raises
+    ------
+    requests.RequestException
+        If the token needs to be refreshed and the refresh failed.
+
+    """
+    with token_lock():
+        access_token, expires_at = read_token_cache(client)
+        if (access_token is None or access_token == stale_token or
+                expires_at - time.time() < REFRESH_MARGIN):
+            with imgur.metrics.span('token_refresh'):
+                access_token, expires_in = _refresh_access_token(client)
+            expires_at = time.time() + expires_in
+            write_token_cache(client, access_token, expires_at)
+    client.access_token = access_token
+    _expires_at[client.refresh_token] = expires_at
+    return access_token
+
+def _refresh_access_token(client):
+    """imgur.request.refresh_access_token, retried on transient errors.
+
+    Connection errors and server errors are retried up to
+    REFRESH_ATTEMPTS times in all, with jittered exponential backoff;
+    a rejected refresh token is not.
+
+    """
+    for attempt in range(REFRESH_ATTEMPTS):
+        try:
+            return imgur.request.refresh_access_token(client)
+        except requests.RequestException as err:
+            response = getattr(err, 'response', None)
+            if (attempt == REFRESH_ATTEMPTS - 1 or
+                    (response is not None and response.status_code < 500)):
+                raise
+            cwarning("failed to refresh access token (%s); retrying" % err)
+            time.sleep(random.uniform(0, REFRESH_BACKOFF * 2 ** attempt))
+
+def ensure_access_token(client):
+    """Make sure an authorized client's access token is not about to expire.
+
+    Cheap when it is not: the expiry of the token loaded into this
+    process is remembered. Otherwise, the token is reloaded with
+    load_access_token, which takes it from the cache if another process
+    has already refreshed it. This way, workers of a long batch switch
+    to a new token before the old one expires, rather than each
+    hitting 401 Unauthorized. Anonymous clients are left alone; for an
+    imgur.profiles.Rotation, the token of every profile is checked.
+
+    """
+    if isinstance(client, imgur.profiles.Rotation):
+        for profile_client in client.clients:
+            ensure_access_token(profile_client)
+        return
+    if client.refresh_token is None or client.client_secret is None:
+        return
+    with _expires_at_lock:
+        expires_at = _expires_at.get(client.refresh_token)
+        if expires_at is None or expires_at - time.time() < REFRESH_MARGIN:
+            load_access_token(client)
+
+def call_authenticated(client, func, *args, **kwargs):
+    """Call func(*args, **kwargs) with a client's access token.
+
+    The access token is first renewed if about to expire (see
+    ensure_access_token). If Imgur still responds with 401 Unauthorized
+    and the client is authorized as a user, the access token is
+    refreshed (see load_access_token) and the call is retried once.
+
+    A token is only ever refreshed once however many workers, in
+    however many processes, find it expired or rejected: the others
+    wait for the refresh and pick up its result from the cache.
+
+    If client is an imgur.profiles.Rotation, the call goes through the
+    client of the profile it chooses, which replaces the Rotation in
+    args and kwargs as well.
+
+    """
+    if isinstance(client, imgur.profiles.Rotation):
+        return client.call(call_authenticated, client, func, *args, **kwargs)
+    ensure_access_token(client)
+    stale_token = client.access_token
+    try:
+        return func(*args, **kwargs)
+    except requests.HTTPError as err:
+        if (err.response is None or err.response.status_code != 401 or
+                stale_token is None or client.refresh_token is None):
+            raise
+    with _expires_at_lock:
+        if client.access_token == stale_token:
+            # not already replaced by another thread
+            load_access_token(client, stale_token=stale_token)
+    return func(*args, **kwargs)
+
+def profile_section(profile):
+    """Config section of a profile."""
+    if profile is None or profile == DEFAULT_PROFILE:
+        return 'oauth'
+    return PROFILE_SECTION_PREFIX + profile
+
+def get_credentials(profile=None):
     """Get credentials from conf file.
 
+    Parameters
+    ----------
+    profile : str
+        Name of the profile (see get_profiles). Default is None, i.e.,
+        the "oauth" section.
+
     Returns
     -------
     (client_id, client_secret, refresh_token) : tuple
@@ -42,13 +285,65 @@ def get_credentials():
 
     config = configparser.ConfigParser()
     config.read(get_conf_file())
-    client_id = config.get('oauth', 'client_id', fallback=None)
-    client_secret = config.get('oauth', 'client_secret', fallback=None)
-    refresh_token = config.get('oauth', 'refresh_token', fallback=None)
+    section = profile_section(profile)
+    client_id = config.get(section, 'client_id', fallback=None)
+    client_secret = config.get(section, 'client_secret', fallback=None)
+    refresh_token = config.get(section, 'refresh_token', fallback=None)
     return (client_id, client_secret, refresh_token)
 
-def gen_client(anonymous=False):
-    """Generate an authenticated OAuth client with a fresh access_token.
+def get_profiles():
+    """Get the names of the credential profiles in the conf file.
+
+    The "oauth" section is the profile DEFAULT_PROFILE; an "oauth:NAME"
+    section is the profile NAME. Sections without a client_id are
+    skipped.
+
+    Returns
+    -------
+    profiles : list
+        In the order of the conf file.
+
+    """
+    config = configparser.ConfigParser()
+    config.read(get_conf_file())
+    profiles = []
+    for section in config.sections():
+        if not config.get(section, 'client_id', fallback=None):
+            continue
+        if section == 'oauth':
+            profiles.append(DEFAULT_PROFILE)
+        elif section.startswith(PROFILE_SECTION_PREFIX):
+            profiles.append(section[len(PROFILE_SECTION_PREFIX):])
+    return profiles
+
+def _gen_profile_client(profile, anonymous):
+    """gen_client for one of several profiles, without prompting.
+
+    Returns None, with a warning, if the profile is not usable.
+
+    """
+    client_id, client_secret, refresh_token = get_credentials(profile)
+    if client_id is None:
+        cwarning("profile %s: client_id unavailable" % profile)
+        return None
+    if anonymous:
+        return pyimgur.Imgur(client_id)
+    if client_secret is None or refresh_token is None:
+        cwarning("profile %s: client_secret or refresh_token unavailable; "
+                 "run imgur-authorize --profile %s" % (profile, profile))
+        return None
+    client = pyimgur.Imgur(client_id, client_secret,
+                           refresh_token=refresh_token)
+    try:
+        load_access_token(client)
+    except requests.RequestException as err:
+        cwarning("profile %s: failed to load access token: %s" %
+                 (profile, err))
+        return None
+    return client
+
+def gen_client(anonymous=False, profiles=None):
+    """Generate an authenticated OAuth client with a valid access_token.
 
     client_id, client_secret, and refresh_token are read from either
     $XDG_CONFIG_HOME/imgur/imgur.conf or $HOME/.config/imgur/imgur.conf,
@@ -56,22 +351,49 @@ def gen_client(anonymous=False):
     present, return None; if only refresh_token is missing, call
     imgur.authorize.authorize(client_id, client_secret) to authorize and
     generate the token. The credentials are then used to initialize the
-    client.
+    client, whose access token is taken from the cache if still valid
+    (see load_access_token).
+
+    If the conf file holds several profiles (see get_profiles), or
+    several are asked for, a client is generated for each, and an
+    imgur.profiles.Rotation of them is returned, which can be used
+    wherever a client is (through call_authenticated). Profiles that
+    are not authorized are skipped with a warning.
 
     Parameters
     ----------
     anonymous : bool
         Whether to generate an anonymous client (not logged in as a
         user). Default is False.
+    profiles : list
+        Names of the profiles to use. Default is None, i.e., all of
+        them.
 
     Returns
     -------
-    client : pyimgur.Imgur
+    client : pyimgur.Imgur or imgur.profiles.Rotation
         On success. None if any step failed.
 
     """
 
-    client_id, client_secret, refresh_token = get_credentials()
+    if profiles is None:
+        profiles = get_profiles()
+    if len(profiles) > 1:
+        clients = []
+        with imgur.metrics.span('authenticate'):
+            for profile in profiles:
+                client = _gen_profile_client(profile, anonymous)
+                if client is not None:
+                    clients.append((profile, client))
+        if not clients:
+            cwarning("no usable profile")
+            return None
+        if len(clients) == 1:
+            return clients[0][1]
+        return imgur.profiles.Rotation(clients)
+
+    client_id, client_secret, refresh_token = get_credentials(
+        profiles[0] if profiles else None)
     if client_id is None or (not anonymous and client_secret is None):
         cwarning("client_id or client_secret unavailable")
         return None
@@ -91,14 +413,17 @@ def gen_client(anonymous=False):
                 sys.stderr.write("Please answer yes or no.\n")
 
         if yesno:
-            return imgur.authorize.authorize(client_id, client_secret)
+            return imgur.authorize.authorize(
+                client_id, client_secret,
+                profile=profiles[0] if profiles else None)
         else:
             return None
 
-    if anonymous:
-        client = pyimgur.Imgur(client_id)
-    else:
-        client = pyimgur.Imgur(client_id, client_secret,
-                               refresh_token=refresh_token)
-        client.refresh_access_token()
+    with imgur.metrics.span('authenticate'):
+        if anonymous:
+            client = pyimgur.Imgur(client_id)
+        else:
+            client = pyimgur.Imgur(client_id, client_secret,
+                                   refresh_token=refresh_token)
+            load_access_token(client)
     return client
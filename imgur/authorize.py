@@ -15,7 +15,7 @@ import imgur.authenticate
 
 from zmwangx.colorout import *
 
-def authorize(client_id, client_secret):
+def authorize(client_id, client_secret, profile=None):
     """Authorize with Imgur's OAuth API and get refresh token.
 
     The refresh token will be written to the config file.
@@ -24,6 +24,10 @@ def authorize(client_id, client_secret):
     ----------
     client_id : str
     client_secret : str
+    profile : str
+        Credential profile to write to (see
+        imgur.authenticate.get_profiles). Default is None, i.e., the
+        "oauth" section.
 
     Returns
     -------
@@ -56,7 +60,7 @@ def authorize(client_id, client_secret):
     conf_file = imgur.authenticate.get_conf_file()
     config = configparser.ConfigParser()
     config.read([conf_file])
-    config['oauth'] = {
+    config[imgur.authenticate.profile_section(profile)] = {
         'client_id': client_id,
         'client_secret': client_secret,
         'refresh_token': refresh_token,
@@ -74,12 +78,15 @@ def main():
     $XDG_CONFIG_HOME/imgur/imgur.conf (or
     $HOME/.config/imgur/imgur.conf), under the "oauth"
     section. Additional credentials will be written to this file
-    afterwards."""
+    afterwards. Additional profiles go in "oauth:NAME" sections, and
+    are authorized with --profile NAME."""
     parser = argparse.ArgumentParser(description=description)
-    # no arguments
-    parser.parse_args()
+    parser.add_argument('--profile', help="""credential profile to
+                        authorize; default is the "oauth" section""")
+    args = parser.parse_args()
 
-    client_id, client_secret, _ = imgur.authenticate.get_credentials()
-    if authorize(client_id, client_secret) is None:
+    client_id, client_secret, _ = imgur.authenticate.get_credentials(
+        args.profile)
+    if authorize(client_id, client_secret, profile=args.profile) is None:
         cerror("authorization failed")
         return 1
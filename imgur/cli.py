@@ -1,35 +1,111 @@
 #!/usr/bin/env python3
 
-"""Shared CLI."""
+"""Shared CLI.
+
+Only what every run needs is imported up front; imgur.authenticate,
+imgur.upload, imgur.save and imgur.dedup (and with them pyimgur and
+requests, which take most of the startup time) are loaded by
+_load_local once the run is known to upload or save in this process,
+rather than through imgur-uploadd.
+
+"""
 
 # pylint: disable=wildcard-import,unused-wildcard-import
 
 import argparse
+import collections
+import itertools
 import os
 import re
-import subprocess
 
 from zmwangx.colorout import *
 
-import imgur.authenticate
-import imgur.save
-import imgur.upload
+import imgur.daemon
+import imgur.engine
+import imgur.history
+import imgur.inputs
+import imgur.journal
+import imgur.metrics
+import imgur.progress
+import imgur.retry
+import imgur.similar
+import imgur.transform
+import imgur.validate
+
+def _count(items):
+    """Number of items for progress messages; "all" if not known yet."""
+    return len(items) if hasattr(items, '__len__') else "all"
 
-def get_log_file():
-    """Get the path to upload's log file.
+def _size(string):
+    """Parse a size in bytes, with an optional k or m suffix."""
+    multiplier = {'k': 1024, 'm': 1024 * 1024}.get(string[-1:].lower())
+    try:
+        if multiplier:
+            return int(float(string[:-1]) * multiplier)
+        return int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size '%s'" % string)
 
-    Also make sure the directory containing the log file exists.
+def _remember(items, sources):
+    """Yield items, keeping each in sources under its index."""
+    for i, item in enumerate(items):
+        sources[i] = item
+        yield item
+
+def _valid_paths(validations, stats, journal=None, history=None):
+    """Paths that passed validation; report and count the others.
+
+    Valid images are counted in stats under their types, and rejected
+    files under "rejected"; rejected files are also marked as failed in
+    the journal and recorded in the history, if any.
 
     """
+    for validation in validations:
+        if validation.reason is None:
+            stats[validation.type] += 1
+            yield validation.path
+        else:
+            stats['rejected'] += 1
+            cerror("skipping %s: %s" % (validation.path, validation.reason))
+            if journal is not None:
+                journal.finish(validation.path, None)
+            if history is not None:
+                history.add("upload", os.path.abspath(validation.path), None)
 
-    if 'XDG_DATA_HOME' in os.environ:
-        log_file = os.path.join(os.environ['XDG_DATA_HOME'],
-                                'imgur/upload.log')
+def _validation_summary(stats):
+    """Summarize the counts of _valid_paths."""
+    types = sorted(image_type for image_type in stats
+                   if image_type != 'rejected')
+    valid_count = sum(stats[image_type] for image_type in types)
+    return "%d images valid (%s), %d rejected" % (
+        valid_count,
+        ", ".join("%d %s" % (stats[image_type], image_type)
+                  for image_type in types) or "none",
+        stats['rejected'])
+
+def _load_local(action, dedup=False):
+    """Import the modules needed to upload or save in this process.
+
+    They become available as attributes of the imgur package, e.g.,
+    imgur.upload.
+
+    """
+    # pylint: disable=redefined-outer-name,unused-variable
+    import imgur.authenticate
+    if action == "upload":
+        import imgur.upload
     else:
-        log_file = os.path.expanduser('~/.local/share/imgur/upload.log')
-    if not os.path.exists(os.path.dirname(log_file)):
-        os.makedirs(os.path.dirname(log_file), mode=0o700)
-    return log_file
+        import imgur.save
+    if dedup:
+        import imgur.dedup
+
+def upload_main():
+    """Entry point of imgur-upload."""
+    return cli("upload")
+
+def save_main():
+    """Entry point of imgur-save."""
+    return cli("save")
 
 def cli(action):
     """Shared CLI interface for imgur.upload and imgur.save.
@@ -52,68 +128,421 @@ def cli(action):
         be updated so that you don't need to re-authorize in the
         future).
 
-        This script logs to $XDG_DATA_HOME/imgur/upload.log or
-        $HOME/.local/share/imgur/upload.log.
+        This script records every image in the history
+        $XDG_DATA_HOME/imgur/history.sqlite3 or
+        $HOME/.local/share/imgur/history.sqlite3; see imgur-history.
         """
     else:
         description = """Save remote images to your Imgur account. This
-        routine basically retrieves the remote images to local
-        tempfiles, and then upload them in the same way as
-        imgur-upload. See "imgur-upload -h" for more details."""
+        routine basically retrieves the remote images (into memory, or
+        local tempfiles for large images), and then upload them in the
+        same way as imgur-upload. See "imgur-upload -h" for more
+        details."""
 
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('-a', '--anonymous', action='store_true',
                         help='upload anonymously')
-    parser.add_argument('-j', '--jobs', type=int,
+    parser.add_argument('--profile', action='append', metavar='NAME',
+                        help="""credential profile to use (an "oauth:NAME"
+                        section of the config file, or "default" for
+                        "oauth"); may be repeated, and uploads are
+                        spread across the profiles in proportion to
+                        their remaining credits; default is all
+                        profiles configured""")
+    jobs_flags = ['-j', '--jobs']
+    if action == "save":
+        jobs_flags.append('--upload-jobs')
+    parser.add_argument(*jobs_flags, type=int, dest='jobs',
                         help="""Maximum number of concurrent jobs. If 0,
                         do not limit the number of jobs (not recommended
                         when uploading a large list of imagesp). By
                         default, twice the number of (virtual) CPU cores
-                        is used.""")
+                        is used with the process engine, and %d with
+                        the async engine.""" %
+                        imgur.engine.DEFAULT_ASYNC_JOBS)
+    parser.add_argument('-e', '--engine', choices=imgur.engine.ENGINES,
+                        default='process',
+                        help="""Worker engine. "process" (default) runs
+                        jobs in a pool of worker processes; "async" runs
+                        all jobs in this process on an asyncio event
+                        loop, sharing a pool of keep-alive connections,
+                        which scales to hundreds of concurrent jobs
+                        (see -j).""")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="""adapt the number of concurrent jobs to
+                        Imgur's rate limits: start from -j, grow while
+                        uploads go through and credits remain, and
+                        halve on 429 Too Many Requests""")
+    parser.add_argument('--max-jobs', type=int,
+                        help="""upper bound of concurrent jobs with
+                        --adaptive; by default, %d times -j with the
+                        async engine (the process engine never exceeds
+                        -j)""" % imgur.engine.ADAPTIVE_HEADROOM)
+    parser.add_argument('--ordered', action='store_true',
+                        help="""print and log links in the order of the
+                        input; by default they are printed as soon as
+                        each image is done""")
+    parser.add_argument('--attempts', type=int,
+                        default=imgur.retry.DEFAULT_ATTEMPTS,
+                        help="""attempts per image on transient errors
+                        (connection errors, timeouts, 5xx responses,
+                        etc.), with exponential backoff; default is
+                        %d""" % imgur.retry.DEFAULT_ATTEMPTS)
+    parser.add_argument('--connect-timeout', type=float,
+                        default=imgur.retry.CONNECT_TIMEOUT,
+                        metavar='SECONDS',
+                        help="""give up on a connection attempt after
+                        SECONDS; default is %g""" %
+                        imgur.retry.CONNECT_TIMEOUT)
+    parser.add_argument('--read-timeout', type=float,
+                        default=imgur.retry.READ_TIMEOUT, metavar='SECONDS',
+                        help="""give up on a request when the server
+                        sends nothing for SECONDS; default is %g""" %
+                        imgur.retry.READ_TIMEOUT)
+    parser.add_argument('--deadline', type=float,
+                        default=imgur.retry.DEFAULT_DEADLINE,
+                        metavar='SECONDS',
+                        help="""stop retrying an image after SECONDS in
+                        all; default is %g""" % imgur.retry.DEFAULT_DEADLINE)
+    parser.add_argument('--resume', metavar='JOURNAL',
+                        help="""keep a journal of the batch in the file
+                        JOURNAL; if JOURNAL already exists, skip the
+                        items it lists as done, and retry the ones that
+                        failed or were interrupted, in addition to any
+                        new items given on the command line""")
+    parser.add_argument('--from-file', action='append', default=[],
+                        metavar='FILE', dest='from_files',
+                        help="""read %s from FILE ("-" for stdin), one
+                        per line; may be given more than once. The list
+                        is read lazily as the batch goes, so it can be
+                        arbitrarily long; with --resume%s, though, the
+                        whole batch is read up front.""" %
+                        (("paths", ", -d or --similar") if action == "upload"
+                         else ("URLs", "")))
+    parser.add_argument('-0', '--null', action='store_true',
+                        help="""entries of --from-file are separated by
+                        NUL characters instead of newlines, e.g., as
+                        printed by find -print0""")
+    parser.add_argument('--similar', type=int, nargs='?', metavar='BITS',
+                        const=imgur.similar.DEFAULT_THRESHOLD,
+                        help="""upload only one image of each group of
+                        near-duplicates (re-encodes, resizes, etc.),
+                        whose perceptual hashes differ in at most BITS
+                        of 64 bits (default %d), and print its link
+                        for every image of the group; requires NumPy
+                        and Pillow""" % imgur.similar.DEFAULT_THRESHOLD)
+    parser.add_argument('--metrics-out', metavar='FILE',
+                        help="""write the time spent in each phase
+                        (authentication, %s, retries, rate limit
+                        waits, etc.) to FILE when done: JSON with
+                        percentiles, or, if FILE ends in .prom, a
+                        Prometheus textfile with histograms""" %
+                        ("validation, transforms, uploads"
+                         if action == "upload" else "downloads, uploads"))
+    parser.add_argument('--no-progress', action='store_true',
+                        help="""do not report progress (done, failed
+                        and in-flight images, throughput and ETA) on
+                        stderr; it is redrawn in place on a terminal,
+                        and logged every %g seconds otherwise""" %
+                        imgur.progress.LOG_INTERVAL)
     parser.add_argument('--no-https', action='store_true',
                         help="""by default returned URIs use the HTTPS
                         protocol; this option turns HTTPS off and use
                         HTTP instead""")
     if action == "upload":
-        parser.add_argument('paths', nargs='+', metavar='PATH',
-                            help='path to the image')
+        parser.add_argument('--no-validate', action='store_true',
+                            help="""do not check files before uploading;
+                            by default, files that are missing, not
+                            images, over Imgur's size limits, or with
+                            corrupt headers are reported and skipped
+                            without contacting Imgur""")
+        parser.add_argument('-d', '--dedup', action='store_true',
+                            help="""skip files whose content has been
+                            uploaded before (according to the index
+                            $XDG_DATA_HOME/imgur/index.sqlite3 or
+                            $HOME/.local/share/imgur/index.sqlite3), and
+                            print the previous links instead; identical
+                            files are also uploaded only once""")
+        parser.add_argument('--dedup-max-age', type=float, metavar='DAYS',
+                            help="""with -d, forget files not uploaded
+                            or found in the index for DAYS days; in any
+                            case, the least recently used are forgotten
+                            beyond a million""")
+        parser.add_argument('--no-daemon', action='store_true',
+                            help="""upload in this process even if
+                            imgur-uploadd is running; by default, the
+                            batch is handed to a running imgur-uploadd
+                            (unless -d, --similar or a transform is
+                            requested), which uploads with its own -j
+                            and retry options""")
+        parser.add_argument('--dir', action='append', default=[],
+                            metavar='DIR', dest='dirs',
+                            help="""upload files found under DIR,
+                            recursively; may be given more than once""")
+        parser.add_argument('--glob', action='append', metavar='PATTERN',
+                            dest='patterns',
+                            help="""with --dir, only upload files whose
+                            names match the shell-style PATTERN, e.g.,
+                            '*.png'; may be given more than once""")
+        parser.add_argument('--ext', type=lambda s: s.split(','),
+                            metavar='EXT[,EXT...]', dest='extensions',
+                            help="""with --dir, only upload files with
+                            these extensions, e.g., png,jpg""")
+        parser.add_argument('--max-dimension', type=int, metavar='PIXELS',
+                            help="""downscale images wider or taller than
+                            PIXELS before upload (requires Pillow, as do
+                            the following options)""")
+        parser.add_argument('--optimize-png', action='store_true',
+                            help="""losslessly recompress PNGs before
+                            upload""")
+        parser.add_argument('--convert', choices=imgur.transform.CONVERSIONS,
+                            help="""convert images larger than
+                            --convert-above to this format before upload
+                            (except images with transparency to
+                            JPEG)""")
+        parser.add_argument('--convert-above', type=_size, default=0,
+                            metavar='SIZE',
+                            help="""size threshold of --convert, in
+                            bytes, with an optional k or m suffix, e.g.,
+                            5m; default is 0""")
+        parser.add_argument('--quality', type=int,
+                            default=imgur.transform.DEFAULT_QUALITY,
+                            help="""JPEG or WebP quality of --convert,
+                            from 1 to 100; default is %d""" %
+                            imgur.transform.DEFAULT_QUALITY)
+        parser.add_argument('paths', nargs='*', metavar='PATH',
+                            help='path to the image; "-" reads paths '
+                            'from stdin like --from-file -')
     else:
-        parser.add_argument('source_urls', nargs='+', metavar='URL',
-                            help='source urls of images')
+        parser.add_argument('--download-jobs', type=int,
+                            help="""Maximum number of concurrent
+                            downloads, interpreted like -j. Downloads
+                            and uploads run in separate pools, joined by
+                            a bounded queue. By default, the same as
+                            -j.""")
+        parser.add_argument('--direct', action='store_true',
+                            help="""have Imgur fetch images from their
+                            source URLs directly, instead of downloading
+                            and uploading them; images Imgur refuses to
+                            fetch (e.g., from private hosts) are still
+                            downloaded and uploaded""")
+        parser.add_argument('source_urls', nargs='*', metavar='URL',
+                            help='source urls of images; "-" reads URLs '
+                            'from stdin like --from-file -')
     args = parser.parse_args()
+    items = args.paths if action == "upload" else args.source_urls
+    dirs = args.dirs if action == "upload" else []
+    from_files = args.from_files
+    if '-' in items:
+        items = [item for item in items if item != '-']
+        from_files = from_files + ['-']
+    if not items and not from_files and not dirs and not args.resume:
+        parser.error("no %s given" % ("PATH" if action == "upload" else "URL"))
+    if from_files or dirs:
+        # streamed lazily into the engine
+        items = itertools.chain(
+            items,
+            itertools.chain.from_iterable(
+                imgur.inputs.read_list(path, null=args.null)
+                for path in from_files),
+            itertools.chain.from_iterable(
+                imgur.inputs.walk(directory, patterns=args.patterns,
+                                  extensions=args.extensions)
+                for directory in dirs))
+    if action == "upload" and args.resume:
+        # journaled paths should survive a change of directory
+        items = map(os.path.abspath, items)
+    if action == "save" and args.direct and args.similar is not None:
+        parser.error("--similar cannot be used with --direct")
+    if args.resume or (action == "upload" and
+                       (args.dedup or args.similar is not None)):
+        # the journal, the dedup index and grouping of near-duplicates
+        # need the whole batch up front
+        items = list(items)
+
+    transform = None
+    if action == "upload":
+        transform = imgur.transform.Policy(
+            max_dimension=args.max_dimension, optimize_png=args.optimize_png,
+            convert=args.convert, convert_above=args.convert_above,
+            quality=args.quality)
+        if transform and not imgur.transform.is_available():
+            cfatal_error("--max-dimension, --optimize-png and --convert "
+                         "require Pillow")
+            return 1
 
-    client = imgur.authenticate.gen_client(anonymous=args.anonymous)
-    if client is None:
-        cfatal_error("failed to create client")
+    if args.attempts < 1:
+        parser.error("--attempts should be at least 1")
+    if action == "upload" and args.dedup_max_age is not None:
+        if not args.dedup:
+            parser.error("--dedup-max-age requires -d")
+        if args.dedup_max_age < 0:
+            parser.error("--dedup-max-age should not be negative")
+    retry = imgur.retry.Policy(
+        attempts=args.attempts, connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout, deadline=args.deadline)
+
+    if args.similar is not None and not imgur.similar.is_available():
+        cfatal_error("--similar requires NumPy and Pillow")
         return 1
-    log_file = get_log_file()
-    with open(log_file, 'a', encoding='utf-8') as log_obj:
-        date = subprocess.check_output('date').decode('utf-8').strip()
-        log_obj.write('# %s\n' % date)
 
+    daemon_address = None
+    if (action == "upload" and not args.no_daemon and not transform and
+            not args.dedup and args.similar is None and
+            args.profile is None):
+        daemon_address = imgur.daemon.find_daemon(anonymous=args.anonymous)
+
+    if args.metrics_out:
+        imgur.metrics.enable()
+
+    client = None
+    if daemon_address is None:
+        _load_local(action, dedup=action == "upload" and args.dedup)
+        client = imgur.authenticate.gen_client(anonymous=args.anonymous,
+                                               profiles=args.profile)
+        if client is None:
+            cfatal_error("failed to create client")
+            return 1
+    with imgur.history.History() as history:
+        journal = None
+        if args.resume:
+            journal = imgur.journal.Journal(args.resume)
+            journal.add(items)
+            items = journal.todo()
+            cprogress("journal %s: %d done, %d failed, %d interrupted, "
+                      "%d pending" %
+                      (args.resume, journal.count(imgur.journal.DONE),
+                       journal.count(imgur.journal.FAILED),
+                       journal.count(imgur.journal.IN_FLIGHT),
+                       journal.count(imgur.journal.PENDING)))
+            journal.claim(items)
+
+        validation_stats = collections.Counter()
+        if action == "upload" and not args.no_validate:
+            valid_paths = _valid_paths(
+                # transforms may bring files within the size limits
+                imgur.validate.validate_images(
+                    items, check_size=not transform), validation_stats,
+                journal=journal, history=history)
+            if isinstance(items, list):
+                # validate the whole batch before any upload starts
+                items = list(valid_paths)
+                cprogress("pre-flight check: %s" %
+                          _validation_summary(validation_stats))
+            else:
+                items = valid_paths
+
+        sources = None
+        if not isinstance(items, list):
+            # streamed items are not kept; remember the ones in flight
+            # for the history
+            sources = {}
+            items = _remember(items, sources)
+
+        if not args.no_progress and daemon_address is None:
+            # before worker pools start, so that they get the counter
+            imgur.progress.enable()
+
+        index = None
+        save_stats = collections.Counter()
+        transform_stats = collections.Counter()
         if action == "upload":
-            cprogress("uploading %d images..." % len(args.paths))
-            uploaded_uris = imgur.upload.upload_images(
-                client, args.paths, jobs=args.jobs)
+            if args.dedup:
+                index = imgur.dedup.DedupIndex()
+            via = " with imgur-uploadd" if daemon_address is not None else ""
+            cprogress("uploading %s images%s..." % (_count(items), via))
+        if daemon_address is not None:
+            # files are checked above, unless --no-validate
+            results = imgur.daemon.iter_upload_images(
+                items, address=daemon_address, ordered=args.ordered,
+                validate=False, details=True)
+        elif action == "upload":
+            results = imgur.upload.iter_upload_images(
+                client, items, jobs=args.jobs, engine=args.engine,
+                ordered=args.ordered, index=index, adaptive=args.adaptive,
+                max_jobs=args.max_jobs, transform=transform,
+                stats=transform_stats, similar=args.similar, retry=retry,
+                details=True)
         else:
-            cprogress("saving %d images..." % len(args.source_urls))
-            uploaded_uris = imgur.save.save_images(
-                client, args.source_urls, jobs=args.jobs)
+            cprogress("saving %s images..." % _count(items))
+            results = imgur.save.iter_save_images(
+                client, items, jobs=args.jobs,
+                engine=args.engine, ordered=args.ordered,
+                adaptive=args.adaptive, max_jobs=args.max_jobs,
+                download_jobs=args.download_jobs, direct=args.direct,
+                stats=save_stats, similar=args.similar, retry=retry,
+                details=True)
 
+        progress = None
+        if not args.no_progress:
+            progress = imgur.progress.Reporter(
+                total=len(items) if isinstance(items, list) else None)
+            progress.start()
         success_count = 0
         failure_count = 0
-        for uri in uploaded_uris:
-            if uri is not None:
-                if not args.no_https:
-                    uri = re.sub(r'^http://', 'https://', uri)
-                success_count += 1
-                print(uri)
-                log_obj.write('%s\n' % uri)
-            else:
-                failure_count += 1
+        try:
+            # print and record each link as soon as it arrives, so that
+            # a long batch shows progress and a crash does not lose
+            # finished links
+            for i, image in results:
+                item = items[i] if sources is None else sources.pop(i)
+                uri = image['link'] if image is not None else None
+                if journal is not None:
+                    journal.finish(item, uri)
+                if uri is not None:
+                    if not args.no_https:
+                        uri = re.sub(r'^http://', 'https://', uri)
+                        image = dict(image, link=uri)
+                    success_count += 1
+                    if progress is not None:
+                        progress.print(uri)
+                    else:
+                        print(uri, flush=True)
+                else:
+                    failure_count += 1
+                if progress is not None:
+                    progress.update(succeeded=uri is not None,
+                                    size=image and image.get('bytes'))
+                history.add(action, os.path.abspath(item)
+                            if action == "upload" else item, image)
+        except imgur.daemon.DaemonError as err:
+            cfatal_error(str(err))
+            return 1
+        finally:
+            if progress is not None:
+                progress.close()
+            if index is not None:
+                index.evict(max_age=args.dedup_max_age * 86400
+                            if args.dedup_max_age is not None else None)
+                index.close()
+            if journal is not None:
+                journal.close()
 
+    failure_count += validation_stats['rejected']
+    if validation_stats and not isinstance(items, list):
+        cprogress("pre-flight check: %s" %
+                  _validation_summary(validation_stats))
+    if transform_stats:
+        cprogress("transformed %d images in %.1fs: %s -> %s, saved %s" % (
+            transform_stats['transformed'],
+            transform_stats['transform_seconds'],
+            imgur.validate.human_size(transform_stats['original_bytes']),
+            imgur.validate.human_size(transform_stats['bytes']),
+            imgur.validate.human_size(transform_stats['original_bytes'] -
+                                      transform_stats['bytes'])))
+    if action == "save" and args.similar is not None:
+        cprogress("%d images linked to near-duplicates instead of uploaded" %
+                  save_stats[imgur.save.NEAR_DUPLICATE])
+    if action == "save" and args.direct:
+        cprogress("%d images fetched by Imgur directly, "
+                  "%d downloaded and uploaded" %
+                  (save_stats[imgur.save.DIRECT],
+                   save_stats[imgur.save.FALLBACK]))
     cprogress("successfully %s %d images, failed on %d images" %
               ("uploaded" if action == "upload" else "saved",
                success_count, failure_count))
+    if args.metrics_out:
+        imgur.metrics.write(args.metrics_out, counts={
+            'succeeded': success_count, 'failed': failure_count})
 
     return 1 if failure_count > 0 else 0
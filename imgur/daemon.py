@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+
+"""Long-running upload daemon, and its thin client.
+
+imgur-uploadd keeps what every imgur-upload run would otherwise set up
+from scratch: an authenticated client with a fresh access token, a
+warm pool of keep-alive connections, and a pool of worker threads. It
+serves a small HTTP API on a Unix socket (by default) or a localhost
+TCP port:
+
+* GET /status: a JSON object with the daemon's pid, whether it uploads
+  anonymously, its number of jobs, the number of images uploaded and
+  failed so far, and with several credential profiles, the accounting
+  of each (see imgur.profiles.Rotation.stats);
+* POST /upload: a JSON object {"paths": [...], "validate": true}; the
+  response is one JSON object per line, {"index": ..., "link": ...,
+  "deletehash": ..., "error": ..., "attempts": ..., "bytes": ...,
+  "seconds": ...}, written as each image finishes.
+
+Paths are opened by the daemon, so they should be absolute. Jobs of
+concurrent requests share the daemon's worker threads.
+
+POST /upload must be sent with Content-Type: application/json, and on
+a TCP port, every request must name the daemon's own address in its
+Host header (127.0.0.1:PORT or localhost:PORT); other requests are
+refused with 415 and 403. A web page can then neither make the daemon
+upload local files with a cross-origin form or text/plain POST, nor
+reach it through DNS rebinding. A Unix socket is out of reach of
+browsers anyway.
+
+imgur-upload hands its batch to the daemon listening at get_address(),
+if any, instead of uploading itself (see find_daemon and
+iter_upload_images).
+
+"""
+
+# pylint: disable=wildcard-import,unused-wildcard-import
+
+import argparse
+import collections
+import http.client
+import http.server
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+from zmwangx.colorout import *
+
+# concurrent.futures, imgur.authenticate and imgur.request, and with
+# them pyimgur and requests, are imported by the daemon side only, so
+# that imgur-upload starts fast when it hands its images over
+import imgur.engine
+import imgur.profiles
+import imgur.retry
+import imgur.validate
+
+# seconds to wait for the daemon to answer GET /status
+STATUS_TIMEOUT = 1.0
+
+class DaemonError(Exception):
+    """The daemon could not be reached, or rejected a request."""
+
+def get_socket_file():
+    """Get the default path to the daemon's Unix socket.
+
+    The socket is uploadd.sock under $XDG_RUNTIME_DIR/imgur, or if the
+    environment variable XDG_RUNTIME_DIR is not defined, under
+    ~/.local/share/imgur. Also make sure the directory containing the
+    socket exists, accessible to the user only, since the daemon
+    uploads with the user's credentials.
+
+    """
+    if 'XDG_RUNTIME_DIR' in os.environ:
+        socket_file = os.path.join(os.environ['XDG_RUNTIME_DIR'],
+                                   'imgur/uploadd.sock')
+    else:
+        socket_file = os.path.expanduser('~/.local/share/imgur/uploadd.sock')
+    if not os.path.exists(os.path.dirname(socket_file)):
+        os.makedirs(os.path.dirname(socket_file), mode=0o700)
+    return socket_file
+
+def get_address():
+    """Get the address of the daemon.
+
+    The environment variable IMGUR_UPLOADD, if set, overrides the
+    default get_socket_file(); it is either the path to a Unix socket,
+    or a URL http://127.0.0.1:PORT.
+
+    """
+    return os.environ.get('IMGUR_UPLOADD') or get_socket_file()
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over a Unix socket."""
+
+    def __init__(self, socket_file, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_file = socket_file
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_file)
+
+def _connect(address, timeout):
+    """Open an HTTP connection to the daemon at address."""
+    if address.startswith('http://'):
+        netloc = urllib.parse.urlsplit(address).netloc
+        return http.client.HTTPConnection(netloc, timeout=timeout)
+    return _UnixHTTPConnection(address, timeout=timeout)
+
+def get_status(address=None):
+    """Ask the daemon for its status.
+
+    Parameters
+    ----------
+    address : str
+        See get_address, which is the default.
+
+    Returns
+    -------
+    status : dict
+        See GET /status in the module docstring. None if no daemon is
+        listening at address.
+
+    """
+    address = address or get_address()
+    if not address.startswith('http://') and not os.path.exists(address):
+        return None
+    connection = _connect(address, STATUS_TIMEOUT)
+    try:
+        connection.request('GET', '/status')
+        response = connection.getresponse()
+        if response.status != 200:
+            return None
+        return json.loads(response.read().decode('utf-8'))
+    except (OSError, ValueError, http.client.HTTPException):
+        return None
+    finally:
+        connection.close()
+
+def find_daemon(anonymous=False):
+    """Find a running daemon uploading as requested.
+
+    Parameters
+    ----------
+    anonymous : bool
+        Whether the daemon should upload anonymously. Default is False.
+
+    Returns
+    -------
+    address : str
+        Address of the daemon, or None if there is no such daemon.
+
+    """
+    address = get_address()
+    status = get_status(address)
+    if status is None or status.get('anonymous') != anonymous:
+        return None
+    return address
+
+def iter_upload_images(paths, address=None, ordered=False, validate=True,
+                       details=False):
+    """Upload images with the daemon, yielding URIs as they come.
+
+    This has the same interface as imgur.upload.iter_upload_images,
+    except that the daemon decides on jobs, engine and retries; paths
+    are read up front and sent in a single request.
+
+    Parameters
+    ----------
+    paths : iterable
+    address : str
+        See get_address, which is the default.
+    ordered : bool
+        Whether to yield in the order of paths rather than in order of
+        completion. Default is False.
+    validate : bool
+        Whether the daemon should check files before uploading (see
+        imgur.validate.validate_image). Default is True.
+    details : bool
+        If True, yield image data (see imgur.upload.upload_image)
+        instead of URIs. Default is False.
+
+    Yields
+    ------
+    (index, uri) : tuple
+        uri is the URI of the uploaded paths[index], or None if failed.
+
+    Raises
+    ------
+    DaemonError
+        If the daemon could not be reached, or rejected the batch.
+
+    """
+    paths = [os.path.abspath(path) for path in paths]
+    results = _iter_results(paths, address or get_address(), validate,
+                            details)
+    if ordered:
+        results = imgur.engine.reorder(results)
+    return results
+
+def _iter_results(paths, address, validate, details):
+    """POST /upload, and yield (index, uri) pairs in completion order."""
+    body = json.dumps({'paths': paths, 'validate': validate}).encode('utf-8')
+    # the daemon answers right away, before uploading anything
+    connection = _connect(address, imgur.retry.DEFAULT_DEADLINE)
+    try:
+        try:
+            connection.request('POST', '/upload', body=body, headers={
+                'Content-Type': 'application/json'})
+            sock = connection.sock
+            response = connection.getresponse()
+            # then results may be far apart while images wait their
+            # turn; the daemon holds each to its own deadline, so the
+            # stream needs none
+            sock.settimeout(None)
+        except (OSError, http.client.HTTPException) as err:
+            raise DaemonError("cannot reach imgur-uploadd at %s: %s" %
+                              (address, err))
+        if response.status != 200:
+            raise DaemonError("imgur-uploadd rejected the batch: %d %s" %
+                              (response.status, response.reason))
+        finished = 0
+        try:
+            for line in response:
+                record = json.loads(line.decode('utf-8'))
+                path = paths[record['index']]
+                attempts_note = imgur.retry.attempts_note(record['attempts'])
+                if record['link'] is None:
+                    cerror("failed to upload %s%s: %s" %
+                           (path, attempts_note, record['error']))
+                elif record['attempts'] > 1:
+                    cprogress("%s: uploaded%s" % (path, attempts_note))
+                finished += 1
+                if details and record['link'] is not None:
+                    yield record['index'], {
+                        key: record[key] for key in
+                        ('link', 'deletehash', 'bytes', 'seconds',
+                         'attempts')}
+                else:
+                    yield record['index'], record['link']
+        except (OSError, http.client.HTTPException, ValueError,
+                KeyError) as err:
+            raise DaemonError("lost imgur-uploadd after %d of %d images: %s"
+                              % (finished, len(paths), err))
+        if finished < len(paths):
+            raise DaemonError("imgur-uploadd hung up after %d of %d images" %
+                              (finished, len(paths)))
+    finally:
+        connection.close()
+
+class UploadDaemon(object):
+    """State shared by all requests to the daemon."""
+
+    def __init__(self, client, anonymous=False, jobs=None, retry=None):
+        """Init.
+
+        Parameters
+        ----------
+        client : pyimgur.Imgur
+        anonymous : bool
+            Whether client is anonymous. Default is False.
+        jobs : int
+            Number of worker threads. If None,
+            imgur.engine.DEFAULT_ASYNC_JOBS is used.
+        retry : imgur.retry.Policy
+            Retries and timeouts of each upload. If None, the defaults
+            of imgur.retry.Policy are used. Default is None.
+
+        """
+        import concurrent.futures
+        import imgur.authenticate
+        import imgur.request
+
+        self.client = client
+        self.anonymous = anonymous
+        self.jobs = jobs or imgur.engine.DEFAULT_ASYNC_JOBS
+        self.retry = retry or imgur.retry.Policy()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        self.started = time.time()
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        imgur.request.get_session(pool_size=self.jobs)
+        # load the access token now rather than on the first upload
+        imgur.authenticate.ensure_access_token(client)
+
+    def upload(self, path, validate=True):
+        """Upload an image.
+
+        Returns
+        -------
+        record : dict
+            With keys "link" and "deletehash" (None if failed), "error"
+            (None if succeeded), "attempts", "bytes" and "seconds".
+
+        """
+        import imgur.authenticate
+        import imgur.request
+
+        record = {'link': None, 'deletehash': None, 'error': None,
+                  'attempts': 1, 'bytes': None, 'seconds': None}
+        start = time.perf_counter()
+        if validate:
+            reason = imgur.validate.validate_image(path).reason
+            if reason is not None:
+                record['error'] = reason
+        if record['error'] is None:
+            try:
+                image, record['attempts'] = self.retry.run(
+                    imgur.authenticate.call_authenticated, self.client,
+                    imgur.request.upload_image, self.client, path=path,
+                    title=os.path.basename(path))
+                record['link'] = image['link']
+                record['deletehash'] = image.get('deletehash')
+                record['bytes'] = os.path.getsize(path)
+            # pylint: disable=broad-except
+            except Exception as err:
+                record['error'] = str(err)
+                record['attempts'] = getattr(err, 'attempts', 1)
+        record['seconds'] = time.perf_counter() - start
+        with self.lock:
+            self.stats['failed' if record['link'] is None else 'uploaded'] += 1
+        return record
+
+    def status(self):
+        """Status served by GET /status."""
+        with self.lock:
+            status = {
+                'pid': os.getpid(),
+                'anonymous': self.anonymous,
+                'jobs': self.jobs,
+                'uptime': time.time() - self.started,
+                'uploaded': self.stats['uploaded'],
+                'failed': self.stats['failed'],
+            }
+        if isinstance(self.client, imgur.profiles.Rotation):
+            status['profiles'] = self.client.stats()
+        return status
+
+    def close(self):
+        """Stop the worker threads, abandoning queued uploads."""
+        self.executor.shutdown(wait=False)
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Request handler of the daemon's HTTP API."""
+
+    protocol_version = 'HTTP/1.0'
+
+    def check_host(self):
+        """Refuse a request from another origin; return whether it may
+        go on (see the module docstring)."""
+        allowed_hosts = getattr(self.server, 'allowed_hosts', None)
+        if allowed_hosts is None or self.headers['Host'] in allowed_hosts:
+            return True
+        self.send_error(403)
+        return False
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve GET /status."""
+        if not self.check_host():
+            return
+        if self.path != '/status':
+            self.send_error(404)
+            return
+        self.reply(200, self.server.uploadd.status())
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Serve POST /upload."""
+        if not self.check_host():
+            return
+        if self.path != '/upload':
+            self.send_error(404)
+            return
+        if self.headers.get_content_type() != 'application/json':
+            self.send_error(415)
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+            batch = json.loads(self.rfile.read(length).decode('utf-8'))
+            paths = batch['paths']
+            validate = batch.get('validate', True)
+            # a path that is not a string may be taken for a file
+            # descriptor of the daemon's own by open
+            if not (isinstance(paths, list) and
+                    all(isinstance(path, str) for path in paths) and
+                    isinstance(validate, bool)):
+                raise TypeError("malformed batch")
+        except (TypeError, ValueError, KeyError):
+            self.send_error(400)
+            return
+        import concurrent.futures
+
+        uploadd = self.server.uploadd
+        futures = {uploadd.executor.submit(uploadd.upload, path, validate): i
+                   for i, path in enumerate(paths)}
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                record = dict(future.result(), index=futures[future])
+                self.wfile.write(json.dumps(record).encode('utf-8') + b'\n')
+                self.wfile.flush()
+        except OSError:
+            # the client went away; drop the rest of its batch
+            for future in futures:
+                future.cancel()
+
+    def reply(self, status, body):
+        """Send a JSON response."""
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def make_server(uploadd, address):
+    """Create a server of the daemon's HTTP API.
+
+    Parameters
+    ----------
+    uploadd : UploadDaemon
+    address : str
+        Path to a Unix socket, or a URL http://127.0.0.1:PORT; port 0
+        picks a free port.
+
+    Returns
+    -------
+    server : socketserver.BaseServer
+        Not serving yet; call serve_forever.
+
+    """
+    if address.startswith('http://'):
+        port = urllib.parse.urlsplit(address).port
+        server = _TCPServer(('127.0.0.1', 80 if port is None else port),
+                            _Handler)
+        port = server.server_address[1]
+        server.allowed_hosts = {'127.0.0.1:%d' % port,
+                                'localhost:%d' % port}
+    else:
+        server = _UnixServer(address, _Handler)
+    server.uploadd = uploadd
+    return server
+
+def main():
+    """CLI interface of imgur-uploadd."""
+    import imgur.authenticate
+
+    parser = argparse.ArgumentParser(
+        description="""Keep an authenticated client, a pool of keep-alive
+        connections and worker threads ready, and upload images sent by
+        imgur-upload (or any HTTP client) over a Unix socket or a
+        localhost port.""")
+    parser.add_argument('-a', '--anonymous', action='store_true',
+                        help='upload anonymously')
+    parser.add_argument('--profile', action='append', metavar='NAME',
+                        help="""credential profile to use; may be
+                        repeated; default is all profiles configured
+                        (see imgur-upload)""")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="""number of concurrent uploads, shared by
+                        all requests; default is %d""" %
+                        imgur.engine.DEFAULT_ASYNC_JOBS)
+    listen = parser.add_mutually_exclusive_group()
+    listen.add_argument('--socket', metavar='PATH',
+                        help="""listen on the Unix socket PATH; default
+                        is $IMGUR_UPLOADD, or uploadd.sock in
+                        $XDG_RUNTIME_DIR/imgur or
+                        ~/.local/share/imgur""")
+    listen.add_argument('--port', type=int,
+                        help="""listen on 127.0.0.1:PORT instead of a
+                        Unix socket; note that any local user may then
+                        upload with your credentials""")
+    args = parser.parse_args()
+
+    if args.port is not None:
+        address = 'http://127.0.0.1:%d' % args.port
+    else:
+        address = args.socket or get_address()
+    if get_status(address) is not None:
+        cfatal_error("imgur-uploadd is already running at %s" % address)
+        return 1
+    if not address.startswith('http://') and os.path.exists(address):
+        # left behind by a daemon that was killed
+        os.remove(address)
+
+    client = imgur.authenticate.gen_client(anonymous=args.anonymous,
+                                           profiles=args.profile)
+    if client is None:
+        cfatal_error("failed to create client")
+        return 1
+    uploadd = UploadDaemon(client, anonymous=args.anonymous, jobs=args.jobs)
+    server = make_server(uploadd, address)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    cprogress("imgur-uploadd listening at %s" % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        uploadd.close()
+        if not address.startswith('http://'):
+            os.remove(address)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
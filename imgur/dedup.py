@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""Content-addressed index of uploaded images.
+
+The index maps the SHA-256 digest of an image file to the link and
+deletehash Imgur returned for it, so that a file already uploaded is
+never uploaded again. It is an SQLite database at
+$XDG_DATA_HOME/imgur/index.sqlite3 or
+$HOME/.local/share/imgur/index.sqlite3.
+
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+import time
+
+import imgur.metrics
+
+# read files in chunks of this size while hashing; hashlib releases the
+# GIL on large updates, so hashing in threads runs in parallel
+CHUNK_SIZE = 1024 * 1024
+
+# least recently used entries beyond this count are evicted
+DEFAULT_MAX_ENTRIES = 1000000
+
+def get_index_file():
+    """Get the path to the dedup index.
+
+    Also make sure the directory containing the index exists.
+
+    """
+
+    if 'XDG_DATA_HOME' in os.environ:
+        index_file = os.path.join(os.environ['XDG_DATA_HOME'],
+                                  'imgur/index.sqlite3')
+    else:
+        index_file = os.path.expanduser('~/.local/share/imgur/index.sqlite3')
+    if not os.path.exists(os.path.dirname(index_file)):
+        os.makedirs(os.path.dirname(index_file), mode=0o700)
+    return index_file
+
+def hash_file(path):
+    """Compute the SHA-256 hex digest of a file, reading in chunks.
+
+    Returns
+    -------
+    digest : str
+        Hex digest, or None if the file cannot be read.
+
+    """
+    sha256 = hashlib.sha256()
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with imgur.metrics.span('hash'):
+        try:
+            with open(path, 'rb', buffering=0) as fileobj:
+                while True:
+                    size = fileobj.readinto(buf)
+                    if not size:
+                        break
+                    sha256.update(view[:size])
+        except OSError:
+            return None
+    return sha256.hexdigest()
+
+def hash_files(paths, jobs=None):
+    """Hash files in parallel.
+
+    Parameters
+    ----------
+    paths : list
+    jobs : int
+        Number of hashing threads. If None, os.cpu_count()
+        is used.
+
+    Returns
+    -------
+    digests : list
+        Hex digests in the order of paths; None for unreadable files.
+
+    """
+    jobs = jobs or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        return list(executor.map(hash_file, paths))
+
+class DedupIndex(object):
+    """Persistent map from content digest to (link, deletehash).
+
+    Can be used as a context manager, which closes the index on exit.
+
+    """
+
+    def __init__(self, index_file=None):
+        """Open (and create if necessary) the index.
+
+        Parameters
+        ----------
+        index_file : str
+            Path to the database. If None, get_index_file() is used.
+
+        """
+        self.index_file = index_file or get_index_file()
+        self.connection = sqlite3.connect(self.index_file, timeout=30)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                'digest TEXT PRIMARY KEY, '
+                'link TEXT NOT NULL, '
+                'deletehash TEXT, '
+                'created REAL NOT NULL, '
+                'accessed REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS images_accessed '
+                'ON images (accessed)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def lookup(self, digest):
+        """Look up a digest, marking the entry as recently used.
+
+        Returns
+        -------
+        (link, deletehash) : tuple
+            Or None if the digest is not indexed.
+
+        """
+        row = self.connection.execute(
+            'SELECT link, deletehash FROM images WHERE digest = ?',
+            (digest,)).fetchone()
+        if row is not None:
+            with self.connection:
+                self.connection.execute(
+                    'UPDATE images SET accessed = ? WHERE digest = ?',
+                    (time.time(), digest))
+        return row
+
+    def add(self, digest, link, deletehash=None):
+        """Record an uploaded image."""
+        now = time.time()
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)',
+                (digest, link, deletehash, now, now))
+
+    def evict(self, max_entries=DEFAULT_MAX_ENTRIES, max_age=None):
+        """Evict old entries.
+
+        Parameters
+        ----------
+        max_entries : int
+            Keep at most this many entries, evicting the least recently
+            used ones. None means no limit.
+        max_age : float
+            Evict entries not used for this many seconds. None means no
+            limit.
+
+        Returns
+        -------
+        evicted : int
+            Number of evicted entries.
+
+        """
+        evicted = 0
+        with self.connection:
+            if max_age is not None:
+                evicted += self.connection.execute(
+                    'DELETE FROM images WHERE accessed < ?',
+                    (time.time() - max_age,)).rowcount
+            if max_entries is not None:
+                evicted += self.connection.execute(
+                    'DELETE FROM images WHERE digest IN ('
+                    'SELECT digest FROM images ORDER BY accessed DESC '
+                    'LIMIT -1 OFFSET ?)', (max_entries,)).rowcount
+        return evicted
+
+    def close(self):
+        """Close the database connection."""
+        self.connection.close()
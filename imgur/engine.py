@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+
+"""Worker engines shared by imgur.upload and imgur.save.
+
+Two engines are available:
+
+* "process": a multiprocessing.Pool, one pickled copy of the job per
+  worker process;
+* "async": an asyncio event loop in the current process, with a
+  bounded number of jobs in flight. Blocking HTTP calls run on a
+  thread pool of the same size and share imgur.request's keep-alive
+  connection pool, so memory and process count stay flat however
+  many jobs are allowed.
+
+A batch of a single item runs inline instead, in the calling thread,
+without starting either.
+
+asyncio and multiprocessing (and with the async engine, requests) are
+only imported once a runner needs them, so that short runs start fast.
+
+"""
+
+import collections
+import functools
+import os
+import queue
+import sys
+import threading
+import time
+
+import imgur.metrics
+import imgur.progress
+import imgur.ratelimit
+
+ENGINES = ('process', 'async')
+
+# the async engine is network-bound only, so it can afford many more
+# jobs than there are CPU cores
+DEFAULT_ASYNC_JOBS = 32
+
+# in ordered mode, how many windows of results may be buffered while
+# waiting for a slow item
+REORDER_FACTOR = 4
+
+# in adaptive mode, the async engine may grow up to this many times the
+# initial number of jobs
+ADAPTIVE_HEADROOM = 4
+
+def get_pool_size(jobs, count, engine="process"):
+    """Get the number of workers to use.
+
+    Parameters
+    ----------
+    jobs : int
+        Requested number of workers. If None, a default depending on
+        the engine is used (os.cpu_count() * 2 for
+        "process", DEFAULT_ASYNC_JOBS for "async"). If 0, count is
+        used.
+    count : int
+        Number of items to be processed, or None if unknown (in which
+        case jobs=0 means the default).
+    engine : {"process", "async"}
+
+    Returns
+    -------
+    pool_size : int
+
+    """
+    if jobs is None or (jobs == 0 and count is None):
+        if engine == "async":
+            jobs = DEFAULT_ASYNC_JOBS
+        else:
+            jobs = (os.cpu_count() or 1) * 2
+        if count is not None:
+            jobs = min(jobs, count)
+    elif jobs == 0:
+        jobs = count
+    return max(jobs, 1)
+
+class ProcessRunner(object):
+    """Run jobs in a multiprocessing.Pool.
+
+    A runner accepts jobs with submit(), and hands back finished ones
+    with wait().
+
+    """
+
+    def __init__(self, func, pool_size):
+        """Init with a one-argument func and a pool size."""
+        import multiprocessing
+
+        self.func = func
+        # workers report transfers in flight to imgur.progress
+        self.pool = multiprocessing.Pool(
+            processes=pool_size, initializer=imgur.progress.attach,
+            initargs=(imgur.progress.get_counters(),))
+        self.finished = queue.Queue()
+
+    def submit(self, index, item):
+        """Start func(item), labeled with index."""
+        self.pool.apply_async(
+            self.func, (item,),
+            callback=functools.partial(self._finish, index),
+            error_callback=functools.partial(self._fail, index))
+
+    def _finish(self, index, result):
+        """Callback for a successful job."""
+        self.finished.put((index, result, None))
+
+    def _fail(self, index, exception):
+        """Callback for a job that raised."""
+        self.finished.put((index, None, exception))
+
+    def wait(self):
+        """Block until at least one job finishes.
+
+        Returns
+        -------
+        finished : list
+            List of (index, result) pairs.
+
+        Raises
+        ------
+        Exception
+            Whatever exception func raised.
+
+        """
+        finished = [self.finished.get()]
+        while True:
+            try:
+                finished.append(self.finished.get_nowait())
+            except queue.Empty:
+                break
+        for _, _, exception in finished:
+            if exception is not None:
+                raise exception
+        return [(index, result) for index, result, _ in finished]
+
+    def close(self, abort=False):
+        """Shut down the pool; with abort, do not wait for jobs."""
+        if abort:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+class AsyncRunner(object):
+    """Run jobs on an asyncio event loop.
+
+    func is called on a thread pool of pool_size threads, and all
+    threads share imgur.request's connection pool.
+
+    """
+
+    def __init__(self, func, pool_size):
+        """Init with a one-argument func and a pool size."""
+        import asyncio
+        import concurrent.futures
+
+        self.func = func
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(pool_size)
+        self.pending = {}
+        # jobs making HTTP requests have imported imgur.request; others
+        # (e.g., validation) do not need requests loaded
+        request = sys.modules.get('imgur.request')
+        if request is not None:
+            request.get_session(pool_size=pool_size)
+
+    def submit(self, index, item):
+        """Start func(item), labeled with index."""
+        future = self.loop.run_in_executor(self.executor, self.func, item)
+        self.pending[future] = index
+
+    def wait(self):
+        """Block until at least one job finishes.
+
+        See ProcessRunner.wait.
+
+        """
+        import asyncio
+
+        done, _ = self.loop.run_until_complete(asyncio.wait(
+            set(self.pending), return_when=asyncio.FIRST_COMPLETED))
+        return [(self.pending.pop(future), future.result())
+                for future in done]
+
+    def close(self, abort=False):
+        """Shut down the thread pool and the event loop."""
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown(wait=not abort)
+        self.loop.close()
+
+class InlineRunner(object):
+    """Run jobs in the calling thread, one at a time, on wait().
+
+    Used for batches of a single item, which gain nothing from a pool
+    and would only wait for it to start.
+
+    """
+
+    def __init__(self, func, _pool_size):
+        """Init with a one-argument func."""
+        self.func = func
+        self.pending = collections.deque()
+
+    def submit(self, index, item):
+        """Queue func(item), labeled with index."""
+        self.pending.append((index, item))
+
+    def wait(self):
+        """Run the oldest queued job. See ProcessRunner.wait."""
+        index, item = self.pending.popleft()
+        return [(index, self.func(item))]
+
+    def close(self, abort=False):
+        """Forget queued jobs."""
+        # pylint: disable=unused-argument
+        self.pending.clear()
+
+RUNNERS = {
+    'process': ProcessRunner,
+    'async': AsyncRunner,
+}
+
+def imap(func, items, jobs=None, engine="process", ordered=False,
+         adaptive=False, max_jobs=None, count=None):
+    """Map func over items, yielding results as soon as they are ready.
+
+    Only a bounded number of items are submitted ahead of the results
+    consumed, so results can be printed and logged as they arrive
+    without holding the whole batch in memory.
+
+    Parameters
+    ----------
+    func : callable
+        A one-argument callable; must be picklable for the "process"
+        engine.
+    items : iterable
+        Consumed lazily.
+    jobs : int
+        Number of workers (see get_pool_size).
+    engine : {"process", "async"}
+        Default is "process".
+    ordered : bool
+        If False (default), results are yielded in completion order.
+        If True, they are yielded in input order, using a reorder
+        buffer of at most REORDER_FACTOR times the number of jobs in
+        flight; a slow item then holds back submission of new items
+        rather than letting the buffer grow.
+    adaptive : bool
+        If True, the number of jobs in flight starts at jobs and is
+        adjusted by an imgur.ratelimit.AdaptiveLimiter according to the
+        rate-limit headers and 429 responses the jobs see. Default is
+        False.
+    max_jobs : int
+        Upper bound of the adaptive number of jobs in flight. If None,
+        ADAPTIVE_HEADROOM times jobs is used for the "async" engine;
+        the "process" engine never exceeds its pool size.
+    count : int
+        Number of items, if items has no len(); used to avoid starting
+        more workers than there are items, and to run a single item
+        inline (see InlineRunner). Default is None.
+
+    If imgur.metrics is enabled, spans timed in jobs are brought back
+    and recorded here, along with the "job" time and the "latency" of
+    each item.
+
+    Yields
+    ------
+    (index, result) : tuple
+        result is func applied to the index-th item.
+
+    """
+    # pylint: disable=too-many-arguments,too-many-locals,too-many-branches
+    # pylint: disable=too-many-statements
+    if engine not in RUNNERS:
+        raise ValueError("unknown engine '%s'" % engine)
+    if count is None and hasattr(items, '__len__'):
+        count = len(items)
+    pool_size = get_pool_size(jobs, count, engine=engine)
+    # keep a process pool's task queue fed while results are collected;
+    # the async engine's window is exactly the in-flight limit
+    window = pool_size * 2 if engine == "process" else pool_size
+    limiter = None
+    if adaptive:
+        if engine == "async":
+            maximum = max_jobs or pool_size * ADAPTIVE_HEADROOM
+            # threads for the highest concurrency the limiter may allow
+            pool_size = window = maximum
+        else:
+            maximum = pool_size
+        limiter = imgur.ratelimit.AdaptiveLimiter(
+            initial=get_pool_size(jobs, count, engine=engine),
+            maximum=maximum)
+        func = imgur.ratelimit.Observed(func)
+    measured = imgur.metrics.is_enabled()
+    if measured:
+        func = imgur.metrics.Measured(func)
+        submitted_at = {}  # index => time of submission
+    lookahead = window * REORDER_FACTOR
+
+    runner = (InlineRunner if count is not None and count <= 1 else
+              RUNNERS[engine])(func, pool_size)
+    item_iter = iter(items)
+    exhausted = False
+    submitted = 0
+    in_flight = 0
+    next_index = 0  # next index to yield in ordered mode
+    reorder_buffer = {}
+    abort = True
+    try:
+        while True:
+            if limiter is not None:
+                window = limiter.allowed
+                delay = limiter.delay()
+                if delay > 0 and in_flight == 0:
+                    with imgur.metrics.span('rate_limit_wait'):
+                        time.sleep(delay)
+                    continue
+                if delay > 0:
+                    window = 0  # finish what is in flight first
+            while (not exhausted and in_flight < window and
+                   (not ordered or submitted - next_index < lookahead)):
+                try:
+                    item = next(item_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if measured:
+                    submitted_at[submitted] = time.perf_counter()
+                runner.submit(submitted, item)
+                submitted += 1
+                in_flight += 1
+            if in_flight == 0:
+                break
+            for index, result in runner.wait():
+                in_flight -= 1
+                if measured:
+                    result, spans = result
+                    imgur.metrics.merge(spans)
+                    imgur.metrics.record('latency', time.perf_counter() -
+                                         submitted_at.pop(index))
+                if limiter is not None:
+                    result, observation = result
+                    limiter.update(observation)
+                if ordered:
+                    reorder_buffer[index] = result
+                else:
+                    yield index, result
+            while next_index in reorder_buffer:
+                yield next_index, reorder_buffer.pop(next_index)
+                next_index += 1
+        abort = False
+    finally:
+        runner.close(abort=abort)
+
+_END = object()
+
+def pipe(iterable, maxsize):
+    """Run an iterable in a background thread, through a bounded queue.
+
+    This joins two stages of a pipeline: the producing stage keeps
+    going while the consuming stage is busy, until maxsize results are
+    waiting. Closing the returned generator stops and closes the
+    producer.
+
+    Parameters
+    ----------
+    iterable : iterable
+    maxsize : int
+
+    Yields
+    ------
+    item
+        Items of iterable, in order. An exception raised by iterable is
+        re-raised here.
+
+    """
+    buffer = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(entry):
+        """Put an entry in the buffer unless stopped; return success."""
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        """Body of the producer thread."""
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    break
+            else:
+                put((_END, None))
+        except Exception as exc:  # pylint: disable=broad-except
+            put((_END, exc))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, exc = buffer.get()
+            if exc is not None:
+                raise exc
+            if item is _END:
+                break
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+def reorder(pairs):
+    """Put (index, result) pairs back in order of index.
+
+    For stages that yield out of order even when fed in order. Indices
+    should be 0, 1, 2, ... in some order; results are buffered until
+    all earlier ones have come.
+
+    Yields
+    ------
+    (index, result) : tuple
+
+    """
+    buffer = {}
+    next_index = 0
+    for index, result in pairs:
+        buffer[index] = result
+        while next_index in buffer:
+            yield next_index, buffer.pop(next_index)
+            next_index += 1
+
+def map_jobs(func, items, jobs=None, engine="process", adaptive=False,
+             max_jobs=None):
+    """Map func over items with the chosen engine.
+
+    Parameters
+    ----------
+    func : callable
+        A one-argument callable; must be picklable for the "process"
+        engine.
+    items : list
+    jobs : int
+        Number of workers (see get_pool_size).
+    engine : {"process", "async"}
+        Default is "process".
+    adaptive : bool
+    max_jobs : int
+        See imap.
+
+    Returns
+    -------
+    results : list
+        func(item) for each item, in order.
+
+    """
+    results = [None] * len(items)
+    for index, result in imap(func, items, jobs=jobs, engine=engine,
+                              adaptive=adaptive, max_jobs=max_jobs):
+        results[index] = result
+    return results
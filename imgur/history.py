@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+"""Structured history of uploads and saves.
+
+Every item imgur-upload and imgur-save process is recorded with its
+source (path or URL), link, deletehash, size in bytes and upload time,
+in an SQLite database at $XDG_DATA_HOME/imgur/history.sqlite3 or
+$HOME/.local/share/imgur/history.sqlite3. Sources, links and times are
+indexed, so imgur-history finds entries without scanning the whole
+history.
+
+This replaces the plain-text upload.log of earlier versions, which is
+no longer written.
+
+"""
+
+# pylint: disable=wildcard-import,unused-wildcard-import
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from zmwangx.colorout import *
+
+# buffered entries are written out once there are this many of them,
+# or when an entry comes in this many seconds after the last flush
+FLUSH_ENTRIES = 256
+FLUSH_INTERVAL = 1.0
+
+# accepted by --since and --until (local time)
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M',
+                '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']
+
+Entry = collections.namedtuple('Entry', [
+    'time',  # Unix time when the item finished
+    'action',  # "upload" or "save"
+    'source',  # absolute path or source URL
+    'link',  # None if failed
+    'deletehash',
+    'bytes',  # size of the image uploaded, if known
+    'seconds',  # time the upload took, if known
+])
+
+def get_history_file():
+    """Get the path to the history database.
+
+    Also make sure the directory containing the database exists.
+
+    """
+
+    if 'XDG_DATA_HOME' in os.environ:
+        history_file = os.path.join(os.environ['XDG_DATA_HOME'],
+                                    'imgur/history.sqlite3')
+    else:
+        history_file = os.path.expanduser(
+            '~/.local/share/imgur/history.sqlite3')
+    if not os.path.exists(os.path.dirname(history_file)):
+        os.makedirs(os.path.dirname(history_file), mode=0o700)
+    return history_file
+
+def _link_variants(link):
+    """A link, and the same link with the other scheme."""
+    if link.startswith('https://'):
+        return link, 'http://' + link[len('https://'):]
+    if link.startswith('http://'):
+        return link, 'https://' + link[len('http://'):]
+    return link, link
+
+class History(object):
+    """Upload history.
+
+    Writes are buffered and flushed in batches; closing the history
+    (also on exiting it as a context manager) flushes. Entries may be
+    added from any thread.
+
+    """
+
+    def __init__(self, history_file=None):
+        """Open (and create if necessary) the history.
+
+        Parameters
+        ----------
+        history_file : str
+            Path to the database. If None, get_history_file() is used.
+
+        """
+        self.history_file = history_file or get_history_file()
+        self.connection = sqlite3.connect(self.history_file, timeout=30,
+                                          check_same_thread=False)
+        # let imgur-history read while a batch is being recorded
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'time REAL NOT NULL, '
+                'action TEXT NOT NULL, '
+                'source TEXT NOT NULL, '
+                'link TEXT, '
+                'deletehash TEXT, '
+                'bytes INTEGER, '
+                'seconds REAL)')
+            for column in ('time', 'source', 'link'):
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS entries_%s '
+                    'ON entries (%s)' % (column, column))
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, action, source, image):
+        """Record an item.
+
+        Parameters
+        ----------
+        action : {"upload", "save"}
+        source : str
+        image : dict or str
+            Image data as returned by imgur.upload.upload_image with
+            details (only "link" is required), or just the link, or
+            None if the item failed.
+
+        """
+        if isinstance(image, str):
+            image = {'link': image}
+        image = image or {}
+        with self.lock:
+            self.buffer.append(Entry(
+                time.time(), action, source, image.get('link'),
+                image.get('deletehash'), image.get('bytes'),
+                image.get('seconds')))
+            if (len(self.buffer) >= FLUSH_ENTRIES or
+                    time.monotonic() - self.last_flush >= FLUSH_INTERVAL):
+                self._flush()
+
+    def flush(self):
+        """Write buffered entries."""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        """flush, with the lock held."""
+        if self.buffer:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    self.buffer)
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def find(self, source=None, link=None, since=None, until=None,
+             failed=False, limit=None):
+        """Find entries, oldest first.
+
+        Parameters
+        ----------
+        source : str
+            Only entries of this source.
+        link : str
+            Only entries with this link, whether HTTP or HTTPS.
+        since, until : float
+            Only entries recorded in this range of Unix times, since
+            inclusive, until exclusive.
+        failed : bool
+            Only failed items. Default is False.
+        limit : int
+            Only the latest this many entries.
+
+        Returns
+        -------
+        entries : list
+            List of Entry.
+
+        """
+        # pylint: disable=too-many-arguments
+        self.flush()
+        conditions = []
+        params = []
+        if source is not None:
+            conditions.append('source = ?')
+            params.append(source)
+        if link is not None:
+            conditions.append('link IN (?, ?)')
+            params.extend(_link_variants(link))
+        if since is not None:
+            conditions.append('time >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('time < ?')
+            params.append(until)
+        if failed:
+            conditions.append('link IS NULL')
+        query = 'SELECT * FROM entries'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY time DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [Entry(*row) for row in reversed(rows)]
+
+    def close(self):
+        """Flush and close the database connection."""
+        self.flush()
+        self.connection.close()
+
+def _timestamp(string):
+    """Parse a date or date and time (one of DATE_FORMATS)."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(string,
+                                              date_format).timestamp()
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("invalid date '%s'" % string)
+
+def _format(entry):
+    """Tab-separated line of an entry."""
+    return '\t'.join([
+        datetime.datetime.fromtimestamp(entry.time).strftime(
+            '%Y-%m-%d %H:%M:%S'),
+        entry.action,
+        entry.source,
+        entry.link or '-',
+        entry.deletehash or '-',
+        str(entry.bytes) if entry.bytes is not None else '-',
+        '%.2f' % entry.seconds if entry.seconds is not None else '-',
+    ])
+
+def main():
+    """CLI interface of imgur-history."""
+    parser = argparse.ArgumentParser(
+        description="""Find entries in the history of imgur-upload and
+        imgur-save, and print them oldest first, one per line: time,
+        action, source, link, deletehash, bytes and upload seconds,
+        separated by tabs ("-" if unknown or failed).""")
+    parser.add_argument('--source',
+                        help="""only entries of this path (made absolute)
+                        or URL""")
+    parser.add_argument('--link',
+                        help="""only entries with this link, HTTP or
+                        HTTPS""")
+    parser.add_argument('--since', type=_timestamp, metavar='DATE',
+                        help="""only entries from DATE on, e.g.,
+                        2016-01-31 or 2016-01-31T12:00 (local time)""")
+    parser.add_argument('--until', type=_timestamp, metavar='DATE',
+                        help='only entries before DATE')
+    parser.add_argument('-n', '--limit', type=int,
+                        help='only the latest LIMIT entries')
+    parser.add_argument('--failed', action='store_true',
+                        help='only failed items')
+    parser.add_argument('--json', action='store_true',
+                        help='print entries as JSON objects')
+    args = parser.parse_args()
+
+    source = args.source
+    if source is not None and '://' not in source:
+        source = os.path.abspath(source)
+    history_file = get_history_file()
+    if not os.path.exists(history_file):
+        cerror("no history yet")
+        return 1
+    with History(history_file) as history:
+        entries = history.find(source=source, link=args.link,
+                               since=args.since, until=args.until,
+                               failed=args.failed, limit=args.limit)
+    for entry in entries:
+        if args.json:
+            print(json.dumps(entry._asdict()))
+        else:
+            print(_format(entry))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
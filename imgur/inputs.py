@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""Lazily read batches of paths or URLs.
+
+Batches too large for the command line can be read from a file or
+stdin, or found by walking a directory tree. Entries are generated one
+at a time as the engine asks for them, so a batch of millions starts
+right away and takes constant memory.
+
+"""
+
+import fnmatch
+import os
+import sys
+
+# bytes read at a time from a list
+READ_SIZE = 64 * 1024
+
+def split_entries(fileobj, separator=b'\n'):
+    """Split a binary file object into entries as it is read.
+
+    Empty entries are skipped; with the newline separator, a trailing
+    carriage return is stripped as well. Entries are decoded with
+    os.fsdecode, so that paths that are not valid UTF-8 survive.
+
+    Parameters
+    ----------
+    fileobj : file object
+        Opened in binary mode.
+    separator : bytes
+        b'\\n' (default) or b'\\0'.
+
+    Yields
+    ------
+    entry : str
+
+    """
+    # read1 returns whatever is available, so that entries piped in
+    # slowly are not held back until a full READ_SIZE has arrived
+    read = getattr(fileobj, 'read1', fileobj.read)
+    remainder = b''
+    while True:
+        chunk = read(READ_SIZE)
+        if not chunk:
+            break
+        entries = (remainder + chunk).split(separator)
+        remainder = entries.pop()
+        for entry in entries:
+            if separator == b'\n':
+                entry = entry.rstrip(b'\r')
+            if entry:
+                yield os.fsdecode(entry)
+    if separator == b'\n':
+        remainder = remainder.rstrip(b'\r')
+    if remainder:
+        yield os.fsdecode(remainder)
+
+def read_list(path, null=False):
+    """Read entries from a file, or stdin if path is "-".
+
+    The file is only opened once iteration starts.
+
+    Parameters
+    ----------
+    path : str
+    null : bool
+        If True, entries are separated by NUL characters (as printed by
+        find -print0) instead of newlines. Default is False.
+
+    Yields
+    ------
+    entry : str
+
+    """
+    separator = b'\0' if null else b'\n'
+    if path == '-':
+        yield from split_entries(sys.stdin.buffer, separator)
+    else:
+        with open(path, 'rb') as fileobj:
+            yield from split_entries(fileobj, separator)
+
+def _matches(name, patterns, extensions):
+    """Whether a file name passes the filters of walk."""
+    if patterns and not any(fnmatch.fnmatch(name, pattern)
+                            for pattern in patterns):
+        return False
+    if extensions:
+        extension = os.path.splitext(name)[1].lstrip('.').lower()
+        if extension not in extensions:
+            return False
+    return True
+
+def walk(directory, patterns=None, extensions=None):
+    """Find files under a directory recursively.
+
+    Directories are walked top-down in sorted order, one at a time.
+    Symlinks to directories are not followed.
+
+    Parameters
+    ----------
+    directory : str
+    patterns : list
+        If given, only files whose names match at least one of these
+        shell-style patterns (e.g., "*.png") are yielded.
+    extensions : list
+        If given, only files with one of these extensions (without the
+        dot, case insensitive) are yielded.
+
+    Yields
+    ------
+    path : str
+
+    """
+    if extensions:
+        extensions = set(extension.lstrip('.').lower()
+                         for extension in extensions)
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if _matches(filename, patterns, extensions):
+                yield os.path.join(dirpath, filename)
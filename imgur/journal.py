@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""Resumable job journal for large batches.
+
+A journal records the state of each item of a batch (an image path or
+source URL) as one JSON object per line, appended as the batch
+progresses:
+
+* "pending": added to the journal;
+* "in-flight": claimed by a run that has not reported on it yet;
+* "done": uploaded, with its link;
+* "failed".
+
+The latest line of an item wins. Replaying the journal after a run is
+killed shows what is left to do: everything not done, including items
+that were in flight.
+
+"""
+
+import collections
+import json
+import os
+import time
+
+PENDING = 'pending'
+IN_FLIGHT = 'in-flight'
+DONE = 'done'
+FAILED = 'failed'
+
+# buffered records are written out once there are this many of them,
+# or when a record comes in this many seconds after the last flush
+FLUSH_RECORDS = 256
+FLUSH_INTERVAL = 1.0
+
+def _dumps(item, state, link=None):
+    """Serialize a record as a line."""
+    record = {'item': item, 'state': state}
+    if link is not None:
+        record['link'] = link
+    return json.dumps(record) + '\n'
+
+class Journal(object):
+    """Write-ahead journal of item states.
+
+    Writes are buffered and flushed in batches; closing the journal
+    (also on exiting it as a context manager) flushes and syncs.
+
+    """
+
+    def __init__(self, path):
+        """Open a journal, replaying it if it exists.
+
+        Parameters
+        ----------
+        path : str
+
+        """
+        self.path = path
+        self.states = collections.OrderedDict()  # item => (state, link)
+        lines = 0
+        torn = False
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as journal_obj:
+                for line in journal_obj:
+                    lines += 1
+                    torn = not line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                        self.states[record['item']] = (record['state'],
+                                                       record.get('link'))
+                    except (ValueError, KeyError):
+                        # torn write at the end of a killed run
+                        continue
+        # a torn last line would swallow the next record appended
+        if torn or lines > 2 * len(self.states):
+            self._compact()
+        self.buffer = []
+        self.last_flush = time.time()
+        self.journal_obj = open(path, 'a', encoding='utf-8')
+
+    def _compact(self):
+        """Atomically rewrite the journal with one line per item."""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as journal_obj:
+            for item, (state, link) in self.states.items():
+                journal_obj.write(_dumps(item, state, link))
+            journal_obj.flush()
+            os.fsync(journal_obj.fileno())
+        os.replace(tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _record(self, item, state, link=None):
+        """Set the state of an item."""
+        self.states[item] = (state, link)
+        self.buffer.append(_dumps(item, state, link))
+        if (len(self.buffer) >= FLUSH_RECORDS or
+                time.time() - self.last_flush >= FLUSH_INTERVAL):
+            self.flush()
+
+    def add(self, items):
+        """Add items not already in the journal as pending."""
+        for item in items:
+            if item not in self.states:
+                self._record(item, PENDING)
+
+    def todo(self):
+        """List items not done yet, in the order they were added."""
+        return [item for item, (state, _) in self.states.items()
+                if state != DONE]
+
+    def count(self, state):
+        """Number of items in a state."""
+        return sum(1 for item_state, _ in self.states.values()
+                   if item_state == state)
+
+    def claim(self, items):
+        """Mark items as in flight."""
+        for item in items:
+            self._record(item, IN_FLIGHT)
+
+    def finish(self, item, link):
+        """Mark an item as done with link, or failed if link is None."""
+        if link is not None:
+            self._record(item, DONE, link)
+        else:
+            self._record(item, FAILED)
+
+    def flush(self, sync=False):
+        """Write out buffered records; with sync, also fsync."""
+        if self.buffer:
+            self.journal_obj.write(''.join(self.buffer))
+            self.buffer = []
+        self.journal_obj.flush()
+        if sync:
+            os.fsync(self.journal_obj.fileno())
+        self.last_flush = time.time()
+
+    def close(self):
+        """Flush, sync, and close the journal."""
+        self.flush(sync=True)
+        self.journal_obj.close()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""Per-phase timing of upload and save runs.
+
+Hot paths are wrapped in span(phase), which times them when metrics
+are enabled (see enable and subscribe) and costs next to nothing
+otherwise. Phases are:
+
+* "authenticate": creating the client (imgur.authenticate.gen_client);
+* "token_refresh": getting a new access token;
+* "validate", "transform", "hash": pre-upload stages;
+* "download": downloading an image to save;
+* "upload": uploading an image, retries included;
+* "request": a single HTTP request to Imgur;
+* "retry_backoff", "rate_limit_wait": sleeping before a retry, or
+  because of Imgur's rate limits;
+* "job": a whole job run by the engine, in a worker;
+* "latency": from the submission of a job to the engine until its
+  result is collected, queueing included.
+
+Spans timed in a job run by imgur.engine are collected per job (see
+Measured) and brought back with its result, so that timings of worker
+processes end up in the histograms of the process running the batch.
+Subscribed hooks are called there, for every span.
+
+"""
+
+import collections
+import contextlib
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, float('inf'))
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+_enabled = False
+_hooks = []
+_histograms = collections.OrderedDict()  # phase => Histogram
+_lock = threading.Lock()
+_local = threading.local()
+
+class Histogram(object):
+    """Counts of durations in BUCKETS, with their sum, min and max."""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Count a duration."""
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating within its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = min(BUCKETS[i], self.max)
+                lower = max(lower, self.min)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+def enable():
+    """Time spans in this process from now on."""
+    global _enabled  # pylint: disable=global-statement
+    _enabled = True
+
+def is_enabled():
+    """Whether spans are timed in this process."""
+    return _enabled
+
+def subscribe(hook):
+    """Call hook(phase, seconds) for every span; enables metrics.
+
+    Hooks are called in the process running the batch, from whichever
+    thread collects the span (for spans of engine jobs, the thread
+    driving the engine), so they should be quick.
+
+    """
+    with _lock:
+        _hooks.append(hook)
+    enable()
+
+def unsubscribe(hook):
+    """Stop calling a hook."""
+    with _lock:
+        _hooks.remove(hook)
+
+def record(phase, seconds):
+    """Record a span.
+
+    In a job run by Measured, the span is kept for the job's result;
+    otherwise, it is added to the histograms and passed to the hooks.
+
+    """
+    spans = getattr(_local, 'spans', None)
+    if spans is not None:
+        spans.append((phase, seconds))
+        return
+    with _lock:
+        histogram = _histograms.get(phase)
+        if histogram is None:
+            histogram = _histograms[phase] = Histogram()
+        histogram.add(seconds)
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(phase, seconds)
+
+def merge(spans):
+    """Record spans brought back from a job (see Measured)."""
+    for phase, seconds in spans:
+        record(phase, seconds)
+
+@contextlib.contextmanager
+def span(phase):
+    """Context manager timing a phase, if metrics are enabled."""
+    if not _enabled and getattr(_local, 'spans', None) is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start)
+
+class Measured(object):
+    """lambda item: (func(item), spans timed during the call)
+
+    Picklable wrapper used by the engine to bring spans back from
+    worker processes, like imgur.ratelimit.Observed.
+
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, func):
+        """Init with a one-argument func."""
+        self.func = func
+
+    def __call__(self, item):
+        """Call func, collecting spans."""
+        _local.spans = spans = []
+        start = time.perf_counter()
+        try:
+            result = self.func(item)
+        finally:
+            _local.spans = None
+        spans.append(('job', time.perf_counter() - start))
+        return result, spans
+
+def reset():
+    """Forget all recorded spans."""
+    with _lock:
+        _histograms.clear()
+
+def summary():
+    """Summary of the histograms.
+
+    Returns
+    -------
+    summary : dict
+        For each phase, its "count", "sum", "mean", "min", "max", and
+        estimated "p50", "p90" and "p99", in seconds.
+
+    """
+    with _lock:
+        histograms = list(_histograms.items())
+    result = collections.OrderedDict()
+    for phase, histogram in histograms:
+        entry = collections.OrderedDict([
+            ('count', histogram.count),
+            ('sum', histogram.sum),
+            ('mean', histogram.sum / histogram.count),
+            ('min', histogram.min),
+            ('max', histogram.max),
+        ])
+        for q in QUANTILES:
+            entry['p%d' % round(q * 100)] = histogram.quantile(q)
+        result[phase] = entry
+    return result
+
+def _prometheus(counts):
+    """The histograms and counts in Prometheus' text format."""
+    lines = [
+        '# HELP imgur_phase_seconds Time spent in each phase of a batch.',
+        '# TYPE imgur_phase_seconds histogram',
+    ]
+    with _lock:
+        histograms = list(_histograms.items())
+    for phase, histogram in histograms:
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram.buckets):
+            cumulative += count
+            lines.append('imgur_phase_seconds_bucket{phase="%s",le="%s"} %d' %
+                         (phase, '+Inf' if math.isinf(bound) else repr(bound),
+                          cumulative))
+        lines.append('imgur_phase_seconds_sum{phase="%s"} %r' %
+                     (phase, histogram.sum))
+        lines.append('imgur_phase_seconds_count{phase="%s"} %d' %
+                     (phase, histogram.count))
+    if counts:
+        lines.extend([
+            '# HELP imgur_images Images of the batch, by result.',
+            '# TYPE imgur_images gauge',
+        ])
+        for result, count in counts.items():
+            lines.append('imgur_images{result="%s"} %d' % (result, count))
+    return '\n'.join(lines) + '\n'
+
+def write(path, counts=None):
+    """Write the metrics to a file.
+
+    The file is replaced atomically, as Prometheus' node exporter
+    expects of its textfile collector.
+
+    Parameters
+    ----------
+    path : str
+        If it ends in .prom, the Prometheus text format is used, or
+        else JSON.
+    counts : dict
+        Counts of images by result (e.g., "succeeded" and "failed") to
+        include. Default is None.
+
+    """
+    if path.endswith('.prom'):
+        content = _prometheus(counts)
+    else:
+        content = json.dumps({'phases': summary(), 'images': counts or {}},
+                             indent=2) + '\n'
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmppath = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    with os.fdopen(fd, 'w', encoding='utf-8') as fileobj:
+        fileobj.write(content)
+    os.chmod(tmppath, 0o644)
+    os.replace(tmppath, path)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+"""Spread uploads across several credential profiles.
+
+Imgur limits API credits per application (client_id) and per user, so
+a single set of credentials caps throughput however many jobs run. The
+config file may hold several named profiles (see
+imgur.authenticate.get_profiles); imgur.authenticate.gen_client then
+returns a Rotation of their clients, which is passed around in place of
+a pyimgur.Imgur, and imgur.authenticate.call_authenticated sends each
+call through a profile chosen by the Rotation.
+
+Profiles are chosen by smooth weighted round-robin, weighted by the
+uploads each can still afford according to the X-RateLimit-* headers
+of its latest response, less those in flight, so that traffic is spread
+in proportion to remaining credits and profiles run out together. A
+profile that runs out of credits or is throttled is taken out of
+rotation until its credits are reset (or for EXHAUSTED_BACKOFF seconds
+when Imgur does not say when), and the next calls go to the others,
+the throttled call included.
+
+Each process keeps its own accounting: with the process engine, every
+worker holds a copy of the Rotation, which learns the credits left from
+the responses it sees.
+
+"""
+
+import threading
+import time
+
+import imgur.ratelimit
+
+# assumed credits of a profile not heard from yet: Imgur's daily
+# application limit
+DEFAULT_CREDITS = 12500
+
+# seconds out of rotation after running out of credits or being
+# throttled, when Imgur gives no reset time or Retry-After
+EXHAUSTED_BACKOFF = 300.0
+
+class Profile(object):
+    """A named client and its accounting."""
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+
+    def __init__(self, name, client):
+        """Init with a profile name and a pyimgur.Imgur."""
+        self.name = name
+        self.client = client
+        self.client_remaining = None
+        self.user_remaining = None
+        self.available_at = 0.0  # Unix time; out of rotation until then
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+        self.current_weight = 0  # of smooth weighted round-robin
+
+    def remaining(self):
+        """Credits left as last reported, or DEFAULT_CREDITS."""
+        known = [value for value in (self.client_remaining,
+                                     self.user_remaining)
+                 if value is not None]
+        return min(known) if known else DEFAULT_CREDITS
+
+    def weight(self):
+        """Uploads this profile can still afford, less those in flight."""
+        return max(0, self.remaining() // imgur.ratelimit.CREDITS_PER_UPLOAD
+                   - self.in_flight)
+
+    def update(self, observation):
+        """Account for the Observation of a call."""
+        now = time.time()
+        if observation.client_remaining is not None:
+            self.client_remaining = observation.client_remaining
+        if observation.user_remaining is not None:
+            self.user_remaining = observation.user_remaining
+        exhausted = self.remaining() < imgur.ratelimit.CREDITS_PER_UPLOAD
+        if observation.throttled:
+            self.throttled += observation.throttled
+        if not exhausted and not observation.throttled:
+            return
+        if (observation.user_reset is not None and
+                self.user_remaining is not None and
+                self.user_remaining < imgur.ratelimit.CREDITS_PER_UPLOAD):
+            available_at = observation.user_reset
+        elif observation.retry_after is not None and not exhausted:
+            available_at = now + observation.retry_after
+        else:
+            available_at = now + EXHAUSTED_BACKOFF
+        self.available_at = max(self.available_at, available_at)
+
+    def stats(self):
+        """Accounting of the profile, as a dict."""
+        return {
+            'calls': self.calls,
+            'throttled': self.throttled,
+            'client_remaining': self.client_remaining,
+            'user_remaining': self.user_remaining,
+            'available_at': self.available_at or None,
+        }
+
+class Rotation(object):
+    """Clients of several profiles, used as one.
+
+    Picklable; a copy keeps the clients and their credits, and starts
+    with nothing in flight.
+
+    """
+
+    def __init__(self, clients):
+        """Init.
+
+        Parameters
+        ----------
+        clients : list
+            (name, pyimgur.Imgur) pairs.
+
+        """
+        if not clients:
+            raise ValueError("no clients")
+        self.profiles = [Profile(name, client) for name, client in clients]
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        for profile in self.profiles:
+            profile.in_flight = 0
+
+    @property
+    def clients(self):
+        """The pyimgur.Imgur clients of the profiles."""
+        return [profile.client for profile in self.profiles]
+
+    def choose(self):
+        """Pick the profile for the next call, and count it in flight.
+
+        Profiles in rotation are picked in proportion to their weight;
+        if none is, the one back soonest is picked anyway (and Imgur's
+        429 responses are backed off from as usual).
+
+        """
+        now = time.time()
+        with self.lock:
+            available = [profile for profile in self.profiles
+                         if profile.available_at <= now]
+            for profile in available:
+                if profile.remaining() < imgur.ratelimit.CREDITS_PER_UPLOAD:
+                    # back after a reset; credits unknown until heard from
+                    profile.client_remaining = None
+                    profile.user_remaining = None
+            if not available:
+                chosen = min(self.profiles,
+                             key=lambda profile: profile.available_at)
+            else:
+                # a profile with nothing left to afford still gets a
+                # share if all are so, rather than none at all
+                weights = [profile.weight() for profile in available]
+                if not any(weights):
+                    weights = [1] * len(available)
+                for profile, weight in zip(available, weights):
+                    profile.current_weight += weight
+                chosen = max(available,
+                             key=lambda profile: profile.current_weight)
+                chosen.current_weight -= sum(weights)
+            chosen.in_flight += 1
+            chosen.calls += 1
+        return chosen
+
+    def release(self, profile, observation):
+        """Account for a call chosen with choose, now finished."""
+        with self.lock:
+            profile.in_flight -= 1
+            if observation is not None:
+                profile.update(observation)
+
+    def _others_available(self, profile):
+        """Whether profiles other than profile are in rotation."""
+        now = time.time()
+        return any(other is not profile and other.available_at <= now
+                   for other in self.profiles)
+
+    def call(self, func, *args, **kwargs):
+        """Call func with the client of a chosen profile.
+
+        Arguments that are this Rotation are replaced with the client.
+        If the call is throttled while other profiles are in rotation,
+        it is retried right away through another, rather than backed
+        off from (see imgur.ratelimit.failover).
+
+        """
+        for attempt in range(len(self.profiles)):
+            profile = self.choose()
+            last = (attempt == len(self.profiles) - 1 or
+                    not self._others_available(profile))
+            call_args = [profile.client if arg is self else arg
+                         for arg in args]
+            call_kwargs = {key: profile.client if value is self else value
+                           for key, value in kwargs.items()}
+            seen = None
+            try:
+                with imgur.ratelimit.observing() as seen, \
+                        imgur.ratelimit.failover(not last):
+                    return func(*call_args, **call_kwargs)
+            except Exception:  # pylint: disable=broad-except
+                if last or not seen.observation.throttled:
+                    raise
+            finally:
+                self.release(profile, seen and seen.observation)
+
+    def stats(self):
+        """Accounting of each profile, by name."""
+        with self.lock:
+            return {profile.name: profile.stats()
+                    for profile in self.profiles}
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""Live progress of upload and save batches.
+
+A Reporter shows how many items are done, failed and in flight, the
+throughput in images and megabytes per second, and the estimated time
+left, on a status line redrawn in place when stderr is a terminal, or
+as a log line every LOG_INTERVAL seconds otherwise.
+
+Results already come back to the process running the batch; the only
+things workers report are when they start and finish a transfer (see
+active) and the bytes they send (see sent, called by imgur.request for
+every chunk of an upload), through counters in shared memory that pool
+processes get when they start (see attach), so the hot path pays for
+an uncontended lock acquisition now and then.
+
+"""
+
+# pylint: disable=wildcard-import,unused-wildcard-import
+
+import collections
+import contextlib
+import shutil
+import sys
+import threading
+import time
+
+from zmwangx.colorout import *
+
+# seconds
+REFRESH_INTERVAL = 0.25
+LOG_INTERVAL = 10.0
+# throughput is measured over this much recent time
+RATE_WINDOW = 30.0
+
+# indices of the shared counters
+IN_FLIGHT = 0
+SENT = 1
+
+_counters = None  # multiprocessing.Array, if enabled
+
+def enable():
+    """Count transfers in this process and pools started later."""
+    global _counters  # pylint: disable=global-statement
+    import multiprocessing
+
+    if _counters is None:
+        _counters = multiprocessing.Array('q', 2)
+
+def get_counters():
+    """The shared counters, or None."""
+    return _counters
+
+def attach(counters):
+    """Initializer of pool processes: use the parent's counters."""
+    global _counters  # pylint: disable=global-statement
+    _counters = counters
+
+def _add(index, value):
+    """Add to a counter, if enabled."""
+    counters = _counters
+    if counters is not None:
+        with counters.get_lock():
+            counters[index] += value
+
+def in_flight():
+    """Number of transfers in flight (0 unless enabled)."""
+    return _counters[IN_FLIGHT] if _counters is not None else 0
+
+def bytes_sent():
+    """Bytes uploaded so far (0 unless enabled)."""
+    return _counters[SENT] if _counters is not None else 0
+
+def sent(size):
+    """Count bytes uploaded."""
+    _add(SENT, size)
+
+@contextlib.contextmanager
+def active():
+    """Context manager counting a transfer as in flight while it runs."""
+    _add(IN_FLIGHT, 1)
+    try:
+        yield
+    finally:
+        _add(IN_FLIGHT, -1)
+
+def _duration(seconds):
+    """Format a duration as, e.g., 1h02m, 3m20s or 45s."""
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return '%dh%02dm' % (hours, minutes)
+    if minutes:
+        return '%dm%02ds' % (minutes, seconds)
+    return '%ds' % seconds
+
+class Reporter(object):
+    """Progress reporter of a batch.
+
+    Call update for every result; a background thread refreshes the
+    report. Also a context manager, started on entry and closed on
+    exit.
+
+    """
+
+    def __init__(self, total=None, stream=None, interval=None):
+        """Init.
+
+        Parameters
+        ----------
+        total : int
+            Number of items of the batch, or None if unknown (streamed),
+            in which case no ETA is shown.
+        stream : file
+            Default is sys.stderr.
+        interval : float
+            Seconds between reports. Default is REFRESH_INTERVAL if
+            stream is a terminal, and LOG_INTERVAL otherwise.
+
+        """
+        self.total = total
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        if interval is None:
+            interval = REFRESH_INTERVAL if self.tty else LOG_INTERVAL
+        self.interval = interval
+        self.succeeded = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start_time = time.monotonic()
+        # (time, items finished, bytes) samples within RATE_WINDOW
+        self.samples = collections.deque([(self.start_time, 0, 0)])
+        self.lock = threading.Lock()
+        self.output_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.shown = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        """Start reporting."""
+        self.thread.start()
+
+    def update(self, succeeded=True, size=None):
+        """Count a finished item.
+
+        Parameters
+        ----------
+        succeeded : bool
+        size : int
+            Bytes uploaded, if known; only used when transfers are not
+            counted in this process (see enable).
+
+        """
+        with self.lock:
+            if succeeded:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            if size:
+                self.bytes += size
+
+    def status(self):
+        """The progress report, as a line.
+
+        E.g., "12/40 done, 1 failed, 8 in flight, 3.1 images/s, 2.4
+        MB/s, ETA 9s, elapsed 4s", where done includes failed.
+
+        """
+        now = time.monotonic()
+        with self.lock:
+            finished = self.succeeded + self.failed
+            failed = self.failed
+            size = bytes_sent() if _counters is not None else self.bytes
+            self.samples.append((now, finished, size))
+            while (len(self.samples) > 2 and
+                   now - self.samples[1][0] >= RATE_WINDOW):
+                self.samples.popleft()
+            since, finished_then, size_then = self.samples[0]
+        elapsed = now - since
+        rate = (finished - finished_then) / elapsed if elapsed > 0 else 0.0
+        byte_rate = (size - size_then) / elapsed if elapsed > 0 else 0.0
+        parts = [
+            '%d%s done' % (finished, '/%d' % self.total
+                           if self.total is not None else ''),
+            '%d failed' % failed,
+        ]
+        if _counters is not None:
+            parts.append('%d in flight' % in_flight())
+        parts.extend([
+            '%.1f images/s' % rate,
+            '%.1f MB/s' % (byte_rate / 1e6),
+        ])
+        if self.total is not None:
+            left = self.total - finished
+            if left <= 0:
+                parts.append('ETA 0s')
+            elif rate > 0:
+                parts.append('ETA %s' % _duration(left / rate))
+            else:
+                parts.append('ETA -')
+        parts.append('elapsed %s' % _duration(now - self.start_time))
+        return ', '.join(parts)
+
+    def show(self):
+        """Report now."""
+        if not self.tty:
+            cprogress('progress: %s' % self.status())
+            return
+        # a wrapped line could not be redrawn in place
+        width = shutil.get_terminal_size().columns - 1
+        with self.output_lock:
+            # leave the cursor at the start of the line, so that other
+            # messages overwrite the status rather than follow it
+            self.stream.write('\r\x1b[K%s\r' % self.status()[:width])
+            self.stream.flush()
+            self.shown = True
+
+    def clear(self):
+        """Erase the status line."""
+        with self.output_lock:
+            self._clear()
+
+    def _clear(self):
+        """clear, with the output lock held."""
+        if self.shown:
+            self.stream.write('\r\x1b[K')
+            self.stream.flush()
+            self.shown = False
+
+    def print(self, line):
+        """Print a line to stdout without garbling the status line."""
+        with self.output_lock:
+            self._clear()
+            print(line, flush=True)
+
+    def _run(self):
+        """Body of the reporting thread."""
+        while not self.stopped.wait(self.interval):
+            self.show()
+
+    def close(self):
+        """Stop reporting and erase the status line."""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.clear()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""Rate-limit-aware concurrency control.
+
+Imgur reports the remaining API credits of the application and of the
+user in response headers, and responds with 429 Too Many Requests when
+they run out. imgur.request records what it sees per thread with
+record_response(); the engine collects one Observation per job with
+observe(), and feeds it to an AdaptiveLimiter in the main process,
+which adjusts the number of jobs in flight AIMD-style: additive
+increase while requests go through, multiplicative decrease on 429.
+
+"""
+
+import collections
+import contextlib
+import random
+import threading
+import time
+
+# each upload costs this many credits
+CREDITS_PER_UPLOAD = 10
+
+# AIMD parameters
+ADDITIVE_INCREASE = 1.0
+MULTIPLICATIVE_DECREASE = 0.5
+
+# backoff after 429 when Imgur does not say how long to wait
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+MAX_THROTTLE_RETRIES = 8
+
+Observation = collections.namedtuple('Observation', [
+    'client_remaining',  # remaining application credits, or None
+    'user_remaining',  # remaining user credits, or None
+    'user_reset',  # Unix time when user credits reset, or None
+    'throttled',  # number of 429 responses
+    'retry_after',  # longest wait Imgur asked for after 429, or None
+])
+
+_local = threading.local()
+
+def _int_header(headers, name):
+    """Parse an integer header; None if absent or malformed."""
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def _new_observation():
+    """An empty Observation."""
+    return Observation(None, None, None, 0, None)
+
+def record_response(response):
+    """Record the rate-limit headers of a response in this thread.
+
+    Parameters
+    ----------
+    response : requests.Response
+
+    """
+    observation = getattr(_local, 'observation', None) or _new_observation()
+    headers = response.headers
+    updates = {}
+    for field, header in (('client_remaining', 'X-RateLimit-ClientRemaining'),
+                          ('user_remaining', 'X-RateLimit-UserRemaining'),
+                          ('user_reset', 'X-RateLimit-UserReset')):
+        value = _int_header(headers, header)
+        if value is not None:
+            updates[field] = value
+    if response.status_code == 429:
+        updates['throttled'] = observation.throttled + 1
+        retry_after = _int_header(headers, 'Retry-After')
+        if retry_after is not None:
+            updates['retry_after'] = max(retry_after,
+                                         observation.retry_after or 0)
+    _local.observation = observation._replace(**updates)
+
+def _merge(outer, inner):
+    """Observation of a call containing another."""
+    def latest(field):
+        """Value of a field from inner, or else from outer."""
+        value = getattr(inner, field)
+        return value if value is not None else getattr(outer, field)
+
+    retry_after = [value for value in (outer.retry_after, inner.retry_after)
+                   if value is not None]
+    return Observation(latest('client_remaining'), latest('user_remaining'),
+                       latest('user_reset'),
+                       outer.throttled + inner.throttled,
+                       max(retry_after) if retry_after else None)
+
+class _Seen(object):
+    """Result of observing; observation is set on exit."""
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('observation',)
+
+    def __init__(self):
+        self.observation = None
+
+@contextlib.contextmanager
+def observing():
+    """Context manager observing the rate limits of a block on its own.
+
+    Yields an object whose observation attribute is the Observation of
+    the block once it exits. What the block sees also counts toward the
+    observation of the enclosing call, if any (e.g., of Observed).
+
+    """
+    seen = _Seen()
+    outer = getattr(_local, 'observation', None)
+    _local.observation = _new_observation()
+    try:
+        yield seen
+    finally:
+        seen.observation = _local.observation
+        _local.observation = (None if outer is None else
+                              _merge(outer, seen.observation))
+
+def max_throttle_retries():
+    """Throttled retries allowed to a request of this thread.
+
+    MAX_THROTTLE_RETRIES, or 0 within failover.
+
+    """
+    return 0 if getattr(_local, 'failover', False) else MAX_THROTTLE_RETRIES
+
+@contextlib.contextmanager
+def failover(enabled=True):
+    """Context manager under which throttled requests of this thread are
+    not retried, as the caller retries them elsewhere (see
+    imgur.profiles.Rotation)."""
+    saved = getattr(_local, 'failover', False)
+    _local.failover = enabled
+    try:
+        yield
+    finally:
+        _local.failover = saved
+
+def retry_delay(response, attempt):
+    """Time to sleep before retrying a throttled request.
+
+    Retry-After is honored if present; otherwise exponential backoff
+    capped at BACKOFF_CAP, with full jitter so that workers throttled
+    together do not retry together.
+
+    Parameters
+    ----------
+    response : requests.Response
+        The 429 response.
+    attempt : int
+        Number of throttled attempts so far, starting at 0.
+
+    """
+    retry_after = _int_header(response.headers, 'Retry-After')
+    if retry_after is not None:
+        return retry_after + random.uniform(0, BACKOFF_BASE)
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+class Observed(object):
+    """lambda item: (func(item), observation during the call)
+
+    Picklable wrapper used by the engine to bring rate-limit
+    observations back from worker processes.
+
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, func):
+        """Init with a one-argument func."""
+        self.func = func
+
+    def __call__(self, item):
+        """Call func, observing rate limits."""
+        _local.observation = _new_observation()
+        try:
+            return self.func(item), _local.observation
+        finally:
+            _local.observation = None
+
+class AdaptiveLimiter(object):
+    """AIMD limit on the number of jobs in flight.
+
+    Only used from the thread driving the engine.
+
+    """
+
+    def __init__(self, initial, maximum, minimum=1):
+        """Init.
+
+        Parameters
+        ----------
+        initial : int
+            Initial number of jobs in flight.
+        maximum : int
+        minimum : int
+            Default is 1.
+
+        """
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.resume_at = 0.0
+
+    @property
+    def allowed(self):
+        """Number of jobs allowed in flight."""
+        return int(self.limit)
+
+    def delay(self):
+        """Seconds to wait before starting another job."""
+        return max(0.0, self.resume_at - time.time())
+
+    def update(self, observation):
+        """Adjust the limit according to an Observation."""
+        now = time.time()
+        if observation.throttled:
+            self.limit = max(self.minimum,
+                             self.limit * MULTIPLICATIVE_DECREASE)
+            if observation.retry_after is not None:
+                self.resume_at = max(self.resume_at,
+                                     now + observation.retry_after)
+        else:
+            self.limit = min(self.maximum,
+                             self.limit + ADDITIVE_INCREASE / self.limit)
+
+        # never have more jobs in flight than there are credits left for
+        remaining = [value for value in (observation.client_remaining,
+                                         observation.user_remaining)
+                     if value is not None]
+        if remaining:
+            affordable = min(remaining) // CREDITS_PER_UPLOAD
+            self.limit = max(self.minimum, min(self.limit, affordable))
+            if (affordable == 0 and observation.user_reset is not None and
+                    observation.user_remaining is not None and
+                    observation.user_remaining < CREDITS_PER_UPLOAD):
+                # user credits exhausted; hold off until they are reset
+                self.resume_at = max(self.resume_at, observation.user_reset)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+"""Send requests to Imgur's API over a shared connection pool.
+
+pyimgur issues every request through a module-level requests call,
+which means a new TCP connection and TLS handshake per upload. This
+module keeps one requests.Session per process, whose connection pool
+is sized to the number of concurrent jobs, so that uploads reuse
+keep-alive connections.
+
+Images are sent as multipart/form-data streamed from disk (see
+MultipartBody), never read whole or base64-encoded, so an upload holds
+a fixed amount of memory however large the file.
+
+"""
+
+import io
+import os
+import threading
+import time
+import uuid
+
+import requests
+import requests.adapters
+
+import imgur.metrics
+import imgur.progress
+import imgur.ratelimit
+import imgur.retry
+
+API_URL = 'https://api.imgur.com'
+
+DEFAULT_POOL_SIZE = 10
+
+# images are read from disk this many bytes at a time while uploading
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_pid = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+def get_api_url():
+    """Get the base URL of Imgur's API.
+
+    The environment variable IMGUR_API_URL, if set, overrides the
+    default https://api.imgur.com.
+
+    """
+    return os.environ.get('IMGUR_API_URL', API_URL).rstrip('/')
+
+def get_session(pool_size=None):
+    """Get the HTTP session shared by all threads of this process.
+
+    A forked worker never reuses its parent's session, since the two
+    processes would otherwise share sockets.
+
+    Parameters
+    ----------
+    pool_size : int
+        Minimum number of keep-alive connections to pool. The pool is
+        only ever grown. If None, DEFAULT_POOL_SIZE is used.
+
+    Returns
+    -------
+    session : requests.Session
+
+    """
+    # pylint: disable=global-statement
+    global _session, _session_pid, _session_pool_size
+    pool_size = pool_size or DEFAULT_POOL_SIZE
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            _session_pid = os.getpid()
+            _session_pool_size = 0
+        if pool_size > _session_pool_size:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session_pool_size = pool_size
+        return _session
+
+def auth_headers(client):
+    """Get the Authorization header for a client.
+
+    Parameters
+    ----------
+    client : pyimgur.Imgur
+
+    Returns
+    -------
+    headers : dict
+
+    """
+    if client.access_token is None:
+        return {'Authorization': 'Client-ID %s' % client.client_id}
+    else:
+        return {'Authorization': 'Bearer %s' % client.access_token}
+
+class MultipartBody(object):
+    """A multipart/form-data request body, streamed from a file.
+
+    Form fields and part headers are built up front; the file is read
+    as the body is sent, at most CHUNK_SIZE bytes at a time, so the
+    request never holds more than one chunk of it. requests sends the
+    body with a Content-Length, since its length is known.
+
+    """
+
+    def __init__(self, fields, name, fileobj, size, filename,
+                 progress=None):
+        """Init.
+
+        Parameters
+        ----------
+        fields : dict
+            Text fields, sent before the file.
+        name : str
+            Field name of the file.
+        fileobj : file
+            Binary file object, positioned at the start of the content.
+        size : int
+            Number of bytes of fileobj to send.
+        filename : str
+        progress : callable
+            Called as progress(sent, total) in bytes as the body is
+            read. Default is None.
+
+        """
+        # pylint: disable=too-many-arguments
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        head = []
+        for key, value in fields.items():
+            head.append('--%s\r\nContent-Disposition: form-data; '
+                        'name="%s"\r\n\r\n%s\r\n' % (boundary, key, value))
+        head.append('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                    'filename="%s"\r\nContent-Type: '
+                    'application/octet-stream\r\n\r\n' %
+                    (boundary, name, filename.replace('"', '%22')))
+        self.head = ''.join(head).encode('utf-8')
+        self.tail = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+        self.fileobj = fileobj
+        self.start = fileobj.tell()
+        self.size = size
+        self.length = len(self.head) + size + len(self.tail)
+        self.progress = progress
+        self.readers = None
+        self.sent = 0
+        self.rewind()
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def rewind(self):
+        """Go back to the start of the body, to send it again."""
+        self.fileobj.seek(self.start)
+        self.readers = [io.BytesIO(self.head),
+                        _Limited(self.fileobj, self.size),
+                        io.BytesIO(self.tail)]
+        self.sent = 0
+
+    def read(self, size=-1):
+        """Read up to size bytes of the body (all if negative)."""
+        imgur.retry.check_deadline()
+        if size is None or size < 0:
+            size = self.length - self.sent
+        chunks = []
+        wanted = size
+        while wanted > 0 and self.readers:
+            chunk = self.readers[0].read(min(wanted, CHUNK_SIZE))
+            if not chunk:
+                self.readers.pop(0)
+                continue
+            chunks.append(chunk)
+            wanted -= len(chunk)
+        data = b''.join(chunks)
+        if data:
+            self.sent += len(data)
+            imgur.progress.sent(len(data))
+            if self.progress is not None:
+                self.progress(self.sent, self.length)
+        return data
+
+class _Limited(object):
+    """Reader of at most size bytes of a file object."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.left = size
+
+    def read(self, size):
+        """Read up to size bytes."""
+        if self.left <= 0:
+            return b''
+        data = self.fileobj.read(min(size, self.left))
+        if not data:
+            raise IOError("file shrank while being uploaded")
+        self.left -= len(data)
+        return data
+
+def post(url, **kwargs):
+    """POST with the shared session, backing off on 429.
+
+    Rate-limit headers of every response are recorded with
+    imgur.ratelimit.record_response. Throttled requests are retried
+    after imgur.ratelimit.retry_delay, up to
+    imgur.ratelimit.max_throttle_retries() times, or until the deadline
+    of the current imgur.retry.Policy. Unless a timeout is given, the
+    request gets the timeouts of imgur.retry.timeout.
+
+    Returns
+    -------
+    response : requests.Response
+
+    Raises
+    ------
+    requests.RequestException
+        If the request failed or Imgur returned an error status.
+
+    """
+    timeout = kwargs.pop('timeout', None)
+    attempt = 0
+    while True:
+        with imgur.metrics.span('request'):
+            response = get_session().post(
+                url, timeout=timeout or imgur.retry.timeout(), **kwargs)
+        imgur.ratelimit.record_response(response)
+        if (response.status_code != 429 or
+                attempt >= imgur.ratelimit.max_throttle_retries()):
+            break
+        delay = imgur.ratelimit.retry_delay(response, attempt)
+        if delay >= imgur.retry.remaining():
+            break
+        with imgur.metrics.span('rate_limit_wait'):
+            time.sleep(delay)
+        if isinstance(kwargs.get('data'), MultipartBody):
+            kwargs['data'].rewind()
+        attempt += 1
+    response.raise_for_status()
+    return response
+
+def refresh_access_token(client):
+    """Get a new access token with the client's refresh token.
+
+    Unlike pyimgur.Imgur.refresh_access_token, the client is not
+    modified, and the lifetime of the token is returned as well.
+
+    Parameters
+    ----------
+    client : pyimgur.Imgur
+
+    Returns
+    -------
+    (access_token, expires_in) : tuple
+        expires_in is in seconds.
+
+    Raises
+    ------
+    requests.RequestException
+
+    """
+    payload = {
+        'client_id': client.client_id,
+        'client_secret': client.client_secret,
+        'grant_type': 'refresh_token',
+        'refresh_token': client.refresh_token,
+    }
+    response = post(get_api_url() + '/oauth2/token', data=payload)
+    token = response.json()
+    return token['access_token'], token.get('expires_in', 3600)
+
+def upload_image(client, path=None, url=None, title=None, data=None,
+                 progress=None):
+    """Upload an image from a local path, a remote URL, or memory.
+
+    Exactly one of path, url and data should be given. Files and data
+    are sent as a streamed MultipartBody.
+
+    Parameters
+    ----------
+    client : pyimgur.Imgur
+    path : str
+    url : str
+    title : str
+    data : bytes
+        Content of the image.
+    progress : callable
+        See MultipartBody. Default is None.
+
+    Returns
+    -------
+    image : dict
+        The "data" object of Imgur's response, containing "link",
+        "deletehash", etc.
+
+    Raises
+    ------
+    requests.RequestException
+        If the request failed or Imgur returned an error status.
+
+    """
+    if sum(arg is not None for arg in (path, url, data)) != 1:
+        raise ValueError("exactly one of path, url and data should be given")
+    # pylint: disable=too-many-arguments
+    fields = {'type': 'file' if url is None else 'url'}
+    if title is not None:
+        fields['title'] = title
+    headers = auth_headers(client)
+    if url is not None:
+        fields['image'] = url
+        response = post(get_api_url() + '/3/image', data=fields,
+                        headers=headers)
+        return response.json()['data']
+    if path is not None:
+        fileobj = open(path, 'rb')
+        size = os.fstat(fileobj.fileno()).st_size
+        filename = os.path.basename(path)
+    else:
+        fileobj = io.BytesIO(data)
+        size = len(data)
+        filename = title or 'image'
+    with fileobj:
+        body = MultipartBody(fields, 'image', fileobj, size, filename,
+                             progress=progress)
+        headers['Content-Type'] = body.content_type
+        response = post(get_api_url() + '/3/image', data=body,
+                        headers=headers)
+    return response.json()['data']
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""Retries with backoff and deadlines for uploads and downloads.
+
+Errors are classified as retryable (connection errors, timeouts,
+truncated responses, 408, 429 and 5xx statuses) or fatal (everything
+else, e.g., 400 Bad Request, or a missing file). A Policy runs a job,
+retrying retryable errors with capped, jittered exponential backoff,
+within a total deadline per item; while it runs, every request made by
+imgur.request in the same thread gets connect and read timeouts (see
+timeout), so a hung socket cannot stall a worker indefinitely. Those
+only bound each read or write of a socket, so streamed transfers also
+call check_deadline between chunks, lest a server trickling bytes
+keep a worker past the deadline.
+
+"""
+
+import http.client
+import random
+import socket
+import threading
+import time
+import urllib.error
+
+import imgur.metrics
+
+DEFAULT_ATTEMPTS = 5
+
+# seconds
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 60.0
+DEFAULT_DEADLINE = 300.0
+
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+RETRYABLE_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+
+_local = threading.local()
+
+def is_retryable(exc):
+    """Whether an error is likely to go away if the job is retried.
+
+    Parameters
+    ----------
+    exc : Exception
+        An exception raised by requests, urllib or socket I/O.
+
+    Returns
+    -------
+    retryable : bool
+
+    """
+    # pylint: disable=too-many-return-statements
+    # only needed once something failed; the CLI defines policies
+    # before it knows whether it will make requests at all
+    import requests
+
+    if isinstance(exc, requests.HTTPError):
+        return (exc.response is not None and
+                exc.response.status_code in RETRYABLE_STATUSES)
+    if isinstance(exc, requests.exceptions.SSLError):
+        return False
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout,
+                        requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(exc, urllib.error.HTTPError):
+        return exc.code in RETRYABLE_STATUSES
+    if isinstance(exc, urllib.error.ContentTooShortError):
+        return True
+    if isinstance(exc, urllib.error.URLError):
+        return isinstance(exc.reason, (ConnectionError, socket.timeout))
+    return isinstance(exc, (ConnectionError, socket.timeout,
+                            http.client.IncompleteRead,
+                            http.client.RemoteDisconnected))
+
+def backoff(attempt, base=BACKOFF_BASE):
+    """Seconds to wait before retrying after a failed attempt.
+
+    Full jitter: uniform between 0 and base * 2 ** attempt, capped at
+    BACKOFF_CAP, so that workers failing together do not retry
+    together.
+
+    Parameters
+    ----------
+    attempt : int
+        Number of failed attempts so far, minus one.
+    base : float
+        Default is BACKOFF_BASE.
+
+    """
+    return random.uniform(0, min(BACKOFF_CAP, base * 2 ** attempt))
+
+def remaining():
+    """Seconds left before the deadline of the job running in this thread.
+
+    Infinity if no job with a deadline is running.
+
+    """
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return float('inf')
+    return deadline - time.monotonic()
+
+def check_deadline():
+    """Raise socket.timeout if the deadline of the job running in this
+    thread has passed."""
+    if remaining() <= 0:
+        raise socket.timeout("deadline exceeded mid-transfer")
+
+def timeout():
+    """Timeouts for a request made in this thread.
+
+    Returns
+    -------
+    (connect_timeout, read_timeout) : tuple
+        The timeouts of the policy running in this thread, or
+        CONNECT_TIMEOUT and READ_TIMEOUT, both capped at the time
+        remaining before its deadline.
+
+    """
+    policy = getattr(_local, 'policy', None)
+    if policy is None:
+        connect_timeout, read_timeout = CONNECT_TIMEOUT, READ_TIMEOUT
+    else:
+        connect_timeout = policy.connect_timeout
+        read_timeout = policy.read_timeout
+    # never 0, which would mean non-blocking
+    left = max(remaining(), 0.1)
+    return min(connect_timeout, left), min(read_timeout, left)
+
+def attempts_note(attempts):
+    """Suffix for messages about a job: "" or " after N attempts"."""
+    return "" if attempts == 1 else " after %d attempts" % attempts
+
+class Policy(object):
+    """How many times, and for how long, to retry a job."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, attempts=DEFAULT_ATTEMPTS,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 deadline=DEFAULT_DEADLINE, backoff_base=BACKOFF_BASE):
+        """Init.
+
+        Parameters
+        ----------
+        attempts : int
+            Maximum number of attempts, including the first one.
+            Default is DEFAULT_ATTEMPTS.
+        connect_timeout : float
+            Seconds to wait for a connection. Default is
+            CONNECT_TIMEOUT.
+        read_timeout : float
+            Seconds to wait for data from the socket (not for the
+            whole response). Default is READ_TIMEOUT.
+        deadline : float
+            Seconds all attempts of a job may take in all, backoff
+            included; no attempt is started after that, and the
+            timeouts of the last one are cut short. None means no
+            deadline. Default is DEFAULT_DEADLINE.
+        backoff_base : float
+            See backoff. Default is BACKOFF_BASE.
+
+        """
+        # pylint: disable=too-many-arguments
+        if attempts < 1:
+            raise ValueError("attempts should be at least 1")
+        self.attempts = attempts
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.backoff_base = backoff_base
+
+    def run(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs), retrying retryable errors.
+
+        Returns
+        -------
+        (result, attempts) : tuple
+            attempts is the number of calls made.
+
+        Raises
+        ------
+        Exception
+            The error of the last attempt, if fatal, or if out of
+            attempts or time; its attempts attribute is set to the
+            number of calls made.
+
+        """
+        saved = getattr(_local, 'policy', None), getattr(_local, 'deadline',
+                                                         None)
+        _local.policy = self
+        _local.deadline = (time.monotonic() + self.deadline
+                           if self.deadline is not None else None)
+        try:
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    return func(*args, **kwargs), attempt
+                except Exception as err:  # pylint: disable=broad-except
+                    err.attempts = attempt
+                    if attempt >= self.attempts or not is_retryable(err):
+                        raise
+                    delay = backoff(attempt - 1, self.backoff_base)
+                    if delay >= remaining():
+                        raise
+                with imgur.metrics.span('retry_backoff'):
+                    time.sleep(delay)
+        finally:
+            _local.policy, _local.deadline = saved
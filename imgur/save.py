@@ -4,14 +4,249 @@
 
 # pylint: disable=wildcard-import,unused-wildcard-import
 
-import multiprocessing
+import collections
+import io
 import os
 import tempfile
+import time
+import urllib.error
 import urllib.request
 
+import requests
 from zmwangx.colorout import *
 
+import imgur.authenticate
 import imgur.cli
+import imgur.engine
+import imgur.metrics
+import imgur.progress
+import imgur.request
+import imgur.retry
+import imgur.similar
+
+# downloaded images up to this size are passed from the download stage
+# to the upload stage in memory; larger ones are streamed to tempfiles
+SPOOL_THRESHOLD = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# routes an image can be saved by
+DOWNLOAD = 'download'  # downloaded and uploaded
+DIRECT = 'direct'  # fetched by Imgur from the source URL
+FALLBACK = 'fallback'  # downloaded and uploaded after Imgur refused
+NEAR_DUPLICATE = 'near-duplicate'  # linked to a near-duplicate's upload
+
+def download_image(source_url, directory, retry=None):
+    """Download an image, into memory if small enough.
+
+    Images of at most SPOOL_THRESHOLD bytes are kept in memory; larger
+    ones are streamed to a tempfile in chunks.
+
+    Parameters
+    ----------
+    source_url : str
+    directory : str
+        Directory to create the tempfile in.
+    retry : imgur.retry.Policy
+        Retries and timeouts. If None, the defaults of
+        imgur.retry.Policy are used. Default is None.
+
+    Returns
+    -------
+    image : bytes or str
+        Content of the image, or path to the tempfile holding it, or
+        None if failed.
+
+    """
+    retry = retry or imgur.retry.Policy()
+    try:
+        with imgur.metrics.span('download'), imgur.progress.active():
+            image, attempts = retry.run(_download, source_url, directory)
+    # anything the last attempt raised, e.g., http.client.IncompleteRead
+    # pylint: disable=broad-except
+    except Exception as err:
+        cerror("failed to download '%s'%s: %s" % (
+            source_url, imgur.retry.attempts_note(getattr(err, 'attempts', 1)),
+            err))
+        return None
+    if attempts > 1:
+        cprogress("%s: downloaded%s" % (source_url,
+                                        imgur.retry.attempts_note(attempts)))
+    return image
+
+def _download(source_url, directory):
+    """download_image without retries; raise on failure."""
+    buffer = io.BytesIO()
+    fileobj = buffer
+    savepath = None
+    try:
+        with urllib.request.urlopen(
+                source_url, timeout=imgur.retry.timeout()[1]) as response:
+            length = response.headers.get('Content-Length')
+            expected = int(length) if length and length.isdigit() else None
+            if expected is not None and expected > SPOOL_THRESHOLD:
+                fileobj, savepath = _spill(buffer, directory)
+            # read1 returns what has come in so far, so that a server
+            # trickling bytes is held to the deadline
+            read = getattr(response, 'read1', response.read)
+            received = 0
+            while True:
+                imgur.retry.check_deadline()
+                chunk = read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if savepath is None and received > SPOOL_THRESHOLD:
+                    fileobj, savepath = _spill(buffer, directory)
+                fileobj.write(chunk)
+            if fileobj is not buffer:
+                fileobj.close()
+            if expected is not None and received < expected:
+                raise urllib.error.ContentTooShortError(
+                    "retrieval incomplete: got only %d out of %d bytes" %
+                    (received, expected), None)
+    except Exception:
+        if savepath is not None:
+            fileobj.close()
+            os.remove(savepath)
+        raise
+    return savepath if savepath is not None else buffer.getvalue()
+
+def _spill(buffer, directory):
+    """Move an in-memory download to a tempfile; return (fileobj, path)."""
+    fd, savepath = tempfile.mkstemp(dir=directory)
+    fileobj = os.fdopen(fd, 'wb')
+    fileobj.write(buffer.getvalue())
+    buffer.seek(0)
+    buffer.truncate()
+    return fileobj, savepath
+
+def upload_saved_image(client, source_url, image, retry=None,
+                       details=False):
+    """Upload an image downloaded with download_image.
+
+    A tempfile holding the image is removed afterwards, whether or not
+    the upload succeeds. Transient errors are retried according to
+    retry (see imgur.upload.upload_image).
+
+    Returns
+    -------
+    uploaded_url : str
+        URL of the uploaded image, or None if failed. With details,
+        image data instead, as returned by imgur.upload.upload_image
+        with details.
+
+    """
+    if isinstance(image, bytes):
+        kwargs = {'data': image}
+        size = len(image)
+    else:
+        kwargs = {'path': image}
+        size = os.path.getsize(image)
+    retry = retry or imgur.retry.Policy()
+    start = time.perf_counter()
+    try:
+        with imgur.metrics.span('upload'), imgur.progress.active():
+            image_data, attempts = retry.run(
+                imgur.authenticate.call_authenticated,
+                client, imgur.request.upload_image, client, **kwargs)
+    # not sure what's waiting
+    # pylint: disable=broad-except
+    except Exception as err:
+        cerror("failed to upload image saved from '%s'%s: %s" % (
+            source_url, imgur.retry.attempts_note(getattr(err, 'attempts', 1)),
+            err))
+        return None
+    finally:
+        if 'path' in kwargs:
+            os.remove(image)
+    if attempts > 1:
+        cprogress("%s: uploaded%s" % (source_url,
+                                      imgur.retry.attempts_note(attempts)))
+    if not details:
+        return image_data['link']
+    return dict(image_data, bytes=size, seconds=time.perf_counter() - start,
+                attempts=attempts)
+
+def is_refusal(exc):
+    """Whether an upload error means Imgur refused to fetch a URL.
+
+    Client errors other than 401 Unauthorized and 429 Too Many Requests
+    count as refusals (e.g., private hosts or unsupported content).
+
+    """
+    response = getattr(exc, 'response', None)
+    return (isinstance(exc, requests.HTTPError) and response is not None and
+            400 <= response.status_code < 500 and
+            response.status_code not in (401, 429))
+
+def save_image_direct(client, source_url, directory, retry=None,
+                      details=False):
+    """Have Imgur fetch an image, falling back to download and upload.
+
+    Parameters
+    ----------
+    client : pyimgur.Imgur
+    source_url : str
+    directory : str
+        Directory for tempfiles of large downloads, if falling back.
+    retry : imgur.retry.Policy
+        Retries and timeouts of each request. If None, the defaults of
+        imgur.retry.Policy are used. Default is None.
+    details : bool
+        If True, return image data (see upload_saved_image) instead of
+        uploaded_url; "bytes" is then Imgur's size of the image, if
+        fetched by Imgur. Default is False.
+
+    Returns
+    -------
+    (uploaded_url, route) : tuple
+        uploaded_url is None if failed. route is DIRECT if the source
+        URL was submitted to Imgur as is, or FALLBACK if Imgur refused
+        to fetch it and the image was downloaded and uploaded instead.
+
+    """
+    retry = retry or imgur.retry.Policy()
+    start = time.perf_counter()
+    try:
+        with imgur.metrics.span('upload'), imgur.progress.active():
+            image, attempts = retry.run(
+                imgur.authenticate.call_authenticated,
+                client, imgur.request.upload_image, client, url=source_url)
+        if attempts > 1:
+            cprogress("%s: saved%s" % (source_url,
+                                       imgur.retry.attempts_note(attempts)))
+        if not details:
+            return image['link'], DIRECT
+        return dict(image, bytes=image.get('size'),
+                    seconds=time.perf_counter() - start,
+                    attempts=attempts), DIRECT
+    # pylint: disable=broad-except
+    except Exception as err:
+        if not is_refusal(err):
+            cerror("failed to save '%s'%s: %s" % (
+                source_url,
+                imgur.retry.attempts_note(getattr(err, 'attempts', 1)), err))
+            return None, DIRECT
+    image = download_image(source_url, directory, retry=retry)
+    if image is None:
+        return None, FALLBACK
+    return upload_saved_image(client, source_url, image, retry=retry,
+                              details=details), FALLBACK
+
+class DirectSaver(object):
+    """lambda source_url: save_image_direct(client, source_url, directory)"""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, client, directory, retry=None, details=False):
+        """Init."""
+        self.client = client
+        self.directory = directory
+        self.retry = retry
+        self.details = details
+
+    def __call__(self, source_url):
+        """Call save_image_direct."""
+        return save_image_direct(self.client, source_url, self.directory,
+                                 retry=self.retry, details=self.details)
 
 class Saver(object):
     """Image saver.
@@ -22,41 +257,133 @@ class Saver(object):
 
     """
     # pylint: disable=too-few-public-methods,invalid-name
-    def __init__(self, client, directory):
+    def __init__(self, client, directory, retry=None):
         """Init."""
         self.client = client
         self.directory = directory
+        self.retry = retry
 
     def __call__(self, source_url):
         """Download image from url and upload to Imgur."""
-        fd, savepath = tempfile.mkstemp(dir=self.directory)
-        os.close(fd)
-        try:
-            urllib.request.urlretrieve(source_url, filename=savepath)
-        except OSError:
-            cerror("failed to download '%s'" % source_url)
-            os.remove(savepath)
+        image = download_image(source_url, self.directory, retry=self.retry)
+        if image is None:
             return None
-        try:
-            return self.client.upload_image(savepath).link
-        # not sure what's waiting
-        # pylint: disable=broad-except
-        except Exception:
-            cerror("failed to upload '%s' saved from '%s'" %
-                   (savepath, source_url))
+        return upload_saved_image(self.client, source_url, image,
+                                  retry=self.retry)
+
+class Downloader(object):
+    """lambda source_url: (source_url, download_image(source_url, directory))
+
+    First stage of the save pipeline. Small images are passed on to the
+    upload stage as bytes, large ones as paths to tempfiles.
+
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, directory, retry=None):
+        """Init with the download directory."""
+        self.directory = directory
+        self.retry = retry
+
+    def __call__(self, source_url):
+        """Call download_image."""
+        return source_url, download_image(source_url, self.directory,
+                                          retry=self.retry)
+
+class HashingDownloader(Downloader):
+    """lambda source_url: (source_url, image, pixels)
+
+    Downloader that also computes the thumbnail the image's perceptual
+    hash is computed from (see imgur.similar.thumbnail); pixels is None
+    if the image is not readable.
+
+    """
+    # pylint: disable=too-few-public-methods
+    def __call__(self, source_url):
+        """Call download_image and imgur.similar.thumbnail."""
+        source_url, image = super().__call__(source_url)
+        pixels = None
+        if image is not None:
+            result = imgur.similar.thumbnail(image)
+            if result is not None:
+                pixels = result[0]
+        return source_url, image, pixels
+
+def _discard(image):
+    """Discard an image downloaded with download_image."""
+    if image is not None and not isinstance(image, bytes):
+        os.remove(image)
+
+class SavedUploader(object):
+    """lambda (source_url, image): upload_saved_image(client, ...)
+
+    Second stage of the save pipeline; failed downloads (image None)
+    are passed through as failures.
+
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, client, retry=None, details=False):
+        """Init with a client."""
+        self.client = client
+        self.retry = retry
+        self.details = details
+
+    def __call__(self, download):
+        """Call upload_saved_image."""
+        source_url, image = download
+        if image is None:
             return None
+        return upload_saved_image(self.client, source_url, image,
+                                  retry=self.retry, details=self.details)
 
-def save_images(client, source_urls, jobs=None):
+def save_images(client, source_urls, jobs=None, engine="process",
+                adaptive=False, max_jobs=None, download_jobs=None,
+                direct=False, stats=None, similar=None, retry=None):
     """Retrieve remote images and then upload to Imgur.
 
+    Downloads and uploads run in two separate pools, joined by a
+    bounded queue, so that slow sources being downloaded do not hold up
+    uploads of images already downloaded.
+
     Parameters
     ----------
     source_urls : list
         List of source image URLs.
     jobs : int
-        Number of workers. If None, multiprocessing.cpu_count() * 2 is
-        used. If 0, the number of paths is used (not recommended when
-        paths is a large list). Default is None.
+        Number of upload workers. If None, multiprocessing.cpu_count() *
+        2 is used for the "process" engine, and
+        imgur.engine.DEFAULT_ASYNC_JOBS for the "async" engine. If 0,
+        the number of paths is used (not recommended when paths is a
+        large list). Default is None.
+    engine : {"process", "async"}
+        Worker engine, see imgur.engine. Default is "process".
+    adaptive : bool
+        Whether to adapt the number of concurrent uploads to Imgur's
+        rate limits, starting from jobs and up to max_jobs; see
+        imgur.engine.imap. Default is False.
+    max_jobs : int
+        See imgur.engine.imap.
+    download_jobs : int
+        Number of download workers, interpreted like jobs. If None, the
+        same number as jobs. Default is None.
+    direct : bool
+        If True, submit source URLs to Imgur to fetch server-side, and
+        only download and upload an image if Imgur refuses to fetch it
+        (see save_image_direct). download_jobs is then not used.
+        Default is False.
+    stats : collections.Counter
+        If given, counts how many images were saved by each route,
+        under the keys DIRECT and FALLBACK (with direct), or
+        DOWNLOAD and NEAR_DUPLICATE. Default is None.
+    similar : int
+        If given, a downloaded image whose perceptual hash differs in
+        at most this many bits from that of an image downloaded before
+        (see imgur.similar; requires NumPy and Pillow) is not uploaded,
+        and gets the link of the earlier image instead. Not supported
+        with direct. Default is None.
+    retry : imgur.retry.Policy
+        Retries of transient errors, and timeouts, of each download
+        and upload. If None, the defaults of imgur.retry.Policy are
+        used. Default is None.
 
     Returns
     -------
@@ -64,16 +391,192 @@ def save_images(client, source_urls, jobs=None):
         List of uploaded image URLs; a None element means a failure.
 
     """
-    pool_size = multiprocessing.cpu_count() * 2 if jobs is None else jobs
-    if pool_size == 0:
-        pool_size = len(source_urls)
-    pool = multiprocessing.Pool(processes=pool_size)
+    uploaded_urls = [None] * len(source_urls)
+    for index, uploaded_url in iter_save_images(
+            client, source_urls, jobs=jobs, engine=engine, adaptive=adaptive,
+            max_jobs=max_jobs, download_jobs=download_jobs, direct=direct,
+            stats=stats, similar=similar, retry=retry):
+        uploaded_urls[index] = uploaded_url
+    return uploaded_urls
+
+def iter_save_images(client, source_urls, jobs=None, engine="process",
+                     ordered=False, adaptive=False, max_jobs=None,
+                     download_jobs=None, direct=False, stats=None,
+                     similar=None, retry=None, details=False):
+    """Retrieve remote images and upload them, yielding URLs as they come.
+
+    Parameters are the same as save_images, except that source_urls
+    may be any iterable, consumed lazily; plus
+
+    ordered : bool
+        Whether to yield in the order of source_urls rather than in
+        order of completion. Default is False.
+    details : bool
+        If True, yield image data (see upload_saved_image) instead of
+        URLs. Default is False.
+
+    Yields
+    ------
+    (index, uploaded_url) : tuple
+        uploaded_url is the URL of the image saved from
+        source_urls[index], or None if failed.
+
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    if direct:
+        if similar is not None:
+            raise ValueError("similar is not supported with direct")
+        with tempfile.TemporaryDirectory(prefix="imgur-save-") as directory:
+            for index, (uploaded_url, route) in imgur.engine.imap(
+                    DirectSaver(client, directory, retry=retry,
+                                details=details), source_urls,
+                    jobs=jobs, engine=engine, ordered=ordered,
+                    adaptive=adaptive, max_jobs=max_jobs):
+                if stats is not None:
+                    stats[route] += 1
+                yield index, uploaded_url
+        return
+    results = _iter_save_pipeline(
+        client, source_urls, download_jobs if download_jobs is not None
+        else jobs, dict(jobs=jobs, engine=engine, ordered=ordered,
+                        adaptive=adaptive, max_jobs=max_jobs),
+        stats if stats is not None else collections.Counter(), similar,
+        retry, details)
+    if ordered and similar is not None:
+        # near-duplicates are yielded as soon as their match is done
+        results = imgur.engine.reorder(results)
+    yield from results
+
+def _iter_save_pipeline(client, source_urls, download_jobs, engine_options,
+                        stats, similar, retry, details):
+    """iter_save_images, downloading and uploading in two stages.
+
+    engine_options are keyword arguments to imgur.engine.imap for the
+    upload stage. Images are yielded in completion order, or in the
+    order of source_urls if engine_options["ordered"], except for
+    near-duplicates.
+
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    count = len(source_urls) if hasattr(source_urls, '__len__') else None
+    engine = engine_options['engine']
+    download_pool_size = imgur.engine.get_pool_size(download_jobs, count,
+                                                    engine=engine)
     with tempfile.TemporaryDirectory(prefix="imgur-save-") as directory:
-        return pool.map(Saver(client, directory), source_urls)
+        downloader = (Downloader(directory, retry=retry) if similar is None
+                      else HashingDownloader(directory, retry=retry))
+        downloads = imgur.engine.imap(downloader, source_urls,
+                                      jobs=download_pool_size, engine=engine,
+                                      ordered=engine_options['ordered'])
+        # downloaded images waiting for an upload slot
+        downloads = imgur.engine.pipe(downloads, download_pool_size)
+        # with similar, hashes of images uploaded or being uploaded
+        tree = imgur.similar.BKTree()
+        finished = {}  # index of an uploaded image => its URL
+        # index of an image being uploaded => its near-duplicates, as
+        # (index, download) pairs, kept until it is known to be uploaded
+        aliases = {}
+        promoted = {}  # index of a failed upload => member taking over
+        retried = collections.deque()  # (index, download) of those members
+        ready = collections.deque()  # near-duplicates of finished images
+
+        def group(index, download):
+            """Group a download with a near-duplicate being uploaded or
+            uploaded, if any; return (source_url, image) if it is to be
+            uploaded, or None."""
+            source_url, image, pixels = download
+            if pixels is None:
+                return source_url, image
+            image_hash = imgur.similar.dhash(pixels)
+            match = tree.nearest(image_hash, similar)
+            while match in promoted:
+                match = promoted[match]
+            if match is None:
+                tree.add(image_hash, index)
+            elif match not in finished:
+                aliases.setdefault(match, []).append(
+                    (index, (source_url, image)))
+                return None
+            elif finished[match] is not None:
+                _discard(image)
+                ready.append((index, finished[match]))
+                return None
+            else:
+                # failed, with no member left to take over
+                promoted[match] = index
+            return source_url, image
+
+        def downloaded(index_of):
+            """Downloaded images for the upload stage; index_of maps the
+            indices of the stage to indices in source_urls, as downloads
+            come out in completion order."""
+            upload_index = 0
+            while True:
+                if retried:
+                    index, download = retried.popleft()
+                else:
+                    try:
+                        index, download = next(downloads)
+                    except StopIteration:
+                        return
+                    if similar is not None:
+                        download = group(index, download)
+                        if download is None:
+                            continue
+                index_of[upload_index] = index
+                upload_index += 1
+                yield download
+
+        def near_duplicates():
+            """Yield near-duplicates whose match is done."""
+            while ready:
+                stats[NEAR_DUPLICATE] += 1
+                yield ready.popleft()
+
+        def upload_stage(count):
+            """Upload downloaded images, yielding (index, url) pairs."""
+            index_of = {}
+            uploads = imgur.engine.imap(
+                SavedUploader(client, retry=retry, details=details),
+                downloaded(index_of), count=count, **engine_options)
+            try:
+                for upload_index, uploaded_url in uploads:
+                    index = index_of.pop(upload_index)
+                    stats[DOWNLOAD] += 1
+                    yield index, uploaded_url
+                    if similar is not None:
+                        finished[index] = uploaded_url
+                        members = aliases.pop(index, [])
+                        if uploaded_url is not None:
+                            for alias, (_, image) in members:
+                                _discard(image)
+                                ready.append((alias, uploaded_url))
+                        elif members:
+                            # the next member of the group is uploaded
+                            # in its place
+                            promoted[index] = members[0][0]
+                            retried.append(members[0])
+                            if len(members) > 1:
+                                aliases[members[0][0]] = members[1:]
+                    yield from near_duplicates()
+            finally:
+                uploads.close()
+
+        try:
+            yield from upload_stage(count)
+            # members taking over after the downloads ran out
+            while retried:
+                yield from upload_stage(len(retried))
+            yield from near_duplicates()
+        finally:
+            downloads.close()
+            for members in aliases.values():
+                for _, (_, image) in members:
+                    _discard(image)
 
 def main():
     """CLI interface."""
-    imgur.cli.cli("save")
+    return imgur.cli.cli("save")
 
 if __name__ == "__main__":
     main()
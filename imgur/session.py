@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+"""Library interface: upload sessions yielding result records.
+
+For programs that upload images without going through imgur-upload::
+
+    import imgur.session
+
+    with imgur.session.Session() as session:
+        for result in session.upload(['a.png', b'...', 'https://...']):
+            if result.ok:
+                print(result.source, result.link, result.deletehash)
+            else:
+                print(result.source, result.error, result.message)
+
+Items may be paths, http(s) URLs (submitted for Imgur to fetch, or
+downloaded and uploaded if Imgur refuses, as imgur-save --direct
+does), or in-memory images (bytes-like or binary file objects). Every
+item yields a Result, as soon as it completes; nothing is printed.
+
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+import imgur.authenticate
+import imgur.engine
+import imgur.metrics
+import imgur.progress
+import imgur.request
+import imgur.retry
+import imgur.save
+
+class SessionError(Exception):
+    """Session could not be set up."""
+
+class Result(object):
+    """Outcome of an item of Session.upload.
+
+    Attributes
+    ----------
+    index : int
+        Position of the item in the items given to Session.upload.
+    source : str
+        Path or URL of the item; None for in-memory images.
+    link : str
+        URI of the uploaded image (HTTP), or None if failed.
+    deletehash : str
+    bytes : int
+        Size of the image uploaded, if known.
+    seconds : float
+        Time spent on the item by its worker, retries included.
+    latency : float
+        Time from the submission of the item until its result, queueing
+        included.
+    attempts : int
+        Number of attempts of the last request.
+    error : str
+        Class name of the exception the item failed with (e.g.,
+        "HTTPError"), or None.
+    message : str
+        Message of the exception, or None.
+
+    """
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    __slots__ = ('index', 'source', 'link', 'deletehash', 'bytes',
+                 'seconds', 'latency', 'attempts', 'error', 'message')
+
+    def __init__(self, link=None, deletehash=None, size=None, seconds=None,
+                 attempts=1, error=None, message=None):
+        """Init; index, source and latency are filled in by Session."""
+        # pylint: disable=too-many-arguments
+        self.index = None
+        self.source = None
+        self.link = link
+        self.deletehash = deletehash
+        self.bytes = size
+        self.seconds = seconds
+        self.latency = None
+        self.attempts = attempts
+        self.error = error
+        self.message = message
+
+    @property
+    def ok(self):  # pylint: disable=invalid-name
+        """Whether the item was uploaded."""
+        return self.link is not None
+
+    def __repr__(self):
+        return 'Result(%s)' % ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+
+def _is_url(source):
+    """Whether a string item is a URL rather than a path."""
+    return source.startswith(('http://', 'https://'))
+
+class _Job(object):
+    """Upload an item, returning a Result; run by the engine."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, client, directory, retry):
+        """Init with a client, a directory for tempfiles and a retry
+        policy."""
+        self.client = client
+        self.directory = directory
+        self.retry = retry
+
+    def _upload(self, **kwargs):
+        """Upload with retries; return (image data, attempts)."""
+        return self.retry.run(
+            imgur.authenticate.call_authenticated, self.client,
+            imgur.request.upload_image, self.client, **kwargs)
+
+    def _upload_item(self, item):
+        """Upload an item; return (image data, attempts, size)."""
+        if isinstance(item, bytes):
+            return self._upload(data=item) + (len(item),)
+        if not _is_url(item):
+            return self._upload(path=item, title=os.path.basename(item)) + (
+                os.path.getsize(item),)
+        try:
+            image, attempts = self._upload(url=item)
+            return image, attempts, image.get('size')
+        except Exception as err:  # pylint: disable=broad-except
+            if not imgur.save.is_refusal(err):
+                raise
+        # refused by Imgur; download and upload, as imgur-save --direct
+        # pylint: disable=protected-access
+        image, _ = self.retry.run(imgur.save._download, item, self.directory)
+        if isinstance(image, bytes):
+            return self._upload(data=image) + (len(image),)
+        try:
+            return self._upload(path=image) + (os.path.getsize(image),)
+        finally:
+            os.remove(image)
+
+    def __call__(self, item):
+        """Upload a path, URL or bytes."""
+        start = time.perf_counter()
+        try:
+            with imgur.metrics.span('upload'), imgur.progress.active():
+                image, attempts, size = self._upload_item(item)
+        except Exception as err:  # pylint: disable=broad-except
+            return Result(seconds=time.perf_counter() - start,
+                          attempts=getattr(err, 'attempts', 1),
+                          error=type(err).__name__, message=str(err))
+        return Result(link=image['link'], deletehash=image.get('deletehash'),
+                      size=size, seconds=time.perf_counter() - start,
+                      attempts=attempts)
+
+class Session(object):
+    """Upload session.
+
+    Holds a client and settings for any number of Session.upload
+    batches. Use as a context manager, or call close when done.
+
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, client=None, anonymous=False, jobs=None,
+                 engine="async", ordered=False, adaptive=False,
+                 max_jobs=None, retry=None, profiles=None):
+        """Init.
+
+        Parameters
+        ----------
+        client : pyimgur.Imgur or imgur.profiles.Rotation
+            If None, a client is generated with
+            imgur.authenticate.gen_client(anonymous, profiles).
+        anonymous : bool
+            Default is False.
+        jobs : int
+            Number of concurrent uploads; see imgur.engine.imap.
+        engine : {"process", "async"}
+            Default is "async", which runs uploads on threads of the
+            calling process, rather than forking it.
+        ordered : bool
+            Yield results in the order of items rather than as they
+            complete. Default is False.
+        adaptive : bool
+        max_jobs : int
+            See imgur.engine.imap.
+        retry : imgur.retry.Policy
+            Retries and timeouts. If None, the defaults of
+            imgur.retry.Policy are used.
+        profiles : list
+            Names of the credential profiles to generate the client
+            with. Default is None, i.e., all profiles configured.
+
+        Raises
+        ------
+        SessionError
+            If no client is given and none could be generated.
+
+        """
+        # pylint: disable=too-many-arguments
+        if client is None:
+            client = imgur.authenticate.gen_client(anonymous=anonymous,
+                                                   profiles=profiles)
+            if client is None:
+                raise SessionError("failed to create client")
+        self.client = client
+        self.engine_options = dict(jobs=jobs, engine=engine, ordered=ordered,
+                                   adaptive=adaptive, max_jobs=max_jobs)
+        self.retry = retry or imgur.retry.Policy()
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-session-")
+        self.cancelled = threading.Event()
+        self.running = set()  # generators of ongoing uploads
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _submit(self, items, submitted):
+        """Items as sent to workers; keep sources and submission times."""
+        for i, item in enumerate(items):
+            if self.cancelled.is_set():
+                return
+            if hasattr(item, 'read'):
+                item = item.read()
+            if isinstance(item, str):
+                submitted[i] = (item, time.perf_counter())
+            else:
+                item = bytes(item)
+                submitted[i] = (None, time.perf_counter())
+            yield item
+
+    def upload(self, items):
+        """Upload items, yielding results as they complete.
+
+        Parameters
+        ----------
+        items : iterable
+            Paths, URLs, bytes-like objects or binary file objects;
+            consumed lazily.
+
+        Yields
+        ------
+        result : Result
+
+        """
+        submitted = {}  # index => (source, time of submission)
+        results = imgur.engine.imap(
+            _Job(self.client, self.directory.name, self.retry),
+            self._submit(items, submitted),
+            count=len(items) if hasattr(items, '__len__') else None,
+            **self.engine_options)
+        self.running.add(results)
+        try:
+            for index, result in results:
+                source, submitted_at = submitted.pop(index)
+                result.index = index
+                result.source = source
+                result.latency = time.perf_counter() - submitted_at
+                yield result
+        finally:
+            self.running.discard(results)
+            results.close()
+
+    def cancel(self):
+        """Stop submitting items; may be called from any thread.
+
+        Uploads already in flight still complete and yield their
+        results, then the iteration of Session.upload ends. A cancelled
+        session uploads nothing more.
+
+        """
+        self.cancelled.set()
+
+    def close(self):
+        """Cancel, stop all workers without waiting for uploads in
+        flight, and remove tempfiles.
+
+        Should be called from the thread iterating over Session.upload,
+        if any; from other threads, use cancel.
+
+        """
+        self.cancel()
+        for results in list(self.running):
+            results.close()
+        self.directory.cleanup()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""Perceptual-hash grouping of near-duplicate images.
+
+Re-encodes, resizes and thumbnails of the same picture have different
+bytes but nearly the same difference hash (dHash): each image is
+shrunk to a (HASH_SIZE + 1) x HASH_SIZE grayscale thumbnail, and each
+bit of the hash says whether a pixel is brighter than its left
+neighbor. Images whose hashes differ in at most a threshold number of
+bits are considered near-duplicates. Hashes are indexed in a BK-tree,
+so that finding the near-duplicates of an image does not take a scan
+of all the others.
+
+This requires NumPy and Pillow, which are optional dependencies;
+install with::
+
+    pip install .[similar]
+
+"""
+
+import io
+import os
+
+import imgur.engine
+import imgur.metrics
+
+HASH_SIZE = 8
+
+# maximum Hamming distance between hashes of near-duplicates, out of
+# HASH_SIZE ** 2 bits
+DEFAULT_THRESHOLD = 6
+
+def is_available():
+    """Whether NumPy and Pillow are installed."""
+    try:
+        # pylint: disable=unused-variable
+        import numpy
+        import PIL.Image
+        return True
+    except ImportError:
+        return False
+
+def thumbnail(source):
+    """Shrink an image to the grayscale thumbnail dHash is computed from.
+
+    Parameters
+    ----------
+    source : str or bytes
+        Path to the image, or its content.
+
+    Returns
+    -------
+    (pixels, pixel_count) : tuple
+        pixels is a HASH_SIZE x (HASH_SIZE + 1) numpy.ndarray of uint8,
+        and pixel_count the number of pixels of the original image. None
+        if the image cannot be read.
+
+    """
+    import numpy
+    import PIL.Image
+
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with imgur.metrics.span('hash'):
+        try:
+            with PIL.Image.open(source) as image:
+                pixel_count = image.size[0] * image.size[1]
+                # let JPEGs be decoded at reduced scale
+                image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+                small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE),
+                                                  PIL.Image.LANCZOS)
+                return numpy.asarray(small, dtype=numpy.uint8), pixel_count
+        except (OSError, ValueError, SyntaxError):
+            return None
+
+def dhash(pixels):
+    """Compute difference hashes of thumbnails.
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        A thumbnail (see thumbnail), or a stack of N of them, of shape
+        (N, HASH_SIZE, HASH_SIZE + 1).
+
+    Returns
+    -------
+    image_hash : int or list
+        A HASH_SIZE ** 2 bit hash, or a list of N of them.
+
+    """
+    import numpy
+
+    pixels = numpy.asarray(pixels)
+    bits = pixels[..., 1:] > pixels[..., :-1]
+    packed = numpy.packbits(bits.reshape(bits.shape[:-2] + (-1,)), axis=-1)
+    return packed.view('>u%d' % (HASH_SIZE ** 2 // 8))[..., 0].tolist()
+
+def hamming(hash1, hash2):
+    """Number of bits two hashes differ in."""
+    return bin(hash1 ^ hash2).count('1')
+
+class BKTree(object):
+    """Burkhard-Keller tree of hashes under the Hamming distance.
+
+    Searching within a small radius only visits the few subtrees whose
+    distance to a node is compatible with the triangle inequality.
+
+    """
+
+    def __init__(self):
+        self.root = None  # [hash, value, {distance: child}]
+
+    def add(self, image_hash, value):
+        """Add a hash, labeled with value."""
+        node = [image_hash, value, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(image_hash, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, image_hash, radius):
+        """Find hashes within radius.
+
+        Returns
+        -------
+        matches : list
+            List of (distance, value) tuples.
+
+        """
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(image_hash, node[0])
+            if distance <= radius:
+                matches.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return matches
+
+    def nearest(self, image_hash, radius):
+        """Value of the nearest hash within radius, or None."""
+        matches = self.search(image_hash, radius)
+        if not matches:
+            return None
+        return min(matches, key=lambda match: match[0])[1]
+
+def hash_images(paths, jobs=None):
+    """Hash images, decoding them in a process pool.
+
+    Parameters
+    ----------
+    paths : list
+    jobs : int
+        Number of worker processes. If None, os.cpu_count() is used.
+
+    Returns
+    -------
+    hashes : list
+        List of (image_hash, pixel_count) tuples in the order of paths;
+        None for unreadable images.
+
+    """
+    import numpy
+
+    thumbnails = [None] * len(paths)
+    for i, result in imgur.engine.imap(
+            thumbnail, paths, jobs=jobs or os.cpu_count() or 1):
+        thumbnails[i] = result
+    readable = [i for i, result in enumerate(thumbnails) if result is not None]
+    hashes = [None] * len(paths)
+    if readable:
+        # one vectorized pass over the whole batch
+        stack = numpy.stack([thumbnails[i][0] for i in readable])
+        for i, image_hash in zip(readable, dhash(stack)):
+            hashes[i] = (image_hash, thumbnails[i][1])
+    return hashes
+
+def group_similar(hashes, threshold=DEFAULT_THRESHOLD):
+    """Group near-duplicates.
+
+    Each image joins the group whose first image has the nearest hash
+    within threshold, or starts a new group.
+
+    Parameters
+    ----------
+    hashes : list
+        Hashes, or None for images to be left in groups of their own.
+    threshold : int
+        Default is DEFAULT_THRESHOLD.
+
+    Returns
+    -------
+    groups : list
+        Lists of indices in hashes, in order of their first members.
+
+    """
+    tree = BKTree()
+    groups = []
+    for i, image_hash in enumerate(hashes):
+        if image_hash is not None:
+            group = tree.nearest(image_hash, threshold)
+            if group is not None:
+                groups[group].append(i)
+                continue
+            tree.add(image_hash, len(groups))
+        groups.append([i])
+    return groups
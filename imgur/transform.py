@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""Client-side resizing and recompression before upload.
+
+Large camera PNGs and TIFFs are mostly wasted bandwidth, since Imgur
+recompresses them anyway, and files over its size limits are rejected
+outright. A Policy says what to do with them: downscale to a maximum
+dimension, losslessly optimize PNGs, and/or convert files above a size
+threshold to JPEG or WebP.
+
+Transforms are CPU-bound, so imgur.upload runs them in their own
+process pool, apart from the workers doing network I/O.
+
+This requires Pillow, which is an optional dependency; install with::
+
+    pip install .[transform]
+
+"""
+
+import collections
+import os
+import tempfile
+import time
+
+import imgur.metrics
+
+# formats that are transformed; others (e.g., possibly animated GIFs)
+# are uploaded as is
+TRANSFORMABLE = ('PNG', 'JPEG', 'TIFF', 'BMP', 'WEBP')
+
+CONVERSIONS = ('jpeg', 'webp')
+
+DEFAULT_QUALITY = 85
+
+Transformed = collections.namedtuple('Transformed', [
+    'source',  # original path
+    'path',  # path to upload; source itself if left alone
+    'original_size',  # in bytes
+    'size',  # in bytes
+    'seconds',  # time spent
+    'error',  # why the image could not be read, or None
+])
+
+def is_available():
+    """Whether Pillow is installed."""
+    try:
+        import PIL.Image  # pylint: disable=unused-variable
+        return True
+    except ImportError:
+        return False
+
+def get_pool_size():
+    """Number of transform workers: one per CPU core."""
+    return os.cpu_count() or 1
+
+class Policy(object):
+    """What to do with images before upload."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, max_dimension=None, optimize_png=False, convert=None,
+                 convert_above=0, quality=DEFAULT_QUALITY):
+        """Init.
+
+        Parameters
+        ----------
+        max_dimension : int
+            If given, images wider or taller than this many pixels are
+            downscaled to fit, keeping the aspect ratio.
+        optimize_png : bool
+            Whether to re-encode PNGs with maximum lossless
+            compression. Default is False.
+        convert : {"jpeg", "webp"}
+            If given, convert images larger than convert_above to this
+            format. Images with transparency are not converted to
+            JPEG.
+        convert_above : int
+            Size threshold of convert, in bytes. Default is 0.
+        quality : int
+            JPEG or WebP quality, 1 to 100. Default is DEFAULT_QUALITY.
+
+        """
+        # pylint: disable=too-many-arguments
+        if convert is not None and convert not in CONVERSIONS:
+            raise ValueError("unknown conversion '%s'" % convert)
+        self.max_dimension = max_dimension
+        self.optimize_png = optimize_png
+        self.convert = convert
+        self.convert_above = convert_above
+        self.quality = quality
+
+    def __bool__(self):
+        return bool(self.max_dimension or self.optimize_png or self.convert)
+
+def _has_alpha(image):
+    """Whether a Pillow image has transparency."""
+    return image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+
+def transform_image(path, policy, directory):
+    """Transform an image according to a policy.
+
+    The result is written to a new file in directory, unless there was
+    nothing to do, the image could not be read, or the result would be
+    larger than the original without having been downscaled; the
+    original is then to be uploaded as is.
+
+    Parameters
+    ----------
+    path : str
+    policy : Policy
+    directory : str
+
+    Returns
+    -------
+    transformed : Transformed
+        With error set, and nothing to upload, if the image could not
+        be read at all.
+
+    """
+    # pylint: disable=too-many-locals
+    import PIL.Image
+
+    start = time.perf_counter()
+    try:
+        original_size = os.path.getsize(path)
+    except OSError as err:
+        # e.g., gone since it was listed; fails this image only
+        return Transformed(path, path, 0, 0, time.perf_counter() - start,
+                           str(err))
+
+    def unchanged():
+        """Result for the original left alone."""
+        return Transformed(path, path, original_size, original_size,
+                           time.perf_counter() - start, None)
+
+    try:
+        with PIL.Image.open(path) as image:
+            if image.format not in TRANSFORMABLE:
+                return unchanged()
+            image_format = image.format
+            resized = False
+            if (policy.max_dimension and
+                    max(image.size) > policy.max_dimension):
+                image.thumbnail((policy.max_dimension, policy.max_dimension),
+                                PIL.Image.LANCZOS)
+                resized = True
+
+            if (policy.convert and original_size > policy.convert_above and
+                    not (policy.convert == 'jpeg' and _has_alpha(image))):
+                image_format = policy.convert.upper()
+            elif image_format in ('TIFF', 'BMP') and resized:
+                image_format = 'PNG'
+            elif not (resized or
+                      (image_format == 'PNG' and policy.optimize_png)):
+                return unchanged()
+
+            options = {}
+            for key in ('exif', 'icc_profile'):
+                if key in image.info:
+                    options[key] = image.info[key]
+            if image_format == 'JPEG':
+                if image.mode not in ('RGB', 'L', 'CMYK'):
+                    image = image.convert('RGB')
+                options.update(quality=policy.quality, optimize=True)
+            elif image_format == 'WEBP':
+                options.update(quality=policy.quality)
+            elif image_format == 'PNG':
+                options.update(optimize=True)
+
+            extension = '.jpg' if image_format == 'JPEG' else (
+                '.' + image_format.lower())
+            fd, savepath = tempfile.mkstemp(suffix=extension, dir=directory)
+            with os.fdopen(fd, 'wb') as fileobj:
+                image.save(fileobj, image_format, **options)
+    except (OSError, ValueError, SyntaxError):
+        # not readable by Pillow; let Imgur decide
+        return unchanged()
+
+    size = os.path.getsize(savepath)
+    if size >= original_size and not resized:
+        os.remove(savepath)
+        return unchanged()
+    return Transformed(path, savepath, original_size, size,
+                       time.perf_counter() - start, None)
+
+class Transformer(object):
+    """lambda path: transform_image(path, policy, directory)"""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, policy, directory):
+        """Init with a policy and a directory for transformed images."""
+        self.policy = policy
+        self.directory = directory
+
+    def __call__(self, path):
+        """Call transform_image."""
+        with imgur.metrics.span('transform'):
+            return transform_image(path, self.policy, self.directory)
@@ -4,22 +4,47 @@
 
 # pylint: disable=wildcard-import,unused-wildcard-import
 
-import multiprocessing
 import os
+import tempfile
+import time
 
 import imgur.authenticate
 import imgur.cli
+import imgur.dedup
+import imgur.engine
+import imgur.metrics
+import imgur.progress
+import imgur.request
+import imgur.retry
+import imgur.similar
+import imgur.transform
+import imgur.validate
 
 from zmwangx.colorout import *
 
-def upload_image(client, path):
+def upload_image(client, path, details=False, source=None, retry=None):
     """Upload a single image.
 
+    Transient errors are retried according to retry; an image uploaded
+    after retries is reported with the number of attempts it took.
+
     Parameters
     ----------
     client : pyimgur.Imgur
     path : str
         Path to the image.
+    details : bool
+        If True, return Imgur's full image data (a dict with "link",
+        "deletehash", etc.), plus the size of the file uploaded
+        ("bytes"), the time the upload took ("seconds") and the number
+        of attempts ("attempts"), instead of just the URI. Default is
+        False.
+    source : str
+        Path to the original image, if path is a transformed copy; used
+        for the title and error messages. Default is None.
+    retry : imgur.retry.Policy
+        Retries and timeouts. If None, the defaults of
+        imgur.retry.Policy are used. Default is None.
 
     Returns
     -------
@@ -29,29 +54,139 @@ def upload_image(client, path):
 
     """
 
-    title = os.path.basename(path)
+    source = source or path
+    title = os.path.basename(source)
+    retry = retry or imgur.retry.Policy()
+    start = time.perf_counter()
     try:
-        return client.upload_image(path, title=title).link
+        with imgur.metrics.span('upload'), imgur.progress.active():
+            image, attempts = retry.run(
+                imgur.authenticate.call_authenticated,
+                client, imgur.request.upload_image, client, path=path,
+                title=title)
     # pylint: disable=broad-except
-    except Exception:  # no sure what kind of exception will occur
-        cerror("failed to upload %s" % path)
+    except Exception as err:  # no sure what kind of exception will occur
+        cerror("failed to upload %s%s: %s" % (
+            source, imgur.retry.attempts_note(getattr(err, 'attempts', 1)),
+            err))
         return None
+    if attempts > 1:
+        cprogress("%s: uploaded%s" % (source,
+                                      imgur.retry.attempts_note(attempts)))
+    if not details:
+        return image['link']
+    return dict(image, bytes=os.path.getsize(path),
+                seconds=time.perf_counter() - start, attempts=attempts)
 
 # define a one-parameter version of upload_image for
 # multiprocessing.Pool.map()
 # equivalent to (lambda path: upload_image(client, path))
 class Uploader(object):
-    """lambda path: upload_image(client, path)"""
+    """lambda path: upload_image(client, path, details, retry=retry)"""
     # pylint: disable=too-few-public-methods
-    def __init__(self, client):
+    def __init__(self, client, details=False, retry=None):
         """Init with a client."""
         self.client = client
+        self.details = details
+        self.retry = retry
 
     def __call__(self, path):
         """Call upload_image."""
-        return upload_image(self.client, path)
+        return upload_image(self.client, path, details=self.details,
+                            retry=self.retry)
+
+class TransformedUploader(object):
+    """Upload an imgur.transform.Transformed image, then remove the copy.
+
+    lambda transformed: upload_image(client, transformed.path, ...)
+
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, client, details=False, retry=None):
+        """Init with a client."""
+        self.client = client
+        self.details = details
+        self.retry = retry
+
+    def __call__(self, transformed):
+        """Call upload_image."""
+        if transformed.error is not None:
+            cerror("failed to upload %s: %s" % (transformed.source,
+                                                transformed.error))
+            return None
+        try:
+            return upload_image(self.client, transformed.path,
+                                details=self.details,
+                                source=transformed.source, retry=self.retry)
+        finally:
+            if transformed.path != transformed.source:
+                os.remove(transformed.path)
+
+def _imap_upload(client, paths, engine_options, details=False,
+                 transform=None, stats=None, retry=None):
+    """imgur.engine.imap of upload_image, with an optional transform stage.
+
+    engine_options are keyword arguments to imgur.engine.imap. See
+    iter_upload_images for transform, stats and retry.
+
+    """
+    # pylint: disable=too-many-arguments
+    if not transform:
+        return imgur.engine.imap(
+            Uploader(client, details=details, retry=retry), paths,
+            **engine_options)
+    return _imap_transformed_upload(client, paths, engine_options, details,
+                                    transform, stats, retry)
+
+def _imap_transformed_upload(client, paths, engine_options, details,
+                             transform, stats, retry):
+    """_imap_upload with a transform stage.
+
+    Images are transformed in a process pool of their own (see
+    imgur.transform.get_pool_size), joined to the upload stage by a
+    bounded queue, as in imgur.save.iter_save_images.
+
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    count = len(paths) if hasattr(paths, '__len__') else None
+    pool_size = min(imgur.transform.get_pool_size(), count or float('inf'))
+    with tempfile.TemporaryDirectory(prefix="imgur-upload-") as directory:
+        transformed_images = imgur.engine.imap(
+            imgur.transform.Transformer(transform, directory), paths,
+            jobs=pool_size, engine="process",
+            ordered=engine_options.get('ordered', False))
+        transformed_images = imgur.engine.pipe(transformed_images, pool_size)
+        index_of = {}  # upload stage index => index in paths
+
+        def transformed():
+            """Transformed images for the upload stage."""
+            for upload_index, (index, image) in enumerate(transformed_images):
+                index_of[upload_index] = index
+                if image.path != image.source:
+                    cprogress("%s: %s -> %s in %.2fs" % (
+                        image.source,
+                        imgur.validate.human_size(image.original_size),
+                        imgur.validate.human_size(image.size), image.seconds))
+                if stats is not None:
+                    stats['transformed'] += image.path != image.source
+                    stats['original_bytes'] += image.original_size
+                    stats['bytes'] += image.size
+                    stats['transform_seconds'] += image.seconds
+                yield image
+
+        uploads = imgur.engine.imap(
+            TransformedUploader(client, details, retry=retry), transformed(),
+            count=count, **engine_options)
+        try:
+            for upload_index, result in uploads:
+                yield index_of.pop(upload_index), result
+        finally:
+            uploads.close()
+            transformed_images.close()
 
-def upload_images(client, paths, jobs=None):
+def upload_images(client, paths, jobs=None, engine="process", index=None,
+                  adaptive=False, max_jobs=None, transform=None, stats=None,
+                  similar=None, retry=None):
     """Upload images using a pool of workers.
 
     Parameters
@@ -61,8 +196,42 @@ def upload_images(client, paths, jobs=None):
         List of image paths.
     jobs : int
         Number of workers. If None, multiprocessing.cpu_count() * 2 is
-        used. If 0, the number of paths is used (not recommended when
-        paths is a large list). Default is None.
+        used for the "process" engine, and
+        imgur.engine.DEFAULT_ASYNC_JOBS for the "async" engine. If 0,
+        the number of paths is used (not recommended when paths is a
+        large list). Default is None.
+    engine : {"process", "async"}
+        Worker engine, see imgur.engine. Default is "process".
+    index : imgur.dedup.DedupIndex
+        If given, files whose content is already in the index are not
+        uploaded again, and their indexed links are returned instead;
+        identical files within paths are uploaded only once. Newly
+        uploaded images are added to the index. Default is None.
+    adaptive : bool
+        Whether to adapt the number of concurrent jobs to Imgur's rate
+        limits, starting from jobs and up to max_jobs; see
+        imgur.engine.imap. Default is False.
+    max_jobs : int
+        See imgur.engine.imap.
+    transform : imgur.transform.Policy
+        If given, images are resized or recompressed according to this
+        policy before upload, in a separate process pool (requires
+        Pillow). Default is None.
+    stats : collections.Counter
+        If given with transform, counts the images transformed
+        ("transformed"), their total size before and after
+        ("original_bytes" and "bytes"), and the time spent
+        ("transform_seconds"). Default is None.
+    similar : int
+        If given, near-duplicate images (re-encodes, resizes, etc.)
+        are grouped by perceptual hashes differing in at most this
+        many bits (see imgur.similar; requires NumPy and Pillow), and
+        only the largest image of each group is uploaded; every image
+        of the group gets its link. Default is None.
+    retry : imgur.retry.Policy
+        Retries of transient errors, and timeouts, of each upload. If
+        None, the defaults of imgur.retry.Policy are used. Default is
+        None.
 
     Returns
     -------
@@ -72,16 +241,166 @@ def upload_images(client, paths, jobs=None):
 
     """
 
-    pool_size = (min(multiprocessing.cpu_count() * 2, len(paths))
-                 if jobs is None else jobs)
-    if pool_size == 0:
-        pool_size = len(paths)
-    pool = multiprocessing.Pool(processes=pool_size)
-    return pool.map(Uploader(client), paths)
+    # pylint: disable=too-many-arguments
+    if index is None and not transform and similar is None:
+        return imgur.engine.map_jobs(Uploader(client, retry=retry), paths,
+                                     jobs=jobs, engine=engine,
+                                     adaptive=adaptive, max_jobs=max_jobs)
+    uris = [None] * len(paths)
+    for i, uri in iter_upload_images(client, paths, jobs=jobs,
+                                     engine=engine, index=index,
+                                     adaptive=adaptive, max_jobs=max_jobs,
+                                     transform=transform, stats=stats,
+                                     similar=similar, retry=retry):
+        uris[i] = uri
+    return uris
+
+def iter_upload_images(client, paths, jobs=None, engine="process",
+                       ordered=False, index=None, adaptive=False,
+                       max_jobs=None, transform=None, stats=None,
+                       similar=None, retry=None, details=False):
+    """Upload images using a pool of workers, yielding URIs as they come.
+
+    Parameters are the same as upload_images, except that paths may
+    be any iterable, consumed lazily, unless index or similar is given;
+    plus
+
+    ordered : bool
+        Whether to yield in the order of paths rather than in order of
+        completion. Default is False.
+    details : bool
+        If True, yield image data (see upload_image) instead of URIs;
+        images already in index only have "link" and "deletehash".
+        Default is False.
+
+    Yields
+    ------
+    (index, uri) : tuple
+        uri is the URI of the uploaded paths[index] (HTTP), or None if
+        failed.
+
+    """
+
+    # pylint: disable=too-many-arguments
+    engine_options = dict(jobs=jobs, engine=engine, ordered=ordered,
+                          adaptive=adaptive, max_jobs=max_jobs)
+    if similar is not None:
+        return _iter_upload_similar(client, paths, similar, engine_options,
+                                    index=index, transform=transform,
+                                    stats=stats, retry=retry, details=details)
+    if index is None:
+        return _imap_upload(client, paths, engine_options, details=details,
+                            transform=transform, stats=stats, retry=retry)
+    return _iter_upload_dedup(client, paths, index, engine_options,
+                              transform=transform, stats=stats, retry=retry,
+                              details=details)
+
+def _iter_upload_similar(client, paths, threshold, engine_options,
+                         index=None, transform=None, stats=None, retry=None,
+                         details=False):
+    """iter_upload_images with near-duplicates uploaded once.
+
+    engine_options are keyword arguments to imgur.engine.imap.
+
+    """
+    # pylint: disable=too-many-arguments
+    hashes = imgur.similar.hash_images(paths)
+    groups = imgur.similar.group_similar(
+        [entry[0] if entry is not None else None for entry in hashes],
+        threshold)
+    # the largest image of a group is the one to upload
+    representatives = [
+        max(group, key=lambda i: hashes[i][1] if hashes[i] else 0)
+        for group in groups]
+    cprogress("skipping %d of %d images as near-duplicates" %
+              (len(paths) - len(groups), len(paths)))
+
+    uploads = iter_upload_images(
+        client, [paths[i] for i in representatives], index=index,
+        transform=transform, stats=stats, retry=retry, details=details,
+        **dict(engine_options, ordered=False))
+    results = ((i, uri) for j, uri in uploads for i in groups[j])
+    if engine_options['ordered']:
+        results = imgur.engine.reorder(results)
+    return results
+
+def _iter_upload_dedup(client, paths, index, engine_options,
+                       transform=None, stats=None, retry=None, details=False):
+    """iter_upload_images with a dedup index.
+
+    engine_options are keyword arguments to imgur.engine.imap. Files
+    are deduplicated by their original content, before any transform.
+
+    """
+    # pylint: disable=too-many-arguments,too-many-locals,too-many-branches
+    ordered = engine_options['ordered']
+    digests = imgur.dedup.hash_files(paths)
+    cached = {}  # index in paths => indexed link
+    first_occurrences = {}  # digest => index of the copy to upload
+    duplicates = {}  # index of the copy to upload => indices of copies
+    to_upload = []  # indices in paths
+    for i, digest in enumerate(digests):
+        if digest is None:
+            # unreadable; let the upload fail and report
+            to_upload.append(i)
+        elif digest in first_occurrences:
+            duplicates.setdefault(first_occurrences[digest], []).append(i)
+        else:
+            indexed = index.lookup(digest)
+            if indexed is not None:
+                link, deletehash = indexed
+                cached[i] = ({'link': link, 'deletehash': deletehash}
+                             if details else link)
+                duplicates[i] = []
+            else:
+                to_upload.append(i)
+            first_occurrences[digest] = i
+    cprogress("skipping %d of %d images already uploaded or duplicated" %
+              (len(paths) - len(to_upload), len(paths)))
+
+    uploads = iter(())
+    if to_upload:
+        uploads = _imap_upload(client, [paths[i] for i in to_upload],
+                               engine_options, details=True,
+                               transform=transform, stats=stats, retry=retry)
+
+    def finish(j, image):
+        """Index an uploaded image; return (index in paths, uri)."""
+        i = to_upload[j]
+        if image is None:
+            return i, None
+        if digests[i] is not None:
+            index.add(digests[i], image['link'], image.get('deletehash'))
+        return i, image if details else image['link']
+
+    if ordered:
+        uris = {}  # index of an uploaded copy => uri, for its duplicates
+        duplicate_of = {dup: i for i, dups in duplicates.items()
+                        for dup in dups}
+        for i in range(len(paths)):
+            if i in cached:
+                uri = cached[i]
+            elif i in duplicate_of:
+                uri = uris[duplicate_of[i]]
+            else:
+                _, uri = finish(*next(uploads))
+            if duplicates.get(i):
+                uris[i] = uri
+            yield i, uri
+    else:
+        for i, uri in cached.items():
+            yield i, uri
+            for dup in duplicates[i]:
+                yield dup, uri
+        for j, image in uploads:
+            i, uri = finish(j, image)
+            yield i, uri
+            for dup in duplicates.get(i, ()):
+                yield dup, uri
 
 def main():
     """CLI interface."""
-    imgur.cli.cli("upload")
+    return imgur.cli.cli("upload")
 
 if __name__ == "__main__":
     main()
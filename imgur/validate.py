@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+"""Pre-flight validation of images before upload.
+
+Imgur only tells us that a file is missing, not an image, or too large
+after it has been sent, at the cost of a round trip and API credits.
+validate_image checks all of that locally from the first few bytes of
+the file: the format is sniffed from its magic bytes, the size checked
+against the limit for that format, and the dimensions read from the
+header, without decoding the image. Videos Imgur accepts (MP4,
+QuickTime, WebM, Matroska, AVI and FLV) are recognized by their
+container, and only their size is checked.
+
+"""
+
+import collections
+import functools
+import os
+import struct
+
+import imgur.engine
+import imgur.metrics
+
+# Imgur's size limits; formats not listed here are limited to MAX_SIZE
+MAX_SIZE = 20 * 1024 * 1024
+VIDEO_MAX_SIZE = 200 * 1024 * 1024
+VIDEO_TYPES = ('mp4', 'mov', 'webm', 'mkv', 'avi', 'flv')
+SIZE_LIMITS = dict({'gif': 200 * 1024 * 1024},
+                   **{video_type: VIDEO_MAX_SIZE
+                      for video_type in VIDEO_TYPES})
+
+# bytes needed to sniff any supported format and read its dimensions,
+# except for JPEG and TIFF, whose headers are found by seeking
+SNIFF_SIZE = 64
+
+# number of threads validating files
+DEFAULT_JOBS = 16
+
+Validation = collections.namedtuple('Validation', [
+    'path',
+    'type',  # "png", "jpeg", "mp4", etc., or None if not recognized
+    'size',  # in bytes, or None if not a readable file
+    'width',  # None for videos
+    'height',
+    'reason',  # why the file is rejected, or None if valid
+])
+
+class InvalidImage(Exception):
+    """Raised when an image header is malformed."""
+
+def sniff(head):
+    """Detect the format of an image or video from its first bytes.
+
+    Parameters
+    ----------
+    head : bytes
+        At least the first 12 bytes of the file; WebM is told apart
+        from other Matroska files only if its DocType is in head.
+
+    Returns
+    -------
+    image_type : str
+        One of "png", "jpeg", "gif", "webp", "bmp" and "tiff", or one
+        of VIDEO_TYPES, or None if not recognized.
+
+    """
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'webp'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    if head.startswith((b'II*\x00', b'MM\x00*')):
+        return 'tiff'
+    if head[4:8] == b'ftyp':
+        return 'mov' if head[8:12] == b'qt  ' else 'mp4'
+    if head[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip'):
+        # QuickTime without a file type box
+        return 'mov'
+    if head.startswith(b'\x1a\x45\xdf\xa3'):  # EBML
+        return 'webm' if b'webm' in head else 'mkv'
+    if head.startswith(b'RIFF') and head[8:12] == b'AVI ':
+        return 'avi'
+    if head.startswith(b'FLV\x01'):
+        return 'flv'
+    return None
+
+def _unpack(fmt, data, offset=0):
+    """struct.unpack_from, raising InvalidImage if data is too short."""
+    try:
+        return struct.unpack_from(fmt, data, offset)
+    except struct.error:
+        raise InvalidImage("truncated header")
+
+def _png_dimensions(head, _fileobj):
+    if head[12:16] != b'IHDR':
+        raise InvalidImage("missing IHDR chunk")
+    return _unpack('>II', head, 16)
+
+def _gif_dimensions(head, _fileobj):
+    return _unpack('<HH', head, 6)
+
+def _bmp_dimensions(head, _fileobj):
+    width, height = _unpack('<ii', head, 18)
+    # negative height means a top-down bitmap
+    return width, abs(height)
+
+def _webp_dimensions(head, _fileobj):
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        width, height = _unpack('<HH', head, 26)
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L':
+        bits, = _unpack('<I', head, 21)
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X':
+        if len(head) < 30:
+            raise InvalidImage("truncated header")
+        return (int.from_bytes(head[24:27], 'little') + 1,
+                int.from_bytes(head[27:30], 'little') + 1)
+    raise InvalidImage("unknown WebP chunk %r" % chunk)
+
+# JPEG start-of-frame markers, which carry the dimensions
+_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+def _jpeg_dimensions(_head, fileobj):
+    fileobj.seek(2)
+    while True:
+        byte = fileobj.read(1)
+        if byte != b'\xff':
+            raise InvalidImage("no frame header")
+        marker = fileobj.read(1)
+        while marker == b'\xff':  # fill bytes
+            marker = fileobj.read(1)
+        if not marker or marker[0] in (0xd9, 0xda):  # EOI, SOS
+            raise InvalidImage("no frame header")
+        if 0xd0 <= marker[0] <= 0xd7 or marker[0] == 0x01:
+            continue  # standalone markers
+        length, = _unpack('>H', fileobj.read(2))
+        if marker[0] in _SOF_MARKERS:
+            height, width = _unpack('>xHH', fileobj.read(5))
+            return width, height
+        fileobj.seek(length - 2, os.SEEK_CUR)
+
+def _tiff_dimensions(head, fileobj):
+    endian = '<' if head.startswith(b'II') else '>'
+    offset, = _unpack(endian + 'I', head, 4)
+    fileobj.seek(offset)
+    count, = _unpack(endian + 'H', fileobj.read(2))
+    entries = fileobj.read(12 * count)
+    dimensions = {}
+    for i in range(count):
+        tag, field_type = _unpack(endian + 'HH', entries, 12 * i)
+        if tag in (256, 257):  # ImageWidth, ImageLength
+            # SHORT or LONG
+            fmt = endian + ('H' if field_type == 3 else 'I')
+            dimensions[tag], = _unpack(fmt, entries, 12 * i + 8)
+    if len(dimensions) < 2:
+        raise InvalidImage("no image dimensions")
+    return dimensions[256], dimensions[257]
+
+_DIMENSION_READERS = {
+    'png': _png_dimensions,
+    'jpeg': _jpeg_dimensions,
+    'gif': _gif_dimensions,
+    'webp': _webp_dimensions,
+    'bmp': _bmp_dimensions,
+    'tiff': _tiff_dimensions,
+}
+
+def human_size(size):
+    """Format a size in bytes, e.g., "20 MiB"."""
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '%g %s' % (size, unit)
+        size = round(size / 1024, 1)
+    return '%g GiB' % size
+
+def _size_limit(image_type):
+    """Imgur's size limit for a format."""
+    return SIZE_LIMITS.get(image_type, MAX_SIZE)
+
+def validate_image(path, check_size=True):
+    """Check that a file can be uploaded to Imgur.
+
+    Parameters
+    ----------
+    path : str
+    check_size : bool
+        Whether to check the size limits; files to be downscaled or
+        recompressed before upload may well be over them. Default is
+        True.
+
+    Returns
+    -------
+    validation : Validation
+        validation.reason is None if the file looks good, and a short
+        explanation (e.g., "not a recognized image format") otherwise.
+
+    """
+    with imgur.metrics.span('validate'):
+        return _validate_image(path, check_size)
+
+def _validate_image(path, check_size):
+    """validate_image, untimed."""
+    try:
+        with open(path, 'rb') as fileobj:
+            size = os.fstat(fileobj.fileno()).st_size
+            head = fileobj.read(SNIFF_SIZE)
+            image_type = sniff(head)
+            if not head:
+                reason = "empty file"
+            elif image_type is None:
+                reason = "not a recognized image format"
+            elif check_size and size > _size_limit(image_type):
+                reason = "larger than the %s limit for %s %s" % (
+                    human_size(_size_limit(image_type)), image_type.upper(),
+                    'videos' if image_type in VIDEO_TYPES else 'images')
+            elif image_type in VIDEO_TYPES:
+                return Validation(path, image_type, size, None, None, None)
+            else:
+                width, height = _DIMENSION_READERS[image_type](head, fileobj)
+                if width == 0 or height == 0:
+                    reason = "zero width or height"
+                else:
+                    return Validation(path, image_type, size, width, height,
+                                      None)
+    except InvalidImage as err:
+        reason = "corrupt %s header: %s" % (image_type.upper(), err)
+    except IsADirectoryError:
+        return Validation(path, None, None, None, None, "is a directory")
+    except OSError as err:
+        return Validation(path, None, None, None, None,
+                          err.strerror or str(err))
+    return Validation(path, image_type, size, None, None, reason)
+
+def validate_images(paths, jobs=None, check_size=True):
+    """Validate images in a thread pool, yielding in order as they come.
+
+    Parameters
+    ----------
+    paths : iterable
+        Consumed lazily.
+    jobs : int
+        Number of threads. If None, DEFAULT_JOBS is used.
+    check_size : bool
+        See validate_image. Default is True.
+
+    Yields
+    ------
+    validation : Validation
+
+    """
+    for _, validation in imgur.engine.imap(
+            functools.partial(validate_image, check_size=check_size),
+            paths, jobs=jobs or DEFAULT_JOBS,
+            engine="async", ordered=True):
+        yield validation
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+"""Spool-directory worker, for uploads spread across hosts.
+
+Any number of imgur-worker processes, on any number of hosts sharing a
+filesystem, consume jobs from the same spool directory. A job is a
+file listing paths or URLs, one per line, and the spool holds:
+
+* new/NAME: jobs waiting; put them there with submit (or imgur-worker
+  --submit), or write them elsewhere on the same filesystem (or as a
+  dotfile, which workers skip) and rename them in;
+* claimed/NAME@OWNER: jobs being worked on, claimed by the worker
+  OWNER (host.pid) by renaming them from new/, which only one worker
+  can do;
+* work/NAME.results: results of a claimed job so far;
+* done/NAME and done/NAME.results: finished jobs, and their results.
+
+A claim is a lease of LEASE seconds, renewed by its worker every
+LEASE / RENEWALS_PER_LEASE seconds by touching the claimed file. A
+claim not renewed within its lease (e.g., its worker crashed, or its
+host went down) is stale, and the first worker to notice renames it
+back to new/ to be claimed again; items already uploaded, according to
+work/NAME.results, are not uploaded again. A worker that finds its
+claim gone stops working on the job. Hosts' clocks should agree to
+well within a lease.
+
+Results are JSON objects, one per line, with the attributes of
+imgur.session.Result and the worker that produced them; done/NAME.results
+has one line per item of the job, in the order of the job.
+
+"""
+
+# pylint: disable=wildcard-import,unused-wildcard-import
+
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from zmwangx.colorout import *
+
+import imgur.engine
+import imgur.inputs
+import imgur.session
+
+# seconds
+LEASE = 300.0
+POLL_INTERVAL = 5.0
+RENEWALS_PER_LEASE = 3
+
+SUBDIRECTORIES = ('new', 'claimed', 'work', 'done')
+
+def get_owner():
+    """Identify this worker: host.pid."""
+    host = socket.gethostname().replace('@', '_').replace(os.sep, '_')
+    return '%s.%d' % (host, os.getpid())
+
+def _age(path):
+    """Seconds since a file was last renamed or touched."""
+    stat = os.stat(path)
+    # rename updates ctime but not mtime; touching updates both
+    return time.time() - max(stat.st_mtime, stat.st_ctime)
+
+def _write_atomically(path, data):
+    """Write a file with a tempfile and a rename."""
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as fileobj:
+            fileobj.write(data)
+            fileobj.flush()
+            os.fsync(fileobj.fileno())
+        os.replace(tmp_file, path)
+    except OSError:
+        os.remove(tmp_file)
+        raise
+
+def _trim_torn_line(path):
+    """Cut a torn last line, if any, off a file about to be appended
+    to, lest the next line be glued onto it."""
+    try:
+        with open(path, 'rb+') as fileobj:
+            data = fileobj.read()
+            if data and not data.endswith(b'\n'):
+                fileobj.truncate(data.rfind(b'\n') + 1)
+    except FileNotFoundError:
+        pass
+
+def read_results(path):
+    """Read a results file.
+
+    Returns
+    -------
+    results : dict
+        index => latest record of the item.
+
+    """
+    results = {}
+    try:
+        with open(path, encoding='utf-8') as results_obj:
+            for line in results_obj:
+                try:
+                    record = json.loads(line)
+                    results[record['index']] = record
+                except (ValueError, KeyError, TypeError):
+                    # torn write of a crashed worker
+                    continue
+    except FileNotFoundError:
+        pass
+    return results
+
+class Spool(object):
+    """Spool directory shared by workers."""
+
+    def __init__(self, path):
+        """Init with the path of the spool, creating it if needed."""
+        self.path = path
+        for subdirectory in SUBDIRECTORIES:
+            os.makedirs(os.path.join(path, subdirectory), exist_ok=True)
+
+    def _path(self, subdirectory, name):
+        """Path of a file of the spool."""
+        return os.path.join(self.path, subdirectory, name)
+
+    def submit(self, items, name=None):
+        """Add a job.
+
+        Parameters
+        ----------
+        items : iterable
+            Paths (made absolute) or URLs.
+        name : str
+            Name of the job; must not contain "@". Default is None,
+            i.e., the time of submission, the host and the pid, so that
+            jobs are claimed in order of submission.
+
+        Returns
+        -------
+        name : str
+
+        """
+        if name is None:
+            name = '%s-%s' % (time.strftime('%Y%m%dT%H%M%S'), get_owner())
+        if '@' in name or name.startswith('.'):
+            raise ValueError("invalid job name '%s'" % name)
+        lines = []
+        for item in items:
+            if not item.startswith(('http://', 'https://')):
+                item = os.path.abspath(item)
+            lines.append(item + '\n')
+        _write_atomically(self._path('new', name), ''.join(lines))
+        return name
+
+    def pending(self):
+        """Names of jobs waiting, in order."""
+        return sorted(name for name in os.listdir(self._path('new', ''))
+                      if not name.startswith('.'))
+
+    def claim(self, owner):
+        """Claim a job waiting, if any.
+
+        Returns
+        -------
+        name : str
+            Name of the job claimed, or None.
+
+        """
+        for name in self.pending():
+            claimed = self.claimed_path(name, owner)
+            try:
+                os.rename(self._path('new', name), claimed)
+            except FileNotFoundError:
+                # claimed by another worker first
+                continue
+            return name
+        return None
+
+    def claimed_path(self, name, owner):
+        """Path of a job claimed by owner."""
+        return self._path('claimed', '%s@%s' % (name, owner))
+
+    def results_path(self, name):
+        """Path of the results so far of a claimed job."""
+        return self._path('work', name + '.results')
+
+    def read_job(self, name, owner):
+        """Items of a job claimed by owner."""
+        return list(imgur.inputs.read_list(self.claimed_path(name, owner)))
+
+    def reclaim(self, lease=LEASE):
+        """Put jobs whose claims are stale back in new/.
+
+        Returns
+        -------
+        names : list
+            Names of the jobs put back.
+
+        """
+        names = []
+        for claim in os.listdir(self._path('claimed', '')):
+            name, _, _ = claim.rpartition('@')
+            if not name:
+                continue
+            path = self._path('claimed', claim)
+            try:
+                if _age(path) < lease:
+                    continue
+                os.rename(path, self._path('new', name))
+            except FileNotFoundError:
+                # finished, or reclaimed by another worker first
+                continue
+            names.append(name)
+        return names
+
+    def release(self, name, owner):
+        """Put a job claimed by owner back in new/ right away."""
+        os.rename(self.claimed_path(name, owner), self._path('new', name))
+
+    def finish(self, name, owner, results):
+        """Move a job claimed by owner to done/, with its results.
+
+        Parameters
+        ----------
+        results : list
+            Records of its items, in order.
+
+        Raises
+        ------
+        FileNotFoundError
+            If the claim is gone (see Lease).
+
+        """
+        _write_atomically(
+            self._path('done', name + '.results'),
+            ''.join(json.dumps(record) + '\n' for record in results))
+        os.rename(self.claimed_path(name, owner), self._path('done', name))
+        try:
+            os.remove(self.results_path(name))
+        except FileNotFoundError:
+            pass
+
+class Lease(object):
+    """Claim on a job, renewed in the background until released.
+
+    Also a context manager, started on entry and stopped on exit.
+
+    """
+
+    def __init__(self, path, duration=LEASE):
+        """Init with the path of the claimed job and the lease duration."""
+        self.path = path
+        self.interval = duration / RENEWALS_PER_LEASE
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.renew()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def renew(self):
+        """Touch the claimed job; set lost if it is gone."""
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            self.lost.set()
+
+    def _run(self):
+        """Body of the renewing thread."""
+        while not self.stopped.wait(self.interval):
+            self.renew()
+
+class Worker(object):
+    """Worker consuming the jobs of a spool."""
+
+    def __init__(self, spool, session, lease=LEASE, owner=None):
+        """Init.
+
+        Parameters
+        ----------
+        spool : Spool
+        session : imgur.session.Session
+            Session to upload with.
+        lease : float
+            Seconds. Default is LEASE.
+        owner : str
+            Default is get_owner().
+
+        """
+        self.spool = spool
+        self.session = session
+        self.lease = lease
+        self.owner = owner or get_owner()
+
+    def run_job(self, name):
+        """Upload the items of a claimed job, and finish it.
+
+        Returns
+        -------
+        finished : bool
+            False if the claim was lost.
+
+        """
+        items = self.spool.read_job(name, self.owner)
+        results_path = self.spool.results_path(name)
+        results = {index: record
+                   for index, record in read_results(results_path).items()
+                   if record.get('link') is not None}
+        todo = [index for index in range(len(items)) if index not in results]
+        if results:
+            cprogress("%s: %d of %d items already uploaded" %
+                      (name, len(results), len(items)))
+        _trim_torn_line(results_path)
+        with Lease(self.spool.claimed_path(name, self.owner),
+                   self.lease) as lease, \
+                open(results_path, 'a', encoding='utf-8') as results_obj:
+            uploads = self.session.upload([items[index] for index in todo])
+            try:
+                for result in uploads:
+                    record = {field: getattr(result, field)
+                              for field in imgur.session.Result.__slots__}
+                    record['index'] = todo[result.index]
+                    record['worker'] = self.owner
+                    results[record['index']] = record
+                    results_obj.write(json.dumps(record) + '\n')
+                    results_obj.flush()
+                    if lease.lost.is_set():
+                        break
+            finally:
+                uploads.close()
+        if lease.lost.is_set():
+            cwarning("%s: claim lost; abandoning" % name)
+            return False
+        try:
+            self.spool.finish(name, self.owner,
+                              [results[index] for index in range(len(items))])
+        except FileNotFoundError:
+            cwarning("%s: claim lost; abandoning" % name)
+            return False
+        failed = sum(1 for record in results.values()
+                     if record['link'] is None)
+        cprogress("%s: done, %d uploaded, %d failed" %
+                  (name, len(items) - failed, failed))
+        return True
+
+    def run(self, poll=POLL_INTERVAL, once=False):
+        """Claim and run jobs until interrupted.
+
+        Parameters
+        ----------
+        poll : float
+            Seconds to wait before looking again when no job is waiting.
+        once : bool
+            Return once no job is waiting, rather than wait for more.
+            Default is False.
+
+        Returns
+        -------
+        count : int
+            Number of jobs finished.
+
+        """
+        count = 0
+        while True:
+            for name in self.spool.reclaim(self.lease):
+                cwarning("%s: claim stale; put back" % name)
+            name = self.spool.claim(self.owner)
+            if name is None:
+                if once:
+                    return count
+                time.sleep(poll)
+                continue
+            cprogress("%s: claimed" % name)
+            try:
+                if self.run_job(name):
+                    count += 1
+            except BaseException:
+                # e.g., KeyboardInterrupt; let another worker take over
+                try:
+                    self.spool.release(name, self.owner)
+                except FileNotFoundError:
+                    pass
+                raise
+
+def main():
+    """CLI interface of imgur-worker."""
+    parser = argparse.ArgumentParser(
+        description="""Upload the jobs of a spool directory, which may be
+        shared by workers on several hosts; or, with --submit, add a
+        job to it.""")
+    parser.add_argument('spool', help="path of the spool directory")
+    parser.add_argument('--submit', nargs='+', metavar='ITEM',
+                        help="""add a job of these paths or URLs, or with
+                        --from-file, of those listed in the files
+                        given, and exit""")
+    parser.add_argument('--from-file', action='store_true',
+                        help="""items of --submit are files listing
+                        paths or URLs, one per line ("-" is stdin)""")
+    parser.add_argument('--name', help="""name of the job submitted;
+                        default is the time, host and pid""")
+    parser.add_argument('-a', '--anonymous', action='store_true',
+                        help='upload anonymously')
+    parser.add_argument('--profile', action='append', metavar='NAME',
+                        help="""credential profile to use; may be
+                        repeated; default is all profiles configured
+                        (see imgur-upload)""")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="""number of concurrent uploads; default is
+                        %d""" % imgur.engine.DEFAULT_ASYNC_JOBS)
+    parser.add_argument('--lease', type=float, default=LEASE,
+                        metavar='SECONDS',
+                        help="""claims not renewed for this long are
+                        taken over by other workers; should be the same
+                        for all workers; default is %d""" % LEASE)
+    parser.add_argument('--poll', type=float, default=POLL_INTERVAL,
+                        metavar='SECONDS',
+                        help="""interval between looks at an empty spool;
+                        default is %d""" % POLL_INTERVAL)
+    parser.add_argument('--once', action='store_true',
+                        help="exit once no job is waiting")
+    args = parser.parse_args()
+
+    spool = Spool(args.spool)
+    if args.submit:
+        items = args.submit
+        if args.from_file:
+            items = [item for path in args.submit
+                     for item in imgur.inputs.read_list(path)]
+        name = spool.submit(items, name=args.name)
+        cprogress("submitted %s, %d items" % (name, len(items)))
+        return 0
+
+    try:
+        session = imgur.session.Session(anonymous=args.anonymous,
+                                        jobs=args.jobs,
+                                        profiles=args.profile)
+    except imgur.session.SessionError as err:
+        cfatal_error(str(err))
+        return 1
+    worker = Worker(spool, session, lease=args.lease)
+    # a terminated worker puts its job back (see Worker.run)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+    cprogress("imgur-worker %s consuming %s" % (worker.owner, args.spool))
+    try:
+        worker.run(poll=args.poll, once=args.once)
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        session.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
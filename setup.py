@@ -23,8 +23,6 @@ setuptools.setup(
         'Topic :: Multimedia :: Graphics',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3 :: Only',
     ],
@@ -32,16 +30,24 @@ setuptools.setup(
     packages=['imgur'],
     install_requires=[
         'pyimgur>=0.6.0',
+        'requests',
         'zmwangx>=0.1.31+g932db22',
     ],
+    extras_require={
+        'similar': ['numpy', 'Pillow'],
+        'transform': ['Pillow'],
+    },
     dependency_links = [
         'git+https://github.com/zmwangx/pyzmwangx.git@master#egg=zmwangx-0.1.31',
     ],
     entry_points={
         'console_scripts': [
             'imgur-authorize=imgur.authorize:main',
-            'imgur-save=imgur.save:main',
-            'imgur-upload=imgur.upload:main',
+            'imgur-history=imgur.history:main',
+            'imgur-save=imgur.cli:save_main',
+            'imgur-upload=imgur.cli:upload_main',
+            'imgur-uploadd=imgur.daemon:main',
+            'imgur-worker=imgur.worker:main',
         ]
     },
     test_suite='tests',
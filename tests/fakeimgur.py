@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+"""Local stand-in for Imgur's API, for offline tests and benchmarks.
+
+Can also be run on its own::
+
+    python -m tests.fakeimgur [--port PORT] [--latency SECONDS]
+                              [--error-rate RATE] ...
+
+"""
+
+import argparse
+import collections
+import email.parser
+import email.policy
+import http.server
+import itertools
+import json
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+
+class FakeImgur(object):
+    """Fake Imgur API server running in a background thread.
+
+    Serves
+
+    * POST /3/image: upload, as a multipart file, base64 or URL;
+    * POST /oauth2/token: token refresh;
+    * GET /3/image/ID: image info;
+    * GET /source/SIZE/NAME: SIZE bytes of deterministic junk, to be
+      used as a source URL for imgur-save.
+
+    Remaining credits are reported in X-RateLimit-* headers. Use as a
+    context manager; while active, IMGUR_API_URL points to the server.
+
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, client_credits=12500, user_credits=2000,
+                 statuses=(), refused_urls=(), latency=0.0, error_rate=0.0,
+                 keep_uploads=True, port=0, access_token=None,
+                 credits_by_client=None, drip=0.0):
+        """Init.
+
+        Parameters
+        ----------
+        client_credits : int
+        user_credits : int
+            Initial credits. Each upload costs
+            imgur.ratelimit.CREDITS_PER_UPLOAD; once out of credits,
+            the server responds with 429. None means unlimited.
+        statuses : iterable
+            Error statuses to respond with, in order, before serving
+            uploads normally.
+        refused_urls : iterable
+            Source URLs to refuse to fetch with 400 Bad Request.
+        latency : float
+            Seconds to wait before responding to each request.
+        error_rate : float
+            Fraction of uploads to fail with 500 Internal Server Error,
+            at random.
+        keep_uploads : bool
+            Whether to keep the submitted forms in self.uploads; only
+            their count is kept otherwise. Default is True.
+        port : int
+            Port to listen on; 0 (default) picks a free one.
+        access_token : str
+            If given, uploads with a Bearer token other than this one
+            (or the latest one issued by POST /oauth2/token) get 401
+            Unauthorized. Default is None, i.e., any token is accepted.
+        credits_by_client : dict
+            Initial application credits by client_id, in place of
+            client_credits, for uploads identified by Client-ID (i.e.,
+            anonymous). Uploads of each client_id are counted in
+            self.uploads_by_client.
+        drip : float
+            Seconds to wait between kilobytes of GET /source/
+            responses, to stand in for a server trickling bytes.
+            Default is 0.0.
+
+        """
+        # pylint: disable=too-many-arguments
+        self.client_credits = client_credits
+        self.credits_by_client = dict(credits_by_client or {})
+        self.uploads_by_client = collections.Counter()
+        self.user_credits = user_credits
+        self.user_reset = int(time.time()) + 3600
+        self.statuses = collections.deque(statuses)
+        self.refused_urls = set(refused_urls)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drip = drip
+        self.keep_uploads = keep_uploads
+        self.port = port
+        self.access_token = access_token
+        self.refresh_count = 0
+        self.uploads = []
+        self.upload_count = 0
+        self.images = {}  # id => image data
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.random = random.Random(0)
+        self.server = None
+        self.url = None
+        self._saved_api_url = None
+
+    def __enter__(self):
+        self.server = _Server(('127.0.0.1', self.port), _Handler)
+        self.server.fake = self
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self._saved_api_url = os.environ.get('IMGUR_API_URL')
+        os.environ['IMGUR_API_URL'] = self.url
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._saved_api_url is None:
+            del os.environ['IMGUR_API_URL']
+        else:
+            os.environ['IMGUR_API_URL'] = self._saved_api_url
+
+    def _client_credits(self, client_id):
+        """Application credits left for a client_id (or None)."""
+        if client_id in self.credits_by_client:
+            return self.credits_by_client[client_id]
+        return self.client_credits
+
+    def _charge(self, client_id):
+        """Take the credits of an upload."""
+        if client_id in self.credits_by_client:
+            self.credits_by_client[client_id] -= 10
+        elif self.client_credits is not None:
+            self.client_credits -= 10
+        if self.user_credits is not None:
+            self.user_credits -= 10
+
+    def ratelimit_headers(self, client_id=None):
+        """Current X-RateLimit-* headers."""
+        headers = {}
+        client_credits = self._client_credits(client_id)
+        if client_credits is not None:
+            headers['X-RateLimit-ClientLimit'] = '12500'
+            headers['X-RateLimit-ClientRemaining'] = str(client_credits)
+        if self.user_credits is not None:
+            headers['X-RateLimit-UserLimit'] = '2000'
+            headers['X-RateLimit-UserRemaining'] = str(self.user_credits)
+            headers['X-RateLimit-UserReset'] = str(self.user_reset)
+        return headers
+
+    def _out_of_credits(self, client_id=None):
+        """Whether another upload would exceed the credits."""
+        return any(credits is not None and credits < 10
+                   for credits in (self._client_credits(client_id),
+                                   self.user_credits))
+
+    def handle_upload(self, form, authorization=None):
+        """Handle POST /3/image; return (status, headers, body)."""
+        client_id = None
+        if authorization is not None and authorization.startswith(
+                'Client-ID '):
+            client_id = authorization[len('Client-ID '):]
+        with self.lock:
+            if self.statuses:
+                status = self.statuses.popleft()
+            elif (self.access_token is not None and
+                  authorization is not None and
+                  authorization.startswith('Bearer ') and
+                  authorization[len('Bearer '):] != self.access_token):
+                status = 401
+            elif (form.get('type') == ['url'] and
+                  form.get('image', [None])[0] in self.refused_urls):
+                status = 400
+            elif self._out_of_credits(client_id):
+                status = 429
+            elif self.error_rate and self.random.random() < self.error_rate:
+                status = 500
+            else:
+                status = 200
+                self._charge(client_id)
+                self.upload_count += 1
+                self.uploads_by_client[client_id] += 1
+                if self.keep_uploads:
+                    self.uploads.append(form)
+            headers = self.ratelimit_headers(client_id)
+        if status != 200:
+            if status == 429:
+                headers['Retry-After'] = '0'
+            return status, headers, {'data': {'error': 'fake error'},
+                                     'success': False, 'status': status}
+        image_id = 'fake%d' % next(self.counter)
+        data = {
+            'id': image_id,
+            'link': 'http://i.imgur.com/%s.png' % image_id,
+            'deletehash': 'delete%s' % image_id,
+            'title': form.get('title', [None])[0],
+        }
+        with self.lock:
+            self.images[image_id] = data
+        return 200, headers, {'data': data, 'success': True, 'status': 200}
+
+    def handle_image(self, image_id):
+        """Handle GET /3/image/ID; return (status, headers, body)."""
+        with self.lock:
+            data = self.images.get(image_id)
+        if data is None:
+            return 404, {}, {'data': {'error': 'not found'},
+                             'success': False, 'status': 404}
+        return 200, {}, {'data': data, 'success': True, 'status': 200}
+
+    def handle_token(self, _form):
+        """Handle POST /oauth2/token; return (status, headers, body)."""
+        token = 'token%d' % next(self.counter)
+        with self.lock:
+            self.refresh_count += 1
+            if self.access_token is not None:
+                self.access_token = token
+        return 200, {}, {'access_token': token, 'expires_in': 3600,
+                         'token_type': 'bearer'}
+
+def parse_form(content_type, body):
+    """Parse a urlencoded or multipart/form-data body.
+
+    Returns
+    -------
+    form : dict
+        Like urllib.parse.parse_qs: field name => list of values. Values
+        of file fields are bytes.
+
+    """
+    if not content_type.startswith('multipart/form-data'):
+        return urllib.parse.parse_qs(body.decode('ascii'))
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('ascii') + b'\r\n\r\n' +
+        body)
+    form = collections.defaultdict(list)
+    for part in message.iter_parts():
+        value = part.get_payload(decode=True)
+        if part.get_filename() is None:
+            value = value.decode('utf-8')
+        form[part.get_param('name', header='content-disposition')].append(
+            value)
+    return dict(form)
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        match = re.match(r'^/source/(\d+)/', self.path)
+        if match:
+            size = int(match.group(1))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            chunk = b'\x89PNG' * (256 if fake.drip else 16384)
+            while size > 0:
+                self.wfile.write(chunk[:size])
+                size -= len(chunk)
+                if fake.drip and size > 0:
+                    self.wfile.flush()
+                    time.sleep(fake.drip)
+            return
+        match = re.match(r'^/3/image/(\w+)$', self.path)
+        if match:
+            self.reply(*fake.handle_image(match.group(1)))
+        else:
+            self.reply(404, {}, {'success': False})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_form(self.headers.get('Content-Type', ''),
+                          self.rfile.read(length))
+        if fake.latency:
+            time.sleep(fake.latency)
+        if self.path == '/3/image':
+            self.reply(*fake.handle_upload(
+                form, self.headers.get('Authorization')))
+        elif self.path == '/oauth2/token':
+            self.reply(*fake.handle_token(form))
+        else:
+            self.reply(404, {}, {'success': False})
+
+    def reply(self, status, headers, body):
+        """Send a JSON response."""
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+def main():
+    """Run a fake server in the foreground."""
+    parser = argparse.ArgumentParser(description="Fake Imgur API server.")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds to wait before each response")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="fraction of uploads failing with 500")
+    parser.add_argument('--user-credits', type=int,
+                        help="user credits; unlimited by default")
+    parser.add_argument('--client-credits', type=int,
+                        help="client credits; unlimited by default")
+    args = parser.parse_args()
+    fake = FakeImgur(client_credits=args.client_credits,
+                     user_credits=args.user_credits, latency=args.latency,
+                     error_rate=args.error_rate, keep_uploads=False,
+                     port=args.port)
+    with fake:
+        print(fake.url, flush=True)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
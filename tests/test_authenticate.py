@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import os
+import stat
+import tempfile
+import time
+import unittest
+
+import pyimgur
+from zmwangx.infrastructure import change_home
+
+import imgur.authenticate
+import imgur.engine
+import imgur.upload
+
+from tests.fakeimgur import FakeImgur
+
+class TestTokenCache(unittest.TestCase):
+
+    def test_read_write(self):
+        client = pyimgur.Imgur("client_id", "client_secret",
+                               refresh_token="refresh_token")
+        other_client = pyimgur.Imgur("client_id", "client_secret",
+                                     refresh_token="other_refresh_token")
+        with change_home():
+            with imgur.authenticate.token_lock():
+                self.assertEqual(imgur.authenticate.read_token_cache(client),
+                                 (None, 0))
+                expires_at = time.time() + 3600
+                imgur.authenticate.write_token_cache(client, "access_token",
+                                                     expires_at)
+                self.assertEqual(imgur.authenticate.read_token_cache(client),
+                                 ("access_token", expires_at))
+                # the cache belongs to a specific refresh token
+                self.assertEqual(
+                    imgur.authenticate.read_token_cache(other_client),
+                    (None, 0))
+            mode = os.stat(imgur.authenticate.get_token_file()).st_mode
+            self.assertEqual(stat.S_IMODE(mode), 0o600)
+
+    def test_load_access_token_from_cache(self):
+        client = pyimgur.Imgur("client_id", "client_secret",
+                               refresh_token="refresh_token")
+        with change_home():
+            with imgur.authenticate.token_lock():
+                imgur.authenticate.write_token_cache(
+                    client, "access_token", time.time() + 3600)
+            # a fresh cached token is used without a network round-trip
+            self.assertEqual(imgur.authenticate.load_access_token(client),
+                             "access_token")
+            self.assertEqual(client.access_token, "access_token")
+
+class TestSharedRefresh(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.imagepath = tempfile.mkstemp(suffix=".png",
+                                              prefix="imgur-test-")
+        os.write(fd, b"not really a png")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.imagepath)
+
+    def test_single_refresh_on_401(self):
+        for engine in imgur.engine.ENGINES:
+            client = pyimgur.Imgur("client_id", "client_secret",
+                                   access_token="revoked",
+                                   refresh_token="refresh_token_" + engine)
+            with change_home():
+                with imgur.authenticate.token_lock():
+                    imgur.authenticate.write_token_cache(
+                        client, "revoked", time.time() + 3600)
+                with FakeImgur(access_token="current") as fake:
+                    links = imgur.upload.upload_images(
+                        client, [self.imagepath] * 20, jobs=8, engine=engine)
+            # every worker got 401, but only one of them refreshed, and
+            # every upload was retried with the new token
+            self.assertTrue(all(links), engine)
+            self.assertEqual(fake.refresh_count, 1, engine)
+
+    def test_renew_before_expiry(self):
+        client = pyimgur.Imgur("client_id", "client_secret",
+                               access_token="expiring",
+                               refresh_token="refresh_token_expiring")
+        with change_home():
+            with imgur.authenticate.token_lock():
+                imgur.authenticate.write_token_cache(
+                    client, "expiring", time.time() + 60)
+            with FakeImgur() as fake:
+                links = imgur.upload.upload_images(
+                    client, [self.imagepath] * 5, jobs=2, engine="async")
+        self.assertTrue(all(links))
+        self.assertEqual(fake.refresh_count, 1)
+        self.assertNotEqual(client.access_token, "expiring")
+
+if __name__ == "__main__":
+    unittest.main()
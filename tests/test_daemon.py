@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import http.server
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import PIL.Image
+import pyimgur
+
+import imgur.daemon
+
+from tests.fakeimgur import FakeImgur
+
+class GarbledHandler(http.server.BaseHTTPRequestHandler):
+    """A daemon that breaks off its stream of results."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'{"index": 0, "li\n')
+
+    def log_message(self, *args):
+        pass
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+        self.address = os.path.join(self.directory.name, "uploadd.sock")
+        self.paths = []
+        for i in range(5):
+            path = os.path.join(self.directory.name, "%d.png" % i)
+            PIL.Image.new("RGB", (10, 10), (i, i, i)).save(path)
+            self.paths.append(path)
+        self.fake = FakeImgur().__enter__()
+        self.uploadd = imgur.daemon.UploadDaemon(pyimgur.Imgur("client_id"),
+                                                 anonymous=True, jobs=2)
+        self.server = imgur.daemon.make_server(self.uploadd, self.address)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.uploadd.close()
+        self.fake.__exit__(None, None, None)
+        self.directory.cleanup()
+
+    def test_upload(self):
+        paths = self.paths + [os.path.join(self.directory.name, "missing")]
+        results = list(imgur.daemon.iter_upload_images(
+            paths, address=self.address, ordered=True))
+        self.assertEqual([i for i, _ in results], list(range(6)))
+        self.assertTrue(all(link for _, link in results[:5]))
+        # rejected by validation, without contacting Imgur
+        self.assertIsNone(results[5][1])
+        self.assertEqual(self.fake.upload_count, 5)
+        self.assertEqual(
+            sorted(form["title"][0] for form in self.fake.uploads),
+            ["%d.png" % i for i in range(5)])
+
+        status = imgur.daemon.get_status(self.address)
+        self.assertTrue(status["anonymous"])
+        self.assertEqual(status["uploaded"], 5)
+        self.assertEqual(status["failed"], 1)
+
+    def test_malformed(self):
+        for batch in ({"paths": "abc"}, {"paths": [3]}, {"paths": None},
+                      {"paths": [], "validate": "no"}, ["a.png"]):
+            connection = imgur.daemon._connect(self.address, 5)
+            try:
+                connection.request("POST", "/upload",
+                                   body=json.dumps(batch).encode("utf-8"),
+                                   headers={"Content-Type":
+                                            "application/json"})
+                self.assertEqual(connection.getresponse().status, 400,
+                                 batch)
+            finally:
+                connection.close()
+        self.assertEqual(self.fake.upload_count, 0)
+        self.assertEqual(imgur.daemon.get_status(self.address)["failed"], 0)
+
+    def test_other_origin(self):
+        server = imgur.daemon.make_server(self.uploadd, "http://127.0.0.1:0")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        address = "http://127.0.0.1:%d" % server.server_address[1]
+        body = json.dumps({"paths": self.paths[:1]}).encode("utf-8")
+        try:
+            for host, content_type, status in [
+                    (None, "text/plain", 415),
+                    ("evil.example.com", "application/json", 403),
+                    ("localhost:%d" % server.server_address[1],
+                     "application/json", 200)]:
+                connection = imgur.daemon._connect(address, 5)
+                headers = {"Content-Type": content_type}
+                if host is not None:
+                    headers["Host"] = host
+                try:
+                    connection.request("POST", "/upload", body=body,
+                                       headers=headers)
+                    response = connection.getresponse()
+                    self.assertEqual(response.status, status, host)
+                    response.read()
+                finally:
+                    connection.close()
+            self.assertEqual(self.fake.upload_count, 1)
+            # the client's own requests go through
+            self.assertIsNotNone(imgur.daemon.get_status(address))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_lost(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), GarbledHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with self.assertRaises(imgur.daemon.DaemonError):
+                list(imgur.daemon.iter_upload_images(
+                    self.paths, address="http://127.0.0.1:%d" %
+                    server.server_address[1]))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_find_daemon(self):
+        os.environ["IMGUR_UPLOADD"] = self.address
+        try:
+            self.assertEqual(imgur.daemon.find_daemon(anonymous=True),
+                             self.address)
+            self.assertIsNone(imgur.daemon.find_daemon(anonymous=False))
+        finally:
+            del os.environ["IMGUR_UPLOADD"]
+        self.assertIsNone(imgur.daemon.get_status(
+            os.path.join(self.directory.name, "nothing.sock")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import tempfile
+import sys
+import time
+import unittest
+import unittest.mock
+
+from zmwangx.infrastructure import capture_stdout, capture_stderr, change_home
+
+import imgur.authenticate
+import imgur.cli
+import imgur.dedup
+
+from tests.fakeimgur import FakeImgur
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+        self.index_file = os.path.join(self.directory.name, "index.sqlite3")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_hash_files(self):
+        paths = []
+        contents = [b"", b"imgur", os.urandom(imgur.dedup.CHUNK_SIZE * 2 + 1)]
+        for i, content in enumerate(contents):
+            path = os.path.join(self.directory.name, "%d.png" % i)
+            with open(path, "wb") as fileobj:
+                fileobj.write(content)
+            paths.append(path)
+        paths.append(os.path.join(self.directory.name, "nonexistent.png"))
+        expected = [hashlib.sha256(content).hexdigest()
+                    for content in contents] + [None]
+        self.assertEqual(imgur.dedup.hash_files(paths, jobs=2), expected)
+
+    def test_index(self):
+        with imgur.dedup.DedupIndex(self.index_file) as index:
+            self.assertIsNone(index.lookup("0" * 64))
+            index.add("0" * 64, "http://i.imgur.com/a.png", "deletehash")
+        # persistent across instances
+        with imgur.dedup.DedupIndex(self.index_file) as index:
+            self.assertEqual(index.lookup("0" * 64),
+                             ("http://i.imgur.com/a.png", "deletehash"))
+
+    def test_evict(self):
+        with imgur.dedup.DedupIndex(self.index_file) as index:
+            for digest in "abc":
+                index.add(digest, "http://i.imgur.com/%s.png" % digest)
+                time.sleep(0.01)
+            # a is now the most recently used
+            index.lookup("a")
+            self.assertEqual(index.evict(max_entries=2), 1)
+            self.assertIsNone(index.lookup("b"))
+            self.assertIsNotNone(index.lookup("a"))
+            self.assertEqual(index.evict(max_entries=None, max_age=0), 2)
+
+    def test_max_age(self):
+        paths = []
+        for name in ("a.png", "b.png"):
+            path = os.path.join(self.directory.name, name)
+            with open(path, "wb") as fileobj:
+                fileobj.write(b"\x89PNG\r\n\x1a\n" + os.urandom(64))
+            paths.append(path)
+        digests = imgur.dedup.hash_files(paths)
+        with change_home(), capture_stdout(), capture_stderr(), \
+                unittest.mock.patch.dict(os.environ), FakeImgur():
+            os.environ.pop("XDG_DATA_HOME", None)
+            os.environ.pop("XDG_CONFIG_HOME", None)
+            with open(imgur.authenticate.get_conf_file(), "w") as conf_obj:
+                conf_obj.write("[oauth]\nclient_id = client_id\n")
+            args = ["-a", "--no-daemon", "--no-progress", "--no-validate",
+                    "-d", "--dedup-max-age", "1"]
+            sys.argv[1:] = args + [paths[0]]
+            self.assertEqual(imgur.cli.upload_main(), 0)
+            # a was last used two days ago
+            with imgur.dedup.DedupIndex() as index, index.connection:
+                index.connection.execute("UPDATE images SET accessed = ?",
+                                         (time.time() - 2 * 86400,))
+            sys.argv[1:] = args + [paths[1]]
+            self.assertEqual(imgur.cli.upload_main(), 0)
+            with imgur.dedup.DedupIndex() as index:
+                self.assertIsNone(index.lookup(digests[0]))
+                self.assertIsNotNone(index.lookup(digests[1]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+
+import imgur.engine
+
+def square(number):
+    return number * number
+
+def sleep_then_return(seconds):
+    time.sleep(seconds)
+    return seconds
+
+class TestEngine(unittest.TestCase):
+
+    def test_get_pool_size(self):
+        self.assertEqual(imgur.engine.get_pool_size(4, 100), 4)
+        self.assertEqual(imgur.engine.get_pool_size(0, 100), 100)
+        self.assertEqual(imgur.engine.get_pool_size(None, 3, "async"), 3)
+        self.assertEqual(imgur.engine.get_pool_size(None, 1000, "async"),
+                         imgur.engine.DEFAULT_ASYNC_JOBS)
+        self.assertEqual(imgur.engine.get_pool_size(None, 0), 1)
+
+    def test_map_jobs(self):
+        numbers = list(range(50))
+        expected = [square(number) for number in numbers]
+        for engine in imgur.engine.ENGINES:
+            self.assertEqual(
+                imgur.engine.map_jobs(square, numbers, jobs=4, engine=engine),
+                expected)
+
+    def test_imap_unordered(self):
+        delays = [0.5, 0, 0, 0]
+        for engine in imgur.engine.ENGINES:
+            pairs = list(imgur.engine.imap(sleep_then_return, delays,
+                                           jobs=4, engine=engine))
+            self.assertEqual(sorted(pairs), sorted(enumerate(delays)))
+            # the slow first item finishes last
+            self.assertEqual(pairs[-1], (0, 0.5))
+
+    def test_imap_ordered(self):
+        delays = [0.3, 0, 0.1, 0] * 5
+        for engine in imgur.engine.ENGINES:
+            pairs = list(imgur.engine.imap(sleep_then_return, delays, jobs=2,
+                                           engine=engine, ordered=True))
+            self.assertEqual(pairs, list(enumerate(delays)))
+
+    def test_imap_iterable(self):
+        numbers = (number for number in range(20))
+        pairs = list(imgur.engine.imap(square, numbers, jobs=0,
+                                       engine="async", ordered=True))
+        self.assertEqual(pairs, [(i, square(i)) for i in range(20)])
+
+    def test_pipe(self):
+        self.assertEqual(list(imgur.engine.pipe(range(100), 4)),
+                         list(range(100)))
+
+        def failing():
+            yield 1
+            raise RuntimeError
+        with self.assertRaises(RuntimeError):
+            list(imgur.engine.pipe(failing(), 4))
+
+        # closing the consumer stops the producer
+        closed = []
+
+        def infinite():
+            try:
+                while True:
+                    yield 0
+            finally:
+                closed.append(True)
+        piped = imgur.engine.pipe(infinite(), 4)
+        next(piped)
+        piped.close()
+        self.assertEqual(closed, [True])
+
+    def test_pipeline(self):
+        stage1 = imgur.engine.pipe(
+            imgur.engine.imap(sleep_then_return, [0.2, 0, 0.1, 0], jobs=2,
+                              engine="async", ordered=True), 2)
+        stage2 = imgur.engine.imap(square, (result for _, result in stage1),
+                                   jobs=2, engine="process", ordered=True,
+                                   count=4)
+        self.assertEqual([result for _, result in stage2],
+                         [square(0.2), 0, square(0.1), 0])
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            imgur.engine.map_jobs(square, [1], engine="thread")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import tempfile
+import time
+import unittest
+
+import imgur.history
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+        self.history_file = os.path.join(self.directory.name,
+                                         "history.sqlite3")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_add_and_find(self):
+        with imgur.history.History(self.history_file) as history:
+            history.add("upload", "/a.png", {
+                "link": "https://i.imgur.com/a.png", "deletehash": "da",
+                "bytes": 100, "seconds": 0.5, "attempts": 1})
+            history.add("upload", "/b.png", None)
+            history.add("save", "http://example.com/c.png",
+                        "https://i.imgur.com/c.png")
+        # buffered entries are written on close
+        with imgur.history.History(self.history_file) as history:
+            entries = history.find()
+            self.assertEqual([entry.source for entry in entries],
+                             ["/a.png", "/b.png", "http://example.com/c.png"])
+            self.assertEqual(entries[0].deletehash, "da")
+            self.assertEqual(entries[0].bytes, 100)
+            self.assertEqual(history.find(source="/b.png")[0].link, None)
+            # either scheme
+            self.assertEqual(
+                history.find(link="http://i.imgur.com/c.png")[0].action,
+                "save")
+            self.assertEqual([entry.source for entry in
+                              history.find(failed=True)], ["/b.png"])
+            self.assertEqual([entry.source for entry in
+                              history.find(limit=1)],
+                             ["http://example.com/c.png"])
+
+    def test_time_range(self):
+        with imgur.history.History(self.history_file) as history:
+            history.add("upload", "/old.png", "https://i.imgur.com/o.png")
+            history.flush()
+            middle = time.time()
+            time.sleep(0.01)
+            history.add("upload", "/new.png", "https://i.imgur.com/n.png")
+            self.assertEqual([entry.source for entry in
+                              history.find(since=middle)], ["/new.png"])
+            self.assertEqual([entry.source for entry in
+                              history.find(until=middle)], ["/old.png"])
+
+    def test_dates(self):
+        noon = time.mktime((2016, 1, 31, 12, 0, 0, 0, 0, -1))
+        for string in ("2016-01-31T12:00", "2016-01-31 12:00:00"):
+            self.assertEqual(imgur.history._timestamp(string), noon)
+        self.assertEqual(imgur.history._timestamp("2016-01-31"),
+                         noon - 12 * 3600)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            imgur.history._timestamp("31/01/2016")
+        entry = imgur.history.Entry(noon, "upload", "/a.png", None, None,
+                                    None, None)
+        self.assertTrue(imgur.history._format(entry).startswith(
+            "2016-01-31 12:00:00\tupload\t/a.png\t-"))
+
+    def test_indexed(self):
+        with imgur.history.History(self.history_file) as history:
+            for column, value in (("source", "/a.png"),
+                                  ("link", "https://i.imgur.com/a.png"),
+                                  ("time", 0)):
+                plan = history.connection.execute(
+                    "EXPLAIN QUERY PLAN SELECT * FROM entries "
+                    "WHERE %s = ?" % column, (value,)).fetchall()
+                self.assertIn("entries_%s" % column, str(plan))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import imgur.inputs
+
+class TestInputs(unittest.TestCase):
+
+    def test_split_entries(self):
+        data = b"a.png\r\nb c.png\n\n\xff.png\nlast.png"
+        # entries straddling reads are put back together
+        with unittest.mock.patch("imgur.inputs.READ_SIZE", 3):
+            entries = list(imgur.inputs.split_entries(io.BytesIO(data)))
+        self.assertEqual(entries, ["a.png", "b c.png",
+                                   os.fsdecode(b"\xff.png"), "last.png"])
+
+        data = b"a\nb.png\0c.png\0"
+        entries = list(imgur.inputs.split_entries(io.BytesIO(data), b"\0"))
+        self.assertEqual(entries, ["a\nb.png", "c.png"])
+
+    def test_read_list_is_lazy(self):
+        entries = imgur.inputs.read_list("/nonexistent/list")
+        with self.assertRaises(FileNotFoundError):
+            next(entries)
+
+    def test_walk(self):
+        with tempfile.TemporaryDirectory() as root:
+            for relpath in ["b.png", "a/c.JPG", "a/d.txt", "a/z/e.png"]:
+                path = os.path.join(root, relpath)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, "wb").close()
+
+            def found(**kwargs):
+                return [os.path.relpath(path, root)
+                        for path in imgur.inputs.walk(root, **kwargs)]
+
+            self.assertEqual(found(),
+                             ["b.png", "a/c.JPG", "a/d.txt", "a/z/e.png"])
+            self.assertEqual(found(extensions=["png", ".jpg"]),
+                             ["b.png", "a/c.JPG", "a/z/e.png"])
+            self.assertEqual(found(patterns=["*.png", "d*"]),
+                             ["b.png", "a/d.txt", "a/z/e.png"])
+
+if __name__ == "__main__":
+    unittest.main()
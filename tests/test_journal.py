@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import imgur.journal
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+        self.path = os.path.join(self.directory.name, "journal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_resume(self):
+        items = ["a.png", "b.png", "c.png", "d.png"]
+        with imgur.journal.Journal(self.path) as journal:
+            journal.add(items)
+            journal.claim(items[:3])
+            journal.finish("a.png", "http://i.imgur.com/a.png")
+            journal.finish("b.png", None)
+            # killed with c.png in flight and d.png pending
+
+        with imgur.journal.Journal(self.path) as journal:
+            self.assertEqual(journal.states["a.png"],
+                             (imgur.journal.DONE, "http://i.imgur.com/a.png"))
+            self.assertEqual(journal.count(imgur.journal.FAILED), 1)
+            self.assertEqual(journal.count(imgur.journal.IN_FLIGHT), 1)
+            self.assertEqual(journal.count(imgur.journal.PENDING), 1)
+            journal.add(["a.png", "e.png"])
+            self.assertEqual(journal.todo(),
+                             ["b.png", "c.png", "d.png", "e.png"])
+
+    def test_torn_write(self):
+        with imgur.journal.Journal(self.path) as journal:
+            journal.add(["a.png"])
+        with open(self.path, "a") as journal_obj:
+            journal_obj.write('{"item": "b.png", "sta')
+        with imgur.journal.Journal(self.path) as journal:
+            self.assertEqual(journal.todo(), ["a.png"])
+            journal.add(["c.png"])
+        # the record after the torn line survives
+        with imgur.journal.Journal(self.path) as journal:
+            self.assertEqual(journal.todo(), ["a.png", "c.png"])
+
+    def test_compact(self):
+        with imgur.journal.Journal(self.path) as journal:
+            for _ in range(3):
+                journal.claim(["a.png"])
+                journal.finish("a.png", None)
+        with imgur.journal.Journal(self.path) as journal:
+            self.assertEqual(journal.todo(), ["a.png"])
+        with open(self.path) as journal_obj:
+            self.assertEqual(len(journal_obj.readlines()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+import unittest
+
+import imgur.engine
+import imgur.metrics
+
+def timed_square(x):
+    with imgur.metrics.span("square"):
+        return x * x
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        imgur.metrics.reset()
+        self.spans = []
+        imgur.metrics.subscribe(self.hook)
+
+    def tearDown(self):
+        imgur.metrics.unsubscribe(self.hook)
+        imgur.metrics.reset()
+
+    def hook(self, phase, seconds):
+        self.spans.append((phase, seconds))
+
+    def test_quantiles(self):
+        histogram = imgur.metrics.Histogram()
+        for i in range(1, 101):
+            histogram.add(i / 1000)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.min, 0.001)
+        self.assertAlmostEqual(histogram.max, 0.1)
+        # estimates are only as good as the buckets
+        self.assertTrue(0.025 <= histogram.quantile(0.5) <= 0.05)
+        self.assertTrue(0.05 <= histogram.quantile(0.99) <= 0.1)
+
+    def test_span(self):
+        with imgur.metrics.span("phase"):
+            pass
+        self.assertEqual([phase for phase, _ in self.spans], ["phase"])
+        self.assertEqual(imgur.metrics.summary()["phase"]["count"], 1)
+
+    def test_engine(self):
+        for engine in ("process", "async"):
+            imgur.metrics.reset()
+            results = sorted(result for _, result in imgur.engine.imap(
+                timed_square, range(5), jobs=2, engine=engine))
+            self.assertEqual(results, [0, 1, 4, 9, 16])
+            summary = imgur.metrics.summary()
+            for phase in ("square", "job", "latency"):
+                self.assertEqual(summary[phase]["count"], 5, (engine, phase))
+
+    def test_write(self):
+        with imgur.metrics.span("upload"):
+            pass
+        with tempfile.TemporaryDirectory(prefix="imgur-test-") as directory:
+            path = os.path.join(directory, "metrics.json")
+            imgur.metrics.write(path, counts={"succeeded": 1, "failed": 0})
+            with open(path) as fileobj:
+                data = json.load(fileobj)
+            self.assertEqual(data["phases"]["upload"]["count"], 1)
+            self.assertEqual(data["images"]["succeeded"], 1)
+
+            path = os.path.join(directory, "metrics.prom")
+            imgur.metrics.write(path, counts={"succeeded": 1, "failed": 0})
+            with open(path) as fileobj:
+                lines = fileobj.read().splitlines()
+            self.assertIn('imgur_phase_seconds_bucket'
+                          '{phase="upload",le="+Inf"} 1', lines)
+            self.assertIn('imgur_phase_seconds_count{phase="upload"} 1',
+                          lines)
+            self.assertIn('imgur_images{result="failed"} 0', lines)
+
+if __name__ == "__main__":
+    unittest.main()
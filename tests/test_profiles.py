@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import collections
+import os
+import pickle
+import tempfile
+import time
+import unittest
+
+import pyimgur
+from zmwangx.infrastructure import change_home
+
+import imgur.authenticate
+import imgur.engine
+import imgur.profiles
+import imgur.ratelimit
+import imgur.upload
+
+from tests.fakeimgur import FakeImgur
+
+def observation(**kwargs):
+    fields = dict(client_remaining=None, user_remaining=None,
+                  user_reset=None, throttled=0, retry_after=None)
+    fields.update(kwargs)
+    return imgur.ratelimit.Observation(**fields)
+
+class TestRotation(unittest.TestCase):
+
+    def setUp(self):
+        self.rotation = imgur.profiles.Rotation([
+            ("a", pyimgur.Imgur("a")), ("b", pyimgur.Imgur("b"))])
+
+    def choices(self, count):
+        chosen = collections.Counter()
+        for _ in range(count):
+            profile = self.rotation.choose()
+            chosen[profile.name] += 1
+            self.rotation.release(profile, None)
+        return chosen
+
+    def test_proportional(self):
+        a, b = self.rotation.profiles
+        a.client_remaining = 1000
+        b.client_remaining = 3000
+        self.assertEqual(self.choices(400), {"a": 100, "b": 300})
+
+    def test_exhausted(self):
+        a, _ = self.rotation.profiles
+        profile = self.rotation.choose()
+        self.rotation.release(profile, observation(client_remaining=5))
+        self.assertEqual(self.choices(10), {"b" if profile is a else "a": 10})
+        # back once reset, with its credits unknown until heard from
+        profile.available_at = time.time() - 1
+        self.assertEqual(len(self.choices(10)), 2)
+
+    def test_pickle(self):
+        profile = self.rotation.choose()
+        self.rotation.release(profile, observation(client_remaining=990))
+        copy = pickle.loads(pickle.dumps(self.rotation))
+        self.assertEqual(copy.stats(), self.rotation.stats())
+        self.assertEqual([client.client_id for client in copy.clients],
+                         ["a", "b"])
+
+class TestShardedUpload(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.imagepath = tempfile.mkstemp(suffix=".png",
+                                              prefix="imgur-test-")
+        os.write(fd, b"\x89PNG" * 10)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.imagepath)
+
+    def test_failover(self):
+        for engine in imgur.engine.ENGINES:
+            rotation = imgur.profiles.Rotation([
+                ("a", pyimgur.Imgur("a")), ("b", pyimgur.Imgur("b"))])
+            # 5 uploads' worth of credits for a; the rest must go to b,
+            # without failing
+            with FakeImgur(user_credits=None,
+                           credits_by_client={"a": 50, "b": 10000}) as fake:
+                links = imgur.upload.upload_images(
+                    rotation, [self.imagepath] * 30, jobs=4, engine=engine)
+            self.assertTrue(all(links), engine)
+            self.assertLessEqual(fake.uploads_by_client["a"], 5, engine)
+            self.assertEqual(fake.upload_count, 30, engine)
+
+class TestProfileConfig(unittest.TestCase):
+
+    def test_gen_client(self):
+        with change_home():
+            with open(imgur.authenticate.get_conf_file(), "w") as conf_obj:
+                conf_obj.write("[oauth]\nclient_id = a\n"
+                               "[oauth:second]\nclient_id = b\n"
+                               "[other]\nclient_id = c\n")
+            self.assertEqual(imgur.authenticate.get_profiles(),
+                             ["default", "second"])
+            rotation = imgur.authenticate.gen_client(anonymous=True)
+            self.assertEqual([client.client_id
+                              for client in rotation.clients], ["a", "b"])
+            client = imgur.authenticate.gen_client(anonymous=True,
+                                                   profiles=["second"])
+            self.assertEqual(client.client_id, "b")
+
+    def test_token_per_profile(self):
+        clients = [pyimgur.Imgur("client_id", "client_secret",
+                                 refresh_token=token)
+                   for token in ("first", "second")]
+        expires_at = time.time() + 3600
+        with change_home():
+            with imgur.authenticate.token_lock():
+                for client in clients:
+                    imgur.authenticate.write_token_cache(
+                        client, "access_" + client.refresh_token, expires_at)
+                for client in clients:
+                    self.assertEqual(
+                        imgur.authenticate.read_token_cache(client),
+                        ("access_" + client.refresh_token, expires_at))
+
+if __name__ == "__main__":
+    unittest.main()
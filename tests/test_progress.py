@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import io
+import unittest
+
+import imgur.engine
+import imgur.progress
+
+def count_in_flight(_):
+    with imgur.progress.active():
+        return imgur.progress.in_flight()
+
+class Terminal(io.StringIO):
+    def isatty(self):
+        return True
+
+class TestProgress(unittest.TestCase):
+
+    def setUp(self):
+        imgur.progress.enable()
+
+    def tearDown(self):
+        imgur.progress.attach(None)
+
+    def test_in_flight(self):
+        for engine in ("process", "async"):
+            seen = [result for _, result in imgur.engine.imap(
+                count_in_flight, range(4), jobs=2, engine=engine)]
+            # counted in workers, seen by every process
+            self.assertTrue(all(count >= 1 for count in seen), engine)
+            self.assertEqual(imgur.progress.in_flight(), 0)
+
+    def test_status(self):
+        reporter = imgur.progress.Reporter(total=4, stream=Terminal())
+        reporter.update(size=1000)
+        reporter.update(succeeded=False)
+        status = reporter.status()
+        self.assertTrue(status.startswith("2/4 done, 1 failed, "
+                                          "0 in flight, "), status)
+        self.assertIn("MB/s", status)
+        self.assertIn("ETA", status)
+
+    def test_terminal(self):
+        stream = Terminal()
+        with imgur.progress.Reporter(stream=stream,
+                                     interval=60) as reporter:
+            reporter.update()
+            reporter.show()
+            self.assertTrue(stream.getvalue().startswith("\r\x1b[K1 done"))
+        # erased when done
+        self.assertTrue(stream.getvalue().endswith("\r\x1b[K"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import time
+import unittest
+
+import pyimgur
+
+import imgur.engine
+import imgur.ratelimit
+import imgur.request
+
+from tests.fakeimgur import FakeImgur
+
+class UploadPath(object):
+    def __init__(self, client):
+        self.client = client
+
+    def __call__(self, path):
+        return imgur.request.upload_image(self.client, path=path)['link']
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    def observation(self, **kwargs):
+        fields = dict(client_remaining=None, user_remaining=None,
+                      user_reset=None, throttled=0, retry_after=None)
+        fields.update(kwargs)
+        return imgur.ratelimit.Observation(**fields)
+
+    def test_aimd(self):
+        limiter = imgur.ratelimit.AdaptiveLimiter(initial=4, maximum=16)
+        # four successes grow the limit by one
+        for _ in range(4):
+            limiter.update(self.observation())
+        self.assertEqual(limiter.allowed, 4)
+        limiter.update(self.observation())
+        self.assertEqual(limiter.allowed, 5)
+        limiter.update(self.observation(throttled=1, retry_after=30))
+        self.assertEqual(limiter.allowed, 2)
+        self.assertGreater(limiter.delay(), 25)
+
+    def test_bounds(self):
+        limiter = imgur.ratelimit.AdaptiveLimiter(initial=2, maximum=2)
+        for _ in range(10):
+            limiter.update(self.observation())
+        self.assertEqual(limiter.allowed, 2)
+        for _ in range(10):
+            limiter.update(self.observation(throttled=1))
+        self.assertEqual(limiter.allowed, 1)
+
+    def test_credits(self):
+        limiter = imgur.ratelimit.AdaptiveLimiter(initial=16, maximum=16)
+        limiter.update(self.observation(client_remaining=50,
+                                        user_remaining=1000))
+        self.assertEqual(limiter.allowed, 5)
+        reset = time.time() + 60
+        limiter.update(self.observation(user_remaining=0, user_reset=reset))
+        self.assertEqual(limiter.allowed, 1)
+        self.assertGreater(limiter.delay(), 55)
+
+class TestFakeServer(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.imagepath = tempfile.mkstemp(suffix=".png",
+                                              prefix="imgur-test-")
+        os.write(fd, b"not really a png")
+        os.close(fd)
+        self.client = pyimgur.Imgur("client_id")
+
+    def tearDown(self):
+        os.remove(self.imagepath)
+
+    def test_backoff_on_429(self):
+        with FakeImgur(statuses=[429, 429]) as fake:
+            observed = imgur.ratelimit.Observed(UploadPath(self.client))
+            link, observation = observed(self.imagepath)
+            self.assertTrue(link.startswith("http://i.imgur.com/"))
+            self.assertEqual(len(fake.uploads), 1)
+        self.assertEqual(observation.throttled, 2)
+        self.assertEqual(observation.user_remaining, 1990)
+        self.assertEqual(observation.client_remaining, 12490)
+
+    def test_adaptive_engine(self):
+        with FakeImgur(statuses=[429] * 3) as fake:
+            for engine in imgur.engine.ENGINES:
+                links = imgur.engine.map_jobs(
+                    UploadPath(self.client), [self.imagepath] * 10,
+                    jobs=4, engine=engine, adaptive=True)
+                self.assertTrue(all(links))
+            self.assertEqual(len(fake.uploads), 20)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import tempfile
+import unittest
+
+import pyimgur
+
+import imgur.request
+
+from tests.fakeimgur import FakeImgur, parse_form
+
+class CountingFile(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.largest_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.largest_read = max(self.largest_read, len(data))
+        return data
+
+class TestMultipart(unittest.TestCase):
+
+    def test_body(self):
+        content = os.urandom(imgur.request.CHUNK_SIZE * 3 + 17)
+        fileobj = CountingFile(content)
+        progress = []
+        body = imgur.request.MultipartBody(
+            {"title": "tïtle", "type": "file"}, "image", fileobj,
+            len(content), "a.gif",
+            progress=lambda sent, total: progress.append((sent, total)))
+        chunks = list(body)
+        data = b"".join(chunks)
+        self.assertEqual(len(data), len(body))
+        # the file is never read whole
+        self.assertEqual(fileobj.largest_read, imgur.request.CHUNK_SIZE)
+        self.assertTrue(all(len(chunk) <= imgur.request.CHUNK_SIZE
+                            for chunk in chunks))
+        self.assertEqual(progress[-1], (len(body), len(body)))
+        form = parse_form(body.content_type, data)
+        self.assertEqual(form["image"], [content])
+        self.assertEqual(form["title"], ["tïtle"])
+        # and again, e.g., after a 429
+        body.rewind()
+        self.assertEqual(body.read(), data)
+
+    def test_upload(self):
+        fd, path = tempfile.mkstemp(suffix=".gif", prefix="imgur-test-")
+        content = b"GIF89a" + os.urandom(200000)
+        os.write(fd, content)
+        os.close(fd)
+        try:
+            with FakeImgur(statuses=[429]) as fake:
+                image = imgur.request.upload_image(
+                    pyimgur.Imgur("client_id"), path=path, title="a.gif")
+            self.assertTrue(image["link"])
+            self.assertEqual(fake.uploads[0]["image"], [content])
+            self.assertEqual(fake.uploads[0]["type"], ["file"])
+        finally:
+            os.remove(path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+import pyimgur
+import requests
+from zmwangx.infrastructure import capture_stderr
+
+import imgur.request
+import imgur.retry
+import imgur.save
+import imgur.upload
+
+from tests.fakeimgur import FakeImgur
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+class Flaky(object):
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "done"
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.imagepath = tempfile.mkstemp(suffix=".png",
+                                              prefix="imgur-test-")
+        os.write(fd, b"not really a png")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.imagepath)
+
+    def test_is_retryable(self):
+        for exc in (http_error(500), http_error(503), http_error(429),
+                    requests.ConnectionError(), requests.ReadTimeout(),
+                    ConnectionResetError()):
+            self.assertTrue(imgur.retry.is_retryable(exc), repr(exc))
+        for exc in (http_error(400), http_error(401), http_error(404),
+                    FileNotFoundError(), ValueError()):
+            self.assertFalse(imgur.retry.is_retryable(exc), repr(exc))
+
+    def test_run(self):
+        policy = imgur.retry.Policy(attempts=3, backoff_base=0.01)
+        flaky = Flaky([http_error(502), requests.ConnectionError()])
+        self.assertEqual(policy.run(flaky), ("done", 3))
+        # out of attempts
+        flaky = Flaky([http_error(502)] * 3)
+        with self.assertRaises(requests.HTTPError) as context:
+            policy.run(flaky)
+        self.assertEqual(context.exception.attempts, 3)
+        # fatal errors are not retried
+        flaky = Flaky([http_error(400)])
+        with self.assertRaises(requests.HTTPError):
+            policy.run(flaky)
+        self.assertEqual(flaky.calls, 1)
+
+    def test_upload_transient_errors(self):
+        retry = imgur.retry.Policy(backoff_base=0.01)
+        with FakeImgur(statuses=[500, 503, 502]) as fake:
+            links = imgur.upload.upload_images(
+                pyimgur.Imgur("client_id"), [self.imagepath] * 4, jobs=2,
+                engine="async", retry=retry)
+        self.assertTrue(all(links))
+        self.assertEqual(fake.upload_count, 4)
+
+    def test_deadline(self):
+        retry = imgur.retry.Policy(read_timeout=0.2, deadline=1.0,
+                                   attempts=100, backoff_base=0.01)
+        start = time.monotonic()
+        with FakeImgur(latency=2) as fake:
+            links = imgur.upload.upload_images(
+                pyimgur.Imgur("client_id"), [self.imagepath] * 2, jobs=2,
+                engine="async", retry=retry)
+            self.assertEqual(links, [None, None])
+            self.assertLess(time.monotonic() - start, 1.5)
+            fake.latency = 0
+
+    def test_slow_drip(self):
+        # each read comes well within the read timeout, but the whole
+        # download would take 3 seconds
+        retry = imgur.retry.Policy(read_timeout=0.5, deadline=1.0,
+                                   attempts=100, backoff_base=0.01)
+        with tempfile.TemporaryDirectory(prefix="imgur-test-") as directory:
+            with FakeImgur(drip=0.05) as fake, capture_stderr():
+                start = time.monotonic()
+                self.assertIsNone(imgur.save.download_image(
+                    fake.url + "/source/61440/image.png", directory,
+                    retry=retry))
+                self.assertLess(time.monotonic() - start, 1.5)
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_deadline_mid_upload(self):
+        body = imgur.request.MultipartBody({}, "image", io.BytesIO(b"x" * 8),
+                                           8, "image.png")
+
+        def send():
+            body.read(4)
+            time.sleep(0.2)
+            body.read(4)
+
+        with self.assertRaises(socket.timeout):
+            imgur.retry.Policy(deadline=0.1).run(send)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,55 @@
 #!/usr/bin/env python3
 
+import collections
 import filecmp
+import http.server
 import os
 import sys
+import tempfile
+import threading
+import unittest
 import urllib.request
 
+import PIL.Image
+import pyimgur
 from zmwangx.infrastructure import capture_stdout, capture_stderr, change_home
 
+import imgur.retry
 import imgur.save
+import imgur.similar
 
+from tests.fakeimgur import FakeImgur
 import tests.test_upload
 
+class DirectoryHandler(http.server.SimpleHTTPRequestHandler):
+    """Quietly serve files under root."""
+
+    root = None
+
+    def translate_path(self, path):
+        # relative to the current directory before Python 3.7
+        path = super().translate_path(path)
+        return os.path.join(self.root, os.path.relpath(path, os.getcwd()))
+
+    def log_message(self, *args):
+        pass
+
+class TruncatedHandler(http.server.BaseHTTPRequestHandler):
+    """Serve a chunked response cut short."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.wfile.write(b"400\r\n" + b"\x89PNG" * 16)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
 # inherit from tests.test_upload.TestUpload to reuse the same setup
 class TestSave(tests.test_upload.TestUpload):
 
@@ -51,3 +90,98 @@ class TestSave(tests.test_upload.TestUpload):
                     finally:
                         os.remove(image1_path)
                         os.remove(image2_path)
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+        self.small = os.urandom(1024)
+        self.large = os.urandom(imgur.save.SPOOL_THRESHOLD + 1)
+        for name, content in (("small.png", self.small),
+                              ("large.png", self.large)):
+            with open(os.path.join(self.directory.name, name), "wb") as f:
+                f.write(content)
+        handler = type("Handler", (DirectoryHandler,),
+                       {"root": self.directory.name})
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), handler)
+        self.url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.tempdir = tempfile.TemporaryDirectory(prefix="imgur-test-")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+        self.tempdir.cleanup()
+
+    def test_download_image(self):
+        with capture_stderr():
+            # small images stay in memory
+            self.assertEqual(imgur.save.download_image(
+                self.url + "small.png", self.tempdir.name), self.small)
+            self.assertEqual(os.listdir(self.tempdir.name), [])
+            # large images are spooled to disk
+            savepath = imgur.save.download_image(self.url + "large.png",
+                                                 self.tempdir.name)
+            with open(savepath, "rb") as fileobj:
+                self.assertEqual(fileobj.read(), self.large)
+            os.remove(savepath)
+            # failed downloads leave nothing behind
+            self.assertIsNone(imgur.save.download_image(
+                self.url + "missing.png", self.tempdir.name))
+            self.assertEqual(os.listdir(self.tempdir.name), [])
+
+    def test_truncated(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), TruncatedHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with capture_stderr():
+                self.assertIsNone(imgur.save.download_image(
+                    "http://127.0.0.1:%d/image.png" %
+                    server.server_address[1], self.tempdir.name,
+                    retry=imgur.retry.Policy(attempts=2, backoff_base=0.01)))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(os.listdir(self.tempdir.name), [])
+
+    def test_near_duplicate_fallback(self):
+        image = PIL.Image.new("RGB", (40, 30))
+        image.putdata([(x * 6, y * 8, 0) for y in range(30)
+                       for x in range(40)])
+        for i in range(3):
+            image.save(os.path.join(self.directory.name, "%d.png" % i))
+        source_urls = [self.url + "%d.png" % i for i in range(3)]
+        stats = collections.Counter()
+        # the group's first upload fails; another member takes over
+        with capture_stderr(), FakeImgur(statuses=[500]) as fake:
+            uploaded_urls = imgur.save.save_images(
+                pyimgur.Imgur("client_id"), source_urls, jobs=2,
+                engine="async", similar=imgur.similar.DEFAULT_THRESHOLD,
+                stats=stats, retry=imgur.retry.Policy(attempts=1))
+        self.assertEqual(uploaded_urls.count(None), 1)
+        links = set(uploaded_urls) - {None}
+        self.assertEqual(len(links), 1)
+        self.assertEqual(fake.upload_count, 1)
+        self.assertEqual(stats[imgur.save.DOWNLOAD] +
+                         stats[imgur.save.NEAR_DUPLICATE], 3)
+
+    def test_direct(self):
+        client = pyimgur.Imgur("client_id")
+        source_urls = [self.url + "small.png", self.url + "large.png",
+                       self.url + "missing.png"]
+        stats = collections.Counter()
+        with capture_stderr():
+            with FakeImgur(refused_urls=source_urls[1:]) as fake:
+                uploaded_urls = imgur.save.save_images(
+                    client, source_urls, jobs=2, engine="async",
+                    direct=True, stats=stats)
+        self.assertTrue(uploaded_urls[0] and uploaded_urls[1])
+        self.assertIsNone(uploaded_urls[2])
+        self.assertEqual(stats[imgur.save.DIRECT], 1)
+        self.assertEqual(stats[imgur.save.FALLBACK], 2)
+        # only the refused image that could be downloaded is uploaded
+        # as a file
+        self.assertEqual(sorted(form["type"][0] for form in fake.uploads),
+                         ["file", "url"])
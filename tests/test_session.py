@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import pickle
+import tempfile
+import unittest
+
+import pyimgur
+
+import imgur.retry
+import imgur.session
+
+from tests.fakeimgur import FakeImgur
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+        self.path = os.path.join(self.directory.name, "a.png")
+        with open(self.path, "wb") as fileobj:
+            fileobj.write(b"\x89PNG" * 100)
+        self.client = pyimgur.Imgur("client_id")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_upload(self):
+        with FakeImgur() as fake:
+            source_url = fake.url + "/source/1000/b.png"
+            fake.refused_urls.add(source_url)
+            items = [self.path, b"\x89PNG" * 10, io.BytesIO(b"\x89PNG"),
+                     source_url, os.path.join(self.directory.name, "missing")]
+            with imgur.session.Session(self.client, jobs=2,
+                                       ordered=True) as session:
+                results = list(session.upload(items))
+        self.assertEqual([result.index for result in results],
+                         list(range(5)))
+        self.assertEqual([result.source for result in results],
+                         [self.path, None, None, source_url, items[4]])
+        self.assertTrue(all(result.ok for result in results[:4]))
+        self.assertEqual([result.bytes for result in results[:4]],
+                         [400, 40, 4, 1000])
+        # refused URL downloaded and uploaded
+        self.assertEqual(fake.uploads[-1]["type"], ["file"])
+        failed = results[4]
+        self.assertFalse(failed.ok)
+        self.assertEqual(failed.error, "FileNotFoundError")
+        self.assertIsNone(failed.link)
+        self.assertTrue(results[0].latency >= results[0].seconds > 0)
+
+    def test_record(self):
+        result = imgur.session.Result(link="http://i.imgur.com/a.png")
+        self.assertFalse(hasattr(result, "__dict__"))
+        copy = pickle.loads(pickle.dumps(result))
+        self.assertEqual(copy.link, result.link)
+
+    def test_errors(self):
+        retry = imgur.retry.Policy(attempts=2, backoff_base=0)
+        with FakeImgur(statuses=[400, 500, 500]):
+            with imgur.session.Session(self.client, jobs=1,
+                                       engine="process",
+                                       retry=retry) as session:
+                results = list(session.upload([self.path] * 2))
+        self.assertEqual(sorted((result.error, result.attempts)
+                                for result in results),
+                         [("HTTPError", 1), ("HTTPError", 2)])
+
+    def test_cancel(self):
+        with FakeImgur(latency=0.05):
+            with imgur.session.Session(self.client, jobs=1) as session:
+                results = []
+                for result in session.upload([self.path] * 20):
+                    results.append(result)
+                    session.cancel()
+        # only what was in flight when cancelled
+        self.assertTrue(1 <= len(results) < 20)
+
+    def test_close(self):
+        with FakeImgur(latency=0.05):
+            session = imgur.session.Session(self.client, jobs=2)
+            results = session.upload([self.path] * 20)
+            next(results)
+            session.close()
+            self.assertEqual(list(results), [])
+        self.assertFalse(os.path.exists(session.directory.name))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import tempfile
+import unittest
+
+import numpy
+import PIL.Image
+import pyimgur
+
+import imgur.similar
+import imgur.upload
+
+from tests.fakeimgur import FakeImgur
+
+class TestSimilar(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def save(self, image, name, **kwargs):
+        path = os.path.join(self.directory.name, name)
+        image.save(path, **kwargs)
+        return path
+
+    def test_dhash(self):
+        pixels = numpy.random.RandomState(0).randint(0, 256, (5, 8, 9))
+        hashes = imgur.similar.dhash(pixels)
+        self.assertEqual(hashes, [imgur.similar.dhash(p) for p in pixels])
+        # leftmost pair of the top row is the most significant bit
+        pixels = numpy.zeros((8, 9), dtype=numpy.uint8)
+        pixels[0, 1] = 1
+        self.assertEqual(imgur.similar.dhash(pixels), 1 << 63)
+
+    def test_bktree(self):
+        rng = random.Random(0)
+        hashes = [rng.getrandbits(64) for _ in range(500)]
+        hashes += [h ^ (1 << rng.randrange(64)) for h in hashes[:50]]
+        tree = imgur.similar.BKTree()
+        for i, image_hash in enumerate(hashes):
+            tree.add(image_hash, i)
+        for probe in hashes[:20]:
+            expected = sorted(
+                (imgur.similar.hamming(probe, h), i)
+                for i, h in enumerate(hashes)
+                if imgur.similar.hamming(probe, h) <= 8)
+            self.assertEqual(sorted(tree.search(probe, 8)), expected)
+
+    def test_group_similar(self):
+        groups = imgur.similar.group_similar([0b0000, None, 0b0011, 0b1111,
+                                              0b0001], threshold=1)
+        self.assertEqual(groups, [[0, 4], [1], [2], [3]])
+
+    def test_upload_images(self):
+        # smooth, so that resizes keep its features
+        coarse = numpy.random.RandomState(0).randint(0, 256, (6, 8, 3))
+        image = PIL.Image.fromarray(coarse.astype(numpy.uint8)).resize(
+            (400, 300), PIL.Image.BICUBIC)
+        paths = [
+            self.save(image.resize((40, 30)), "thumbnail.png"),
+            self.save(image, "original.png"),
+            self.save(PIL.Image.new("RGB", (10, 10), "red"), "other.png"),
+            self.save(image, "reencoded.jpg", quality=70),
+        ]
+        with FakeImgur() as fake:
+            links = imgur.upload.upload_images(
+                pyimgur.Imgur("client_id"), paths, jobs=2, engine="async",
+                similar=imgur.similar.DEFAULT_THRESHOLD)
+        self.assertEqual(len(fake.uploads), 2)
+        # the largest of the group is uploaded for all of it
+        self.assertEqual(sorted(form["title"][0] for form in fake.uploads),
+                         ["original.png", "other.png"])
+        self.assertEqual(links[0], links[1])
+        self.assertEqual(links[0], links[3])
+        self.assertNotEqual(links[0], links[2])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+import imgur.engine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# generous, so as not to fail on slow machines; see benchmarks.startup
+IMPORT_BUDGET = 1.0
+
+def get_pid(_):
+    return os.getpid()
+
+class TestStartup(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        script = ("import json, sys, time\n"
+                  "start = time.perf_counter()\n"
+                  "import imgur.cli\n"
+                  "print(json.dumps([time.perf_counter() - start,"
+                  " sorted(sys.modules)]))\n")
+        output = subprocess.check_output([sys.executable, "-c", script],
+                                         cwd=ROOT, universal_newlines=True)
+        elapsed, modules = json.loads(output)
+        for name in ("asyncio", "imgur.request", "multiprocessing",
+                     "pyimgur", "requests"):
+            self.assertNotIn(name, modules)
+        self.assertLess(elapsed, IMPORT_BUDGET)
+
+    def test_single_item(self):
+        # no pool for a single item
+        results = list(imgur.engine.imap(get_pid, [None], count=1,
+                                         engine="process"))
+        self.assertEqual(results, [(0, os.getpid())])
+
+if __name__ == "__main__":
+    unittest.main()
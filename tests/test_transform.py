@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import collections
+import io
+import os
+import tempfile
+import unittest
+
+import PIL.Image
+import pyimgur
+
+import imgur.transform
+import imgur.upload
+
+from tests.fakeimgur import FakeImgur
+
+class TestTransform(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+        # noisy enough not to compress well as PNG
+        self.imagepath = os.path.join(self.directory.name, "photo.png")
+        PIL.Image.frombytes("RGB", (400, 300),
+                            os.urandom(400 * 300 * 3)).save(self.imagepath)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_policy(self):
+        self.assertFalse(imgur.transform.Policy())
+        self.assertTrue(imgur.transform.Policy(optimize_png=True))
+        with self.assertRaises(ValueError):
+            imgur.transform.Policy(convert="bmp")
+
+    def test_resize_and_convert(self):
+        policy = imgur.transform.Policy(max_dimension=200, convert="jpeg")
+        transformed = imgur.transform.transform_image(
+            self.imagepath, policy, self.directory.name)
+        self.assertNotEqual(transformed.path, self.imagepath)
+        self.assertEqual(transformed.size, os.path.getsize(transformed.path))
+        self.assertLess(transformed.size, transformed.original_size)
+        with PIL.Image.open(transformed.path) as image:
+            self.assertEqual(image.format, "JPEG")
+            self.assertEqual(image.size, (200, 150))
+
+    def test_unchanged(self):
+        # below the conversion threshold, and small enough
+        policy = imgur.transform.Policy(max_dimension=1000, convert="webp",
+                                        convert_above=10 ** 9)
+        transformed = imgur.transform.transform_image(
+            self.imagepath, policy, self.directory.name)
+        self.assertEqual(transformed.path, self.imagepath)
+        self.assertEqual(os.listdir(self.directory.name), ["photo.png"])
+
+    def test_upload_images(self):
+        stats = collections.Counter()
+        policy = imgur.transform.Policy(convert="jpeg")
+        with FakeImgur() as fake:
+            links = imgur.upload.upload_images(
+                pyimgur.Imgur("client_id"), [self.imagepath] * 3, jobs=2,
+                engine="async", transform=policy, stats=stats)
+        self.assertTrue(all(links))
+        self.assertEqual(stats["transformed"], 3)
+        for form in fake.uploads:
+            self.assertEqual(form["title"], ["photo.png"])
+            image = PIL.Image.open(io.BytesIO(form["image"][0]))
+            self.assertEqual(image.format, "JPEG")
+        # originals are left alone
+        self.assertEqual(os.listdir(self.directory.name), ["photo.png"])
+
+    def test_missing(self):
+        missing = os.path.join(self.directory.name, "gone.png")
+        policy = imgur.transform.Policy(max_dimension=100)
+        transformed = imgur.transform.transform_image(
+            missing, policy, self.directory.name)
+        self.assertIsNotNone(transformed.error)
+        # fails the image, not the batch
+        with FakeImgur() as fake:
+            links = imgur.upload.upload_images(
+                pyimgur.Imgur("client_id"), [self.imagepath, missing],
+                jobs=2, transform=policy)
+        self.assertTrue(links[0])
+        self.assertIsNone(links[1])
+        self.assertEqual(fake.upload_count, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import PIL.Image
+
+import imgur.validate
+
+class TestValidate(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_formats(self):
+        image = PIL.Image.new("RGB", (123, 45))
+        for image_type, pil_format in [("png", "PNG"), ("jpeg", "JPEG"),
+                                       ("gif", "GIF"), ("webp", "WEBP"),
+                                       ("bmp", "BMP"), ("tiff", "TIFF")]:
+            path = self.path("image." + image_type)
+            image.save(path, pil_format)
+            validation = imgur.validate.validate_image(path)
+            self.assertIsNone(validation.reason, image_type)
+            self.assertEqual(validation.type, image_type)
+            self.assertEqual((validation.width, validation.height), (123, 45))
+
+    def test_videos(self):
+        heads = {
+            "mp4": b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom",
+            "mov": b"\x00\x00\x00\x14ftypqt  \x20\x05\x03\x00qt  ",
+            "webm": (b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01\x42\xf7\x81"
+                     b"\x01\x42\xf2\x81\x04\x42\xf3\x81\x08\x42\x82\x84"
+                     b"webm"),
+        }
+        for video_type, head in heads.items():
+            path = self.path("video." + video_type)
+            with open(path, "wb") as fileobj:
+                fileobj.write(head)
+                # over the limit for images, not for videos
+                fileobj.truncate(imgur.validate.MAX_SIZE + 1)
+            validation = imgur.validate.validate_image(path)
+            self.assertIsNone(validation.reason, video_type)
+            self.assertEqual(validation.type, video_type)
+            with open(path, "ab") as fileobj:
+                fileobj.truncate(imgur.validate.VIDEO_MAX_SIZE + 1)
+            self.assertEqual(
+                imgur.validate.validate_image(path).reason,
+                "larger than the 200 MiB limit for %s videos" %
+                video_type.upper())
+
+    def test_rejections(self):
+        with open(self.path("text.png"), "wb") as fileobj:
+            fileobj.write(b"not really a png")
+        open(self.path("empty.png"), "wb").close()
+        with open(self.path("truncated.jpg"), "wb") as fileobj:
+            fileobj.write(b"\xff\xd8\xff\xe0\x00\x10JFIF")
+        with open(self.path("huge.png"), "wb") as fileobj:
+            fileobj.write(b"\x89PNG\r\n\x1a\n")
+            fileobj.truncate(imgur.validate.MAX_SIZE + 1)
+        paths = [self.path(name) for name in ["text.png", "empty.png",
+                                              "truncated.jpg", "huge.png",
+                                              "missing.png"]]
+        reasons = [validation.reason for validation
+                   in imgur.validate.validate_images(paths)]
+        self.assertEqual(reasons, [
+            "not a recognized image format",
+            "empty file",
+            "corrupt JPEG header: no frame header",
+            "larger than the 20 MiB limit for PNG images",
+            "No such file or directory",
+        ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import pyimgur
+
+import imgur.session
+import imgur.worker
+
+from tests.fakeimgur import FakeImgur
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+        self.spool = imgur.worker.Spool(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_claim(self):
+        name = self.spool.submit(["a.png", "http://example.com/b.png"],
+                                 name="job")
+        self.assertEqual(self.spool.pending(), ["job"])
+        # only one of several workers gets a job
+        self.assertEqual(self.spool.claim("host.1"), "job")
+        self.assertIsNone(self.spool.claim("host.2"))
+        self.assertEqual(self.spool.read_job(name, "host.1"),
+                         [os.path.abspath("a.png"),
+                          "http://example.com/b.png"])
+
+    def test_reclaim(self):
+        self.spool.submit(["a.png"], name="job")
+        self.spool.claim("dead.1")
+        self.assertEqual(self.spool.reclaim(lease=30), [])
+        self.assertEqual(self.spool.reclaim(lease=0), ["job"])
+        self.assertEqual(self.spool.pending(), ["job"])
+        # the worker that lost its claim finds out when renewing
+        lease = imgur.worker.Lease(self.spool.claimed_path("job", "dead.1"))
+        lease.renew()
+        self.assertTrue(lease.lost.is_set())
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="imgur-test-")
+        self.spool = imgur.worker.Spool(
+            os.path.join(self.directory.name, "spool"))
+        self.paths = []
+        for index in range(3):
+            path = os.path.join(self.directory.name, "%d.png" % index)
+            with open(path, "wb") as fileobj:
+                fileobj.write(b"\x89PNG" * (index + 1))
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def done(self, name):
+        return os.path.join(self.spool.path, "done", name)
+
+    def test_run(self):
+        missing = os.path.join(self.directory.name, "missing.png")
+        self.spool.submit(self.paths + [missing], name="first")
+        self.spool.submit(self.paths[:1], name="second")
+        with FakeImgur() as fake, imgur.session.Session(
+                pyimgur.Imgur("client_id"), jobs=2) as session:
+            worker = imgur.worker.Worker(self.spool, session, owner="w.1")
+            self.assertEqual(worker.run(once=True), 2)
+        self.assertEqual(fake.upload_count, 4)
+        self.assertTrue(os.path.exists(self.done("first")))
+        with open(self.done("first.results")) as results_obj:
+            results = [json.loads(line) for line in results_obj]
+        self.assertEqual([result["index"] for result in results],
+                         [0, 1, 2, 3])
+        self.assertEqual([result["bytes"] for result in results[:3]],
+                         [4, 8, 12])
+        self.assertTrue(all(result["link"] for result in results[:3]))
+        self.assertEqual(results[3]["error"], "FileNotFoundError")
+        self.assertEqual(results[3]["worker"], "w.1")
+        self.assertEqual(os.listdir(os.path.join(self.spool.path, "work")),
+                         [])
+
+    def test_resume(self):
+        # a crashed worker had uploaded the first item
+        self.spool.submit(self.paths, name="job")
+        with open(self.spool.results_path("job"), "w") as results_obj:
+            results_obj.write(json.dumps({"index": 0, "link": "http://x",
+                                          "worker": "dead.1"}) + "\n")
+            results_obj.write('{"index": 1, "li')
+        with FakeImgur() as fake, imgur.session.Session(
+                pyimgur.Imgur("client_id"), jobs=2) as session:
+            imgur.worker.Worker(self.spool, session).run(once=True)
+        self.assertEqual(fake.upload_count, 2)
+        results = imgur.worker.read_results(self.done("job.results"))
+        self.assertEqual(results[0]["worker"], "dead.1")
+        self.assertEqual(sorted(results), [0, 1, 2])
+
+    def test_torn_results(self):
+        self.spool.submit(self.paths, name="job")
+        results_path = self.spool.results_path("job")
+        with open(results_path, "w") as results_obj:
+            results_obj.write('{"index": 1, "li')
+        # crash before finishing, leaving work/job.results behind
+        with FakeImgur(), imgur.session.Session(
+                pyimgur.Imgur("client_id"), jobs=2) as session, \
+                unittest.mock.patch.object(self.spool, "finish"):
+            imgur.worker.Worker(self.spool, session).run(once=True)
+        # none of the records appended after the torn line is lost
+        self.assertEqual(sorted(imgur.worker.read_results(results_path)),
+                         [0, 1, 2])
+
+if __name__ == "__main__":
+    unittest.main()